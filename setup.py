@@ -32,8 +32,10 @@ setup(
         'console_scripts': [
             'vlcc-run = vlcc.main:main',
             'vlcc-http = vlcc.http.main:main',
+            'vlcc-worker = vlcc.worker:main',
         ],
     },
-    scripts=([] if using_setuptools else ['bin/vlcc-run', 'bin/vlcc-http']),
+    scripts=([] if using_setuptools else ['bin/vlcc-run', 'bin/vlcc-http',
+                                       'bin/vlcc-worker']),
     cmdclass=dict(build_py=build_py)
 )
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#
+# Chunked multi-mirror download tests, served by local HTTP servers
+#
+# Run with `python -m unittest discover tests` from the source tree root.
+#
+
+import hashlib
+import logging
+import unittest
+
+import os
+import re
+import posixpath
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import BaseHTTPServer
+import SimpleHTTPServer
+
+from vlcc import download
+from vlcc.core import options
+from vlcc.conf import config
+from vlcc.db import db
+from vlcc.download import ChunkedDownload, Mirror
+from vlcc.source import Source
+
+
+CHUNK_SIZE = 64 << 10
+
+BLOCK_SIZE = 4 << 10
+
+FILENAME = 'vlc-2.0.5.tar.xz'
+
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d+)')
+
+# Cut short and slow responses hang for a while, so streaming readers
+# consume the bytes written before a failure and get ahead of a retry
+DELAY = .3
+
+
+class PlainHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """SimpleHTTPServer handler serving the server's root directory, byte
+    ranges are ignored.
+    """
+
+    def translate_path(self, path):
+        # The stock one serves the current directory
+        return os.path.join(self.server.root,
+                            posixpath.basename(path.split('?')[0]))
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeHandler(PlainHandler):
+    """SimpleHTTPServer handler serving byte ranges.
+
+    Requests of ranges starting within the server's `broken` chunks are cut
+    short, the ones within its `flaky` chunks are cut short once and the
+    ones within its `slow` chunks start with a delay. Every served range
+    offset is appended to its `served` list.
+    """
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+
+        if not os.path.isfile(path):
+            return self.send_error(404)
+
+        with open(path, 'rb') as served_file:
+            data = served_file.read()
+
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+
+        if match is None:
+            return PlainHandler.do_GET(self)
+
+        start = int(match.group(1))
+        end = min(int(match.group(2)), len(data) - 1)
+        body = data[start:end + 1]
+        chunk_offset = start - start % CHUNK_SIZE
+
+        if len(body) > 1 and chunk_offset in self.server.slow:
+            time.sleep(DELAY)
+
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes {0}-{1}/{2}'
+                         .format(start, end, len(data)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if len(body) <= 1:
+            return self.wfile.write(body)
+
+        self.server.served.append(start)
+
+        if chunk_offset in self.server.flaky:
+            self.server.flaky.discard(chunk_offset)
+        elif chunk_offset not in self.server.broken:
+            return self.wfile.write(body)
+
+        self.wfile.write(body[:len(body) // 2])
+        self.wfile.flush()
+        time.sleep(DELAY)
+
+
+class Server(object):
+    """HTTP server serving a directory in a thread.
+    """
+
+    def __init__(self, root, handler=RangeHandler):
+        self.httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.root = root
+        self.httpd.served = []
+        self.httpd.broken = set()
+        self.httpd.flaky = set()
+        self.httpd.slow = set()
+        self.base_url = 'http://127.0.0.1:{0}'.format(self.httpd.server_port)
+
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def get_mirror(self):
+        return Mirror(self.base_url, self.base_url + '/' + FILENAME)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class ChunkedDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.old_sizes = download.CHUNK_SIZE, download.BLOCK_SIZE
+        download.CHUNK_SIZE, download.BLOCK_SIZE = CHUNK_SIZE, BLOCK_SIZE
+
+        config['db'] = os.path.join(self.temp_dir, 'vlcc.db')
+        db.connect()
+
+        # Not a multiple of the chunk size
+        self.data = os.urandom(CHUNK_SIZE * 10 + 1234)
+        self.digest = hashlib.sha256(self.data).hexdigest()
+
+        self.servers = []
+        self.root = self.make_root('root', self.data)
+        self.path = os.path.join(self.temp_dir, FILENAME + '.part')
+        self.logger = logging.getLogger('test')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+        download.CHUNK_SIZE, download.BLOCK_SIZE = self.old_sizes
+        config.clear()
+        shutil.rmtree(self.temp_dir)
+
+    def make_root(self, name, data):
+        root = os.path.join(self.temp_dir, name)
+        os.makedirs(root)
+
+        with open(os.path.join(root, FILENAME), 'wb') as served_file:
+            served_file.write(data)
+
+        return root
+
+    def start_server(self, root=None, handler=RangeHandler):
+        server = Server(root or self.root, handler)
+        self.servers.append(server)
+
+        return server
+
+    def run_download(self, mirrors, connections=2):
+        process = ChunkedDownload(mirrors, self.path, self.logger,
+                                  connections)
+        self.assertTrue(process.start())
+
+        deadline = time.time() + 30
+
+        while process.poll() is None:
+            self.assertLess(time.time(), deadline, "Download hangs")
+            time.sleep(0.05)
+
+        return process
+
+    def get_digest(self):
+        with open(self.path, 'rb') as downloaded_file:
+            return hashlib.sha256(downloaded_file.read()).hexdigest()
+
+    def test_ranges(self):
+        first, second = self.start_server(), self.start_server()
+        process = self.run_download([first.get_mirror(),
+                                     second.get_mirror()], connections=4)
+
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(process.get_available(), len(self.data))
+        self.assertEqual(self.get_digest(), self.digest)
+        self.assertEqual(sorted(first.httpd.served + second.httpd.served),
+                         range(0, len(self.data), CHUNK_SIZE))
+        self.assertFalse(os.path.exists(self.path + '.chunks'))
+
+    def test_probe(self):
+        good = self.start_server()
+        plain = self.start_server(handler=PlainHandler)
+        other = self.start_server(self.make_root('other', self.data[:-1]))
+
+        # Nothing listens on a closed server's port
+        gone = self.start_server()
+        gone.stop()
+        self.servers.remove(gone)
+
+        mirrors = [plain.get_mirror(), good.get_mirror(), other.get_mirror(),
+                   gone.get_mirror()]
+        process = self.run_download(mirrors)
+
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(self.get_digest(), self.digest)
+        self.assertEqual([mirror.disabled for mirror in mirrors],
+                         [True, False, True, True])
+        self.assertEqual(other.httpd.served, [])
+
+    def test_retry(self):
+        broken, good = self.start_server(), self.start_server()
+        broken.httpd.broken.update(range(0, len(self.data), CHUNK_SIZE))
+
+        mirrors = [broken.get_mirror(), good.get_mirror()]
+        process = self.run_download(mirrors)
+
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(self.get_digest(), self.digest)
+        self.assertTrue(mirrors[0].disabled)
+        self.assertEqual(mirrors[0].bytes, 0)
+        # The chunks cut short are resumed from the bytes already written
+        self.assertLess(mirrors[1].bytes, len(self.data))
+        self.assertIn(CHUNK_SIZE // 2, good.httpd.served)
+
+    def test_failure(self):
+        broken = self.start_server()
+        broken.httpd.broken.update(range(0, len(self.data), CHUNK_SIZE))
+
+        process = self.run_download([broken.get_mirror()])
+
+        self.assertEqual(process.returncode, 1)
+        self.assertIsNotNone(process.error)
+
+    def test_resume(self):
+        server = self.start_server()
+        # The first chunks succeed, the download fails at the fourth one
+        server.httpd.broken.update(range(3 * CHUNK_SIZE, len(self.data),
+                                         CHUNK_SIZE))
+
+        process = self.run_download([server.get_mirror()], connections=1)
+
+        self.assertEqual(process.returncode, 1)
+        self.assertTrue(os.path.exists(self.path + '.chunks'))
+
+        server.httpd.broken.clear()
+        del server.httpd.served[:]
+
+        process = self.run_download([server.get_mirror()], connections=1)
+
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(process.initial_size, 3 * CHUNK_SIZE)
+        self.assertEqual(sorted(server.httpd.served),
+                         range(3 * CHUNK_SIZE, len(self.data), CHUNK_SIZE))
+        self.assertEqual(self.get_digest(), self.digest)
+
+    def test_stream(self):
+        # An archive of incompressible data spanning several chunks
+        payload_dir = os.path.join(self.temp_dir, 'payload')
+        os.makedirs(payload_dir)
+
+        with open(os.path.join(payload_dir, 'data'), 'wb') as payload_file:
+            payload_file.write(self.data)
+
+        archive_path = os.path.join(self.temp_dir, FILENAME)
+        subprocess.check_call(['tar', '-C', payload_dir, '-cJf',
+                               archive_path, 'data'])
+
+        with open(archive_path, 'rb') as archive:
+            archive_data = archive.read()
+
+        first = self.start_server(self.make_root('archive', archive_data))
+        second = self.start_server(first.httpd.root)
+
+        # Whichever mirror gets the third chunk cuts it short, the retry
+        # lags behind the reader
+        for server in [first, second]:
+            server.httpd.flaky.add(2 * CHUNK_SIZE)
+            server.httpd.slow.add(2 * CHUNK_SIZE)
+
+        options.build_dir = os.path.join(self.temp_dir, 'build')
+        config.update({
+            'cache_dir': os.path.join(self.temp_dir, 'cache'),
+            'download_url': first.base_url,
+            'download_mirrors': [second.base_url],
+            'download_connections': 1,
+            'versions': {'2.0.5': {
+                'sha256': hashlib.sha256(archive_data).hexdigest(),
+            }},
+        })
+
+        source = Source('2.0.5', Jail(self.logger))
+        # Reading behind the downloading thread
+        source.chunk_size = 4096
+        source.start()
+        source.finish()
+
+        self.assertIsInstance(source.process, ChunkedDownload)
+        self.assertIn(2 * CHUNK_SIZE + CHUNK_SIZE // 2,
+                      first.httpd.served + second.httpd.served)
+        self.assertTrue(source.is_extracted())
+
+        with open(os.path.join(source.ready_dir, 'data'), 'rb') as data:
+            self.assertEqual(data.read(), self.data)
+
+
+class Jail(object):
+    """Jail stub executing the commands on the host.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def exec_command(self, command, **kwargs):
+        kwargs.pop('async', None)
+        return subprocess.Popen(command, **kwargs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import json
+
+import os
+import shutil
+import subprocess
+import threading
+
+from .usage import account
+
+
+__all__ = ['Agent', 'AgentProcess']
+
+
+# Agent script path inside jails
+AGENT_PATH = '/usr/local/lib/vlcc-agent.py'
+
+
+class AgentProcess(object):
+    """subprocess.Popen-like handle of a command run by the agent.
+
+    The command's stderr is always merged into its stdout.
+    """
+
+    def __init__(self, agent, sink, pipe=None, close_sink=False):
+        """Initializes the handle.
+
+        @param agent: agent running the command
+        @param sink: file object to write the output to or None to discard it
+        @param pipe: read end of the output pipe if stdout is piped
+        @param close_sink: close the sink once the command is finished
+        """
+
+        self.agent = agent
+        self.sink = sink
+        self.close_sink = close_sink
+        self.stdout = pipe
+        self.pid = None
+        self.returncode = None
+        self.error = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+
+    def receive(self):
+        """Reads the agent replies until the command is finished, runs in
+        a thread.
+        """
+
+        try:
+            for line in iter(self.agent.process.stdout.readline, ''):
+                message = json.loads(line)
+
+                if 'pid' in message:
+                    self.pid = message['pid']
+                    self.started.set()
+                elif 'output' in message:
+                    if self.sink is not None:
+                        self.sink.write(message['output'].encode('latin-1'))
+                elif 'exit' in message:
+                    self.error = message.get('error')
+
+                    if 'rusage' in message:
+                        # The command isn't a child of vlcc
+                        account(message['rusage'])
+
+                    self.returncode = message['exit']
+                    break
+            else:
+                # The agent is gone
+                self.agent.dead = True
+                self.returncode = -1
+        finally:
+            if self.close_sink:
+                self.sink.close()
+
+            self.agent.lock.release()
+            self.started.set()
+            self.finished.set()
+
+    def poll(self):
+        """Returns the exit status or None if the command is running.
+        """
+
+        return self.returncode if self.finished.is_set() else None
+
+    def wait(self):
+        """Waits for the command and returns the exit status.
+        """
+
+        # Waiting with timeouts keeps the main thread interruptible
+        while not self.finished.wait(1.):
+            pass
+
+        return self.returncode
+
+    def communicate(self):
+        """Reads the piped output and waits for the command.
+
+        @return: tuple of (output, None)
+        """
+
+        output = self.stdout.read() if self.stdout is not None else None
+        self.wait()
+
+        return output, None
+
+
+class Agent(object):
+    """Host side of the long-lived command execution agent running inside
+    a jail.
+
+    The agent runs one command at a time, so spawning chroot and a shell
+    per command and quoting the command into a shell string are avoided.
+    It lives as long as the process that has started it, i. e. a single
+    build task when the scheduler runs the builds.
+    """
+
+    def __init__(self, jail):
+        self.jail = jail
+        self.process = None
+        self.dead = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Installs the agent script into the jail and starts it.
+
+        @return: False if the agent can't run in the jail
+        """
+
+        if not os.path.exists(self.jail.get_path('/usr/bin/python')):
+            return False
+
+        script = os.path.join(os.path.dirname(__file__), 'misc/agent.py')
+        shutil.copy2(script, self.jail.get_path(AGENT_PATH))
+
+        self.process = self.jail.exec_command(['chroot', self.jail.chroot_dir,
+                                               'python', '-u', AGENT_PATH],
+                                              async=True,
+                                              stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE,
+                                              stderr=None)
+        return True
+
+    def execute(self, argv, cwd=None, env=None, userspec=None,
+                stdout=None, async=False):
+        """Runs a command with the agent.
+
+        @param argv: command arguments list
+        @param cwd: working directory inside the jail
+        @param env: environment dict, the agent's one by default
+        @param userspec: `USER[:GROUP]` string to use
+        @param stdout: subprocess.PIPE, file object or descriptor to write
+            the output to, None to discard it
+        @param async: returns immediately if True
+
+        @return: AgentProcess instance or None if the agent is busy or
+            unavailable
+        """
+
+        if self.dead or not self.lock.acquire(False):
+            return None
+
+        if self.process is None and not self.start():
+            self.dead = True
+            self.lock.release()
+            return None
+
+        pipe = None
+        close_sink = True
+
+        if stdout == subprocess.PIPE:
+            if async:
+                read_fd, write_fd = os.pipe()
+
+                # Other children mustn't keep the pipe open
+                for fd in (read_fd, write_fd):
+                    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+                pipe = os.fdopen(read_fd, 'rb')
+                sink = os.fdopen(write_fd, 'wb')
+            else:
+                # Nobody can read it before the command is finished
+                sink = None
+                close_sink = False
+        elif isinstance(stdout, int):
+            sink = os.fdopen(os.dup(stdout), 'wb')
+        else:
+            sink = stdout
+            close_sink = False
+
+        process = AgentProcess(self, sink, pipe, close_sink)
+
+        request = dict(argv=argv, cwd=cwd, env=env, userspec=userspec)
+
+        try:
+            self.process.stdin.write(json.dumps(request) + '\n')
+            self.process.stdin.flush()
+        except IOError:
+            self.dead = True
+            self.lock.release()
+            return None
+
+        thread = threading.Thread(target=process.receive)
+        thread.daemon = True
+        thread.start()
+
+        process.started.wait()
+
+        if process.error is not None:
+            self.jail.logger.error("Unable to execute {0}, the message was: "
+                                   "`{1}`".format(argv[0], process.error))
+
+        return process
+
+    def stop(self):
+        """Stops the agent, it exits on stdin EOF.
+        """
+
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
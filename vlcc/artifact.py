@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import os
+import re
+import shutil
+import subprocess
+
+from .core import logger, fail_with_error
+from .conf import split_build
+from .store import Store, file_digest
+
+
+__all__ = ['ArtifactStore']
+
+
+# readelf output line listing a shared library dependency
+NEEDED_RE = re.compile(r'\(NEEDED\)\s+Shared library: \[(.+)\]')
+
+
+class ArtifactStore(Store):
+    """Installed VLC trees store.
+
+    Every artifact is a compressed tarball of the installed tree named by its
+    sha256 digest, plus a JSON manifest describing the jail it requires.
+    Artifacts are found by references named after the VLC version and its
+    `installed` build state fingerprint.
+    """
+
+    def __init__(self):
+        super(ArtifactStore, self).__init__('artifacts')
+
+    def get_ref_path(self, version, fingerprint, root=None):
+        """Returns an artifact reference path.
+
+        @param version: VLC version string
+        @param fingerprint: `installed` build state fingerprint
+        @param root: store directory, the local one by default
+        """
+
+        return os.path.join(root or self.root,
+                            "{0}-{1}.ref".format(version, fingerprint))
+
+    def find(self, version, fingerprint):
+        """Returns the artifact digest or None if there's no such artifact.
+
+        @param version: VLC version string
+        @param fingerprint: `installed` build state fingerprint
+        """
+
+        ref_path = self.get_ref_path(version, fingerprint)
+
+        if not os.path.exists(ref_path):
+            return None
+
+        with open(ref_path) as ref_file:
+            digest = ref_file.read().strip()
+
+        return digest if self.has(digest, '.tar.xz') else None
+
+    def get_manifest(self, digest, root=None):
+        """Loads an artifact manifest.
+
+        @param digest: artifact digest
+        @param root: store directory, the local one by default
+        """
+
+        path = os.path.join(root or self.root, digest + '.json')
+
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+
+    def get_source_digest(self, version):
+        """Returns the sources archive digest recorded in the latest stored
+        artifact manifest of a VLC version or its variants, or None.
+
+        @param version: VLC version string
+        """
+
+        manifests = []
+
+        for filename in os.listdir(self.root):
+            if not filename.endswith('.ref'):
+                continue
+
+            with open(os.path.join(self.root, filename)) as ref_file:
+                digest = ref_file.read().strip()
+
+            path = self.get_path(digest, '.json')
+
+            if not os.path.exists(path):
+                continue
+
+            manifest = self.get_manifest(digest)
+
+            if (split_build(manifest['version'])[0] == version and
+                    manifest.get('source_sha256') is not None):
+                manifests.append((os.path.getmtime(path), manifest))
+
+        if not manifests:
+            return None
+
+        return max(manifests)[1]['source_sha256']
+
+    def add(self, jail, tree_dir, manifest):
+        """Snapshots an installed tree into the store.
+
+        @param jail: jail the tree has been installed in
+        @param tree_dir: installed tree root path
+        @param manifest: manifest dict, must contain version and fingerprint
+
+        @return: artifact digest
+        """
+
+        manifest = dict(manifest, needed=get_needed(jail, tree_dir))
+
+        temp_path = self.get_temp_path('artifact', '.tar.xz')
+        jail.exec_command(['tar', '-C', tree_dir, '--numeric-owner',
+                           '-cJf', temp_path, '.'])
+
+        digest = file_digest(temp_path)
+        manifest['sha256'] = digest
+
+        self.commit(temp_path, digest, '.tar.xz')
+
+        with open(self.get_path(digest, '.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+
+        with open(self.get_ref_path(manifest['version'],
+                                    manifest['fingerprint']), 'w') as ref:
+            ref.write(digest)
+
+        return digest
+
+    def export(self, dest_dir, versions=None):
+        """Copies artifacts into another store directory.
+
+        @param dest_dir: destination store directory
+        @param versions: VLC versions to export, all by default
+
+        @return: exported artifacts number
+        """
+
+        return self._transfer(self.root, dest_dir, versions)
+
+    def import_(self, src_dir, versions=None):
+        """Copies artifacts from another store directory verifying them.
+
+        @param src_dir: source store directory
+        @param versions: VLC versions to import, all by default
+
+        @return: imported artifacts number
+        """
+
+        return self._transfer(src_dir, self.root, versions)
+
+    def _transfer(self, src_dir, dest_dir, versions):
+        """Copies artifacts between store directories.
+
+        @param src_dir: source store directory
+        @param dest_dir: destination store directory
+        @param versions: VLC versions to copy, all if None
+        """
+
+        try:
+            os.makedirs(dest_dir)
+        except OSError:
+            pass
+
+        count = 0
+
+        for filename in sorted(os.listdir(src_dir)):
+            if not filename.endswith('.ref'):
+                continue
+
+            with open(os.path.join(src_dir, filename)) as ref_file:
+                digest = ref_file.read().strip()
+
+            manifest = self.get_manifest(digest, src_dir)
+
+            if versions and manifest['version'] not in versions:
+                continue
+
+            bundle = digest + '.tar.xz'
+            dest_path = os.path.join(dest_dir, bundle)
+
+            if not os.path.exists(dest_path):
+                temp_path = os.path.join(dest_dir, '.' + bundle)
+                shutil.copyfile(os.path.join(src_dir, bundle), temp_path)
+
+                if file_digest(temp_path) != digest:
+                    os.unlink(temp_path)
+                    fail_with_error("Artifact {0} is corrupted".format(bundle))
+
+                os.rename(temp_path, dest_path)
+
+            for name in [digest + '.json', filename]:
+                shutil.copyfile(os.path.join(src_dir, name),
+                                os.path.join(dest_dir, name))
+
+            logger.info("Copied VLC {0} artifact {1}"
+                        .format(manifest['version'], digest))
+            count += 1
+
+        return count
+
+
+def get_needed(jail, tree_dir):
+    """Returns shared libraries required by an installed tree and not
+    provided by it.
+
+    @param jail: jail the tree has been installed in
+    @param tree_dir: installed tree root path
+    """
+
+    provided = set()
+    paths = []
+
+    for dirpath, dirnames, filenames in os.walk(tree_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+
+            if os.path.isfile(path) and not os.path.islink(path):
+                paths.append(path)
+
+            if '.so' in filename:
+                provided.add(filename)
+
+    needed = set()
+
+    # readelf in batches, it fails on non-ELF files, so ignoring the status
+    for index in range(0, len(paths), 256):
+        process = jail.exec_command(['readelf', '-d'] +
+                                    paths[index:index + 256],
+                                    async=True, stdout=subprocess.PIPE,
+                                    stderr=open(os.devnull, 'w'))
+        output, _ = process.communicate()
+        needed.update(NEEDED_RE.findall(output))
+
+    return sorted(needed - provided)
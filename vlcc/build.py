@@ -2,41 +2,81 @@
 
 from functools import wraps
 
+import collections
+import contextlib
+
+import fcntl
+
 import os
+import shutil
 
 from .core import options, get_child_logger, fail_with_error
-from .conf import config
-from .jail import Jail
+from .conf import config, split_build, get_build_config
+from .jail import Jail, get_available_memory
+from .cgroup import parse_size
+from .jobserver import get_jobserver
+from .store import Store, fingerprint
+from .source import Source
+from .usage import Usage
+from .artifact import ArtifactStore
+from .dedupe import dedupe_source
+from .snapshot import SnapshotStore
+from .units import CompileProfiler
 from .db import db
 
 
-__all__ = ['build']
+__all__ = ['build', 'Builder', 'TASKS', 'SHARED_TASKS', 'get_prefix',
+           'get_build_dir', 'get_state']
+
+
+# Installation staging directory prefix inside jails
+INSTALL_DIR = '/tmp/vlcc-install'
+
+# Out-of-tree build directories parent inside jails
+BUILD_DIR = '/usr/local/build'
+
+# Shared ccache directory mount point and log file prefix inside jails
+CCACHE_DIR = '/var/cache/ccache'
+CCACHE_LOG = '/var/log/ccache'
+
+# Expected build tree size to the source tree size ratio, bounds tmpfs use
+BUILD_FACTOR = 3
+
+
+# Build states in order of execution
+STATES = [None,
+          'jail_created',
+          'source_unpacked',
+          'configured',
+          'compiled',
+          'installed']
 
 
 def build_state(state):
     """Updates the build state in case of successful execution of the
-    decorated method.
+    decorated method and records the stage resource usage.
 
     This actually implements build states failback.
     """
 
+    assert state in STATES
+
     def _build_state(method):
         @wraps(method)
         def __build_state(builder, *args, **kwargs):
-            states = [None,
-                      'jail_created',
-                      'source_unpacked',
-                      'configured',
-                      'compiled',
-                      'installed']
-
-            assert state in states
-
-            if states.index(state) > states.index(builder.state):
+            if not builder.has_state(state):
+                builder.storage = 'disk'
+                usage = Usage()
+                cgroup_stats = builder.jail.cgroup.get_stats()
                 result = method(builder, *args, **kwargs)
 
                 db.execute("UPDATE build SET state=? WHERE version=?",
                            [state, builder.version])
+                builder.state = state
+                builder.save_fingerprint(state)
+                builder.record_usage(state, usage.get())
+                builder.record_cgroup(state, cgroup_stats)
+                builder.take_snapshot(state)
                 return result
             else:
                 builder.build_logger.debug("Skipping build state `{0}`"
@@ -45,20 +85,95 @@ def build_state(state):
     return _build_state
 
 
+# Build tasks for the scheduler: name -> (resource class, dependencies,
+# build state reached on completion)
+TASKS = collections.OrderedDict([
+    ('fetch', ('network', [], 'source_unpacked')),
+    ('create_jail', ('disk', [], 'jail_created')),
+    ('unpack', ('disk', ['fetch', 'create_jail'], 'source_unpacked')),
+    ('configure', ('cpu', ['unpack'], 'configured')),
+    ('make', ('cpu', ['configure'], 'compiled')),
+    ('install', ('disk', ['make'], 'installed')),
+    ('restore', ('disk', ['create_jail'], 'installed')),
+])
+
+# Tasks done once per VLC version for all its variants
+SHARED_TASKS = ['fetch', 'create_jail', 'unpack']
+
+
+def get_prefix(name):
+    """Returns the installation prefix of a build, variants are installed
+    aside from the version itself.
+
+    @param name: build name
+    """
+
+    variant = split_build(name)[1]
+
+    return '/usr' if variant is None else '/opt/vlc-' + variant
+
+
+def get_build_dir(name):
+    """Returns the out-of-tree build directory of a build inside its jail.
+
+    @param name: build name
+    """
+
+    return os.path.join(BUILD_DIR, 'vlc-' + name.replace(':', '-'))
+
+
+def get_state(name):
+    """Returns the saved state of a build, None if it hasn't been started.
+
+    @param name: build name
+    """
+
+    cursor = db.query("SELECT state FROM build WHERE version=?", [name])
+    res = cursor.fetchone()
+
+    return res[0] if res is not None else None
+
+
 class Builder(object):
     """Builder class to create a chroot jail with debootstrap and building a
     VLC version.
 
+    Builds are named after VLC versions, variants of a version are named
+    like `2.0.5:debug`. Variants share the version's jail and unpacked
+    sources, every build is configured out-of-tree.
+
     Call the run() method to start a build.
     """
 
-    def __init__(self, version):
+    def __init__(self, version, read_only=False):
+        """Initializes the builder.
+
+        @param version: build name, i. e. VLC version string optionally
+            followed by `:variant`
+        @param read_only: only inspect the build, i. e. for planning, the
+            DB and the jail are left as they are
+        """
+
         self.version = version
+        self.read_only = read_only
+        self.base_version, self.variant = split_build(version)
         self.state = None
         self.build_logger = get_child_logger(version)
-        self.chroot_src_dir = os.path.join('/usr/local/src', 'vlc-' + version)
 
-        self.jail = Jail(version, self.build_logger)  # chroot jail object
+        slug = version.replace(':', '-')
+        self.chroot_src_dir = os.path.join('/usr/local/src',
+                                           'vlc-' + self.base_version)
+        self.chroot_build_dir = get_build_dir(version)
+        self.install_dir = INSTALL_DIR + '-' + slug
+        self.ccache_log = CCACHE_LOG + '-' + slug + '.log'
+        self.prefix = get_prefix(version)
+
+        # chroot jail object
+        self.jail = Jail(self.base_version, self.build_logger, name=version)
+        self.source = None
+        self.profiler = CompileProfiler(self)
+        # Where the current stage works on the source tree, see log_build()
+        self.storage = 'disk'
 
         # Getting current build version
 
@@ -66,33 +181,320 @@ class Builder(object):
         res = cursor.fetchone()
 
         if res is None:
-            db.execute("INSERT INTO build (version) VALUES (?)", [version])
+            if not read_only:
+                db.execute("INSERT INTO build (version) VALUES (?)",
+                           [version])
         else:
             self.state = res[0]
 
-    def start_download(self):
-        """Downloads the sources archive with wget.
+    def has_state(self, state):
+        """Checks whether the build has already passed the state.
+
+        @param state: build state name
+        """
+
+        return STATES.index(self.state) >= STATES.index(state)
+
+    def get_fingerprints(self):
+        """Returns build state fingerprints, i. e. hashes of each stage
+        inputs chained with the previous stage fingerprint.
+        """
+
+        build_config = get_build_config(self.version)
+
+        inputs = {
+            'jail_created': self.jail.get_fingerprint(),
+            # None until the archive is known somehow, nothing is restored
+            # from the artifacts then
+            'source_unpacked': self.get_source_digest(),
+            'configured': [build_config.get('configure', ''),
+                           build_config.get('cflags'),
+                           config.get('ccache', False),
+                           config.get('profile_compile', False),
+                           self.chroot_build_dir, self.prefix],
+            'compiled': None,
+            'installed': None,
+        }
+
+        fingerprints = {}
+        previous = None
+
+        for state in STATES[1:]:
+            previous = fingerprints[state] = fingerprint(state, previous,
+                                                         inputs[state])
+
+        return fingerprints
+
+    def get_source_digest(self):
+        """Returns the sources archive sha256 digest, either configured,
+        known from a download or recorded in a stored artifact manifest of
+        the version, or None.
+        """
+
+        digest = self.get_source().get_digest()
+
+        if digest is not None:
+            return digest
+
+        # The source store may have been cleaned up
+        cursor = db.query("SELECT sha256 FROM download "
+                          "WHERE build_version=? AND sha256 IS NOT NULL "
+                          "ORDER BY performed DESC LIMIT 1",
+                          [self.base_version])
+        res = cursor.fetchone()
+
+        if res is not None:
+            return res[0]
+
+        # Artifacts built and imported from another host
+        return ArtifactStore().get_source_digest(self.base_version)
+
+    def save_fingerprint(self, state):
+        """Saves the fingerprint of a completed build state.
+
+        @param state: build state name
+        """
+
+        db.execute("INSERT INTO build_fingerprint "
+                   "(build_version, state, fingerprint) VALUES (?, ?, ?)",
+                   [self.version, state, self.get_fingerprints()[state]])
+
+    def set_state(self, state, fingerprints):
+        """Sets the build state replacing the saved fingerprints.
+
+        @param state: build state name
+        @param fingerprints: fingerprints dict of the state and the ones
+            before it
+        """
+
+        self.state = state
+
+        db.execute("UPDATE build SET state=? WHERE version=?",
+                   [state, self.version])
+        db.execute("DELETE FROM build_fingerprint WHERE build_version=?",
+                   [self.version])
+
+        for name in STATES[1:STATES.index(state) + 1]:
+            db.execute("INSERT INTO build_fingerprint "
+                       "(build_version, state, fingerprint) VALUES (?, ?, ?)",
+                       [self.version, name, fingerprints[name]])
+
+    def take_snapshot(self, state):
+        """Snapshots the jail at a completed build state if configured.
+
+        @param state: build state name
         """
 
-        ext = 'xz' if self.version[0] == '2' else 'bz2'
-        filename = "vlc-{0}.tar.{1}".format(self.version, ext)
+        # Variants share the version's jail, it's snapshotted by the version
+        if not config.get('snapshots', False) or self.variant is not None:
+            return
 
-        self.download_url = "/".join((config['download_url'],
-                                      self.version, filename))
-        self.archive_path = os.path.join(options.build_dir, filename)
+        fingerprints = self.get_fingerprints()
+        fingerprints = dict((name, fingerprints[name])
+                            for name in STATES[1:STATES.index(state) + 1])
 
-        command = ['wget', '-c', '-P', options.build_dir, '-O',
-                   self.archive_path, self.download_url]
+        SnapshotStore(self.version).take(state, self.jail, fingerprints)
 
-        self.download_proc = self.jail.exec_command(command, async=True)
-        self.build_logger.info("Starting download from " + self.download_url)
+    def rollback(self, state):
+        """Restores the jail from a snapshot and rolls the build state back
+        to the snapshot one.
+
+        @param state: build state name
+        """
+
+        fingerprints = SnapshotStore(self.version).restore(state, self.jail)
+        self.set_state(state, fingerprints)
+
+        self.build_logger.info("Rolled VLC {0} back to state `{1}`"
+                               .format(self.version, state))
+
+    def branch(self, state, version):
+        """Starts another version build from a snapshot of this one.
+
+        The new version must have the same jail root FS and sources, i. e.
+        the same `sha256` in its description, otherwise it'd be unpacked
+        again anyway. The next build of the new version only redoes the
+        stages whose inputs differ, e. g. configure with other options.
+
+        @param state: build state name
+        @param version: new build VLC version string
+        """
+
+        builder = Builder(version)
+        store = SnapshotStore(self.version)
+        manifest = store.get_manifest(state)
+
+        if manifest is not None:
+            fingerprints = builder.get_fingerprints()
+            shared = STATES[1:min(STATES.index(state),
+                                  STATES.index('source_unpacked')) + 1]
+
+            if any(manifest['fingerprints'][name] != fingerprints[name]
+                   for name in shared):
+                fail_with_error("VLC {0} jail or sources differ from the VLC "
+                                "{1} snapshot ones, give both the same "
+                                "sha256 or describe a variant instead"
+                                .format(version, self.version))
+
+        fingerprints = store.restore(state, builder.jail)
+
+        for old, new in [(self.chroot_src_dir, builder.chroot_src_dir),
+                         (self.chroot_build_dir, builder.chroot_build_dir)]:
+            path = builder.jail.get_path(old)
+
+            if os.path.isdir(path) and old != new:
+                # Configured trees refer to their absolute paths
+                os.rename(path, builder.jail.get_path(new))
+                os.symlink(os.path.basename(new), path)
+
+        builder.set_state(state, fingerprints)
+
+        self.build_logger.info("Branched VLC {0} from state `{1}` of VLC {2}"
+                               .format(version, state, self.version))
+
+    def invalidate(self):
+        """Rolls the build state back to the last state whose inputs haven't
+        changed, so only the affected stages are run again.
+        """
+
+        if self.state is None:
+            return
+
+        cursor = db.query("SELECT state, fingerprint FROM build_fingerprint "
+                          "WHERE build_version=?", [self.version])
+        saved = dict(cursor.fetchall())
+        fingerprints = self.get_fingerprints()
+
+        for index, state in enumerate(STATES[1:], 1):
+            if not self.has_state(state):
+                break
+
+            if state not in saved:
+                # Built before fingerprinting, trusting it
+                if not self.read_only:
+                    self.save_fingerprint(state)
+
+                continue
+
+            if saved[state] != fingerprints[state]:
+                self.build_logger.info("Inputs of build state `{0}` have "
+                                       "changed, rebuilding from it"
+                                       .format(state))
+                self.reset(STATES[index - 1])
+                break
+
+        # Garbage collection may have removed the trees the stages need
+        if (self.state in ('configured', 'compiled') and
+                not self.has_build_tree()):
+            self.reset('source_unpacked')
+
+        if self.state == 'source_unpacked' and not self.has_source_tree():
+            self.reset('jail_created')
+
+    def reset(self, state):
+        """Rolls the build state back forgetting the later states'
+        fingerprints.
+
+        @param state: build state name, None to build from scratch
+        """
+
+        later = STATES[STATES.index(state) + 1:]
+        self.state = state
+
+        if self.read_only:
+            return
+
+        db.execute("UPDATE build SET state=? WHERE version=?",
+                   [state, self.version])
+        db.execute("DELETE FROM build_fingerprint "
+                   "WHERE build_version=? AND state IN ({0})"
+                   .format(", ".join("?" * len(later))),
+                   [self.version] + later)
+
+    def record_usage(self, stage, usage):
+        """Saves a build stage resource usage into the DB.
+
+        @param stage: build state name
+        @param usage: resource usage dict, see vlcc.usage.Usage
+        """
+
+        self.build_logger.info("Stage `{0}` took {1[wall_time]:.2f}s "
+                               "on {2}, CPU user {1[user_time]:.2f}s, "
+                               "sys {1[sys_time]:.2f}s"
+                               .format(stage, usage, self.storage))
+
+        params = dict(usage, version=self.version, stage=stage,
+                      storage=self.storage)
+
+        db.execute("INSERT INTO build_stage "
+                   "(build_version, stage, wall_time, user_time, sys_time, "
+                   "    max_rss, read_bytes, write_bytes, storage) "
+                   "VALUES (:version, :stage, :wall_time, :user_time, "
+                   "    :sys_time, :max_rss, :read_bytes, :write_bytes, "
+                   "    :storage)",
+                   params)
+
+    def record_cgroup(self, stage, start):
+        """Saves a build stage cgroup counters into the DB.
+
+        @param stage: build state name
+        @param start: counters before the stage, see vlcc.cgroup.CGroup
+        """
+
+        stats = self.jail.cgroup.get_stats()
+
+        if not stats:
+            return
+
+        params = dict((key, value - start.get(key, 0))
+                      for key, value in stats.iteritems()
+                      if key != 'memory_peak')
+        params.update(memory_peak=stats['memory_peak'], version=self.version,
+                      stage=stage)
+
+        if params['oom_kills']:
+            self.build_logger.warning("{0[oom_kills]} process(es) killed "
+                                      "by OOM killer at stage `{1}`"
+                                      .format(params, stage))
+
+        db.execute("INSERT INTO build_cgroup "
+                   "(build_version, stage, cpu_time, user_time, sys_time, "
+                   "    throttled_time, memory_peak, oom_kills) "
+                   "VALUES (:version, :stage, :cpu_time, :user_time, "
+                   "    :sys_time, :throttled_time, :memory_peak, :oom_kills)",
+                   params)
+
+    def get_source(self):
+        """Returns the sources archive object.
+        """
+
+        if self.source is None:
+            self.source = Source(self.base_version, self.jail)
+
+        return self.source
+
+    def start_download(self):
+        """Starts downloading the sources archive unless it's stored already.
+        """
+
+        if self.has_state('source_unpacked') and self.has_source_tree():
+            return
+
+        self.get_source().start()
 
     def finish_download(self):
         """Waits for the download to finish.
         """
 
-        if 0 != self.download_proc.wait():
-            fail_with_error("Download failed :-(")
+        if self.source is not None:
+            self.source.finish()
+
+    def fetch(self):
+        """Downloads the sources archive, the fetch task body.
+        """
+
+        self.start_download()
+        self.finish_download()
 
     @build_state('jail_created')
     def create_jail(self):
@@ -101,63 +503,457 @@ class Builder(object):
 
         self.jail.create()
 
+    def get_tree_path(self, inner_path, *rest):
+        """Returns the root FS path of a tree in the jail, read-only builders
+        look it up without mounting the jail.
+
+        @param inner_path: path inside the jail
+        @param rest: additional path components to join
+        """
+
+        if self.read_only:
+            return self.jail.get_stored_path(inner_path, *rest)
+
+        self.jail.prepare()
+
+        return self.jail.get_path(inner_path, *rest)
+
+    def has_source_tree(self):
+        """Checks whether the unpacked sources are in the jail, they aren't
+        if the build has been restored from an artifact.
+        """
+
+        return os.path.exists(self.get_tree_path(self.chroot_src_dir,
+                                                 'configure'))
+
+    def has_build_tree(self):
+        """Checks whether the configured build tree is in the jail.
+        """
+
+        return os.path.exists(self.get_tree_path(self.chroot_build_dir,
+                                                 'config.status'))
+
     @build_state('source_unpacked')
     def unpack(self):
         """Unpacks the downloaded sources archive.
         """
 
-        self.build_logger.info("Unpacking the downloaded archive")
+        self.unpack_tree()
+
+    def unpack_shared(self):
+        """Unpacks the sources for the version variants even if the version
+        itself has been restored from an artifact.
+        """
+
+        if self.has_state('source_unpacked') and not self.has_source_tree():
+            return self.unpack_tree()
+
+        self.unpack()
+
+    def unpack_tree(self):
+        """Moves the extracted sources into the jail.
+        """
+
+        source = self.get_source()
+
+        if not source.is_extracted():
+            archive_path = source.get_path()
+
+            if archive_path is None:
+                fail_with_error("VLC {0} sources archive is not downloaded"
+                                .format(self.version))
+
+            self.build_logger.info("Unpacking the downloaded archive")
+            source.extract(archive_path)
+
+        # Moving the verified tree into the jail
+        dest_dir = self.jail.get_path('/usr/local/src/')
+
+        for filename in os.listdir(source.ready_dir):
+            dest = os.path.join(dest_dir, filename)
+
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+
+            self.jail.exec_command(['mv',
+                                    os.path.join(source.ready_dir, filename),
+                                    dest_dir])
+
+        os.rmdir(source.ready_dir)
+
+        dedupe_source(self.jail.get_path(self.chroot_src_dir),
+                      self.build_logger)
+
+    def get_env(self):
+        """Returns the environment for build commands executed in jail.
+        """
+
+        env = dict(os.environ)
+
+        if config.get('ccache', False):
+            env.update(
+                CC='ccache gcc',
+                CXX='ccache g++',
+                CCACHE_DIR=CCACHE_DIR,
+                CCACHE_LOGFILE=self.ccache_log,
+            )
+
+        cflags = get_build_config(self.version).get('cflags')
+
+        if cflags:
+            env.update(CFLAGS=cflags, CXXFLAGS=cflags)
+
+        if self.profiler.is_enabled():
+            self.profiler.wrap(env)
+
+        return env
+
+    @contextlib.contextmanager
+    def use_ccache(self):
+        """Context manager bind-mounting the shared ccache directory into
+        the jail if ccache is enabled.
+        """
+
+        if not config.get('ccache', False):
+            yield
+            return
+
+        with self.jail.bind(Store('ccache').root, CCACHE_DIR):
+            yield
+
+    @contextlib.contextmanager
+    def use_job_slot(self):
+        """Context manager holding a jobserver token for the top-level make
+        process if the jobserver is started.
+        """
+
+        jobserver = get_jobserver()
+
+        if jobserver is None:
+            yield
+            return
+
+        with jobserver.slot():
+            yield
+
+    def record_ccache_stats(self):
+        """Counts ccache hits and misses of the last compilation and saves
+        them into the DB.
+        """
+
+        hits = misses = 0
 
-        command = ['tar', '-C',
-                   self.jail.get_path('/usr/local/src/'),
-                   '-xf', self.archive_path]
+        try:
+            with open(self.jail.get_path(self.ccache_log)) as log_file:
+                for line in log_file:
+                    if 'Result: cache hit' in line:
+                        hits += 1
+                    elif 'Result: cache miss' in line:
+                        misses += 1
+        except IOError:
+            return
 
-        self.jail.exec_command(command)
+        total = hits + misses
+        rate = 100. * hits / total if total else 0.
+
+        self.build_logger.info("ccache hits: {0}, misses: {1}, "
+                               "hit rate: {2:.2f}%"
+                               .format(hits, misses, rate))
+
+        db.execute("INSERT INTO ccache_stats (build_version, hits, misses) "
+                   "VALUES (?, ?, ?)", [self.version, hits, misses])
+
+    def get_tmpfs_size(self):
+        """Returns the tmpfs size to build on, None to build on disk.
+        """
+
+        setting = config.get('tmpfs', False)
+
+        if not setting:
+            return None
+
+        available = get_available_memory()
+
+        if setting in (True, 'auto'):
+            size = available / 2
+        else:
+            size = min(parse_size(setting), available)
+
+        required = self.jail.get_tree_size(self.chroot_src_dir) * BUILD_FACTOR
+
+        if size < required:
+            self.build_logger.info("Only {0} bytes of memory for {1} bytes "
+                                   "build tree, building on disk"
+                                   .format(size, required))
+            return None
+
+        return size
+
+    def log_build(self, command, log_to, log_message, env=None):
+        """Runs a command in the build tree logging the results.
+
+        The tree is moved onto tmpfs if it's configured and there's enough
+        memory. If the tmpfs runs out of space, the command is run again
+        on disk continuing from where it has stopped.
+
+        @param command: command string
+        @param log_to: log file name
+        @param log_message: message string to log
+        @param env: environment dict, the current one by default
+        """
+
+        kwargs = dict(command=command, cwd=self.chroot_build_dir, env=env,
+                      log_to=log_to, log_message=log_message)
+        size = self.get_tmpfs_size()
+
+        if size is not None:
+            self.storage = 'tmpfs'
+
+            try:
+                with self.jail.tmpfs(self.chroot_build_dir, size):
+                    return self.jail.log_chroot(**kwargs)
+            except SystemExit:
+                if not self.jail.tmpfs_full:
+                    raise
+
+            self.build_logger.warning("tmpfs is full, spilling to disk")
+            self.storage = 'spilled'
+
+        return self.jail.log_chroot(**kwargs)
+
+    def clean_source_tree(self):
+        """Cleans the source tree up if it has been configured in-tree by
+        the older vlcc versions, out-of-tree builds refuse such trees.
+        """
+
+        lock_path = self.jail.chroot_dir + '.src.lock'
+
+        with open(lock_path, 'w') as lock_file:
+            # Serializing the variants configured at the same time
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if os.path.exists(self.jail.get_path(self.chroot_src_dir,
+                                                 'config.status')):
+                self.jail.log_chroot('make distclean',
+                                     cwd=self.chroot_src_dir,
+                                     log_to='distclean.log',
+                                     log_message="Cleaning the source tree")
 
     @build_state('configured')
     def configure(self):
-        """Launches the `configure` script from jail.
+        """Launches the `configure` script from jail in the build tree.
         """
 
-        configure_args = config['versions'][self.version].get('configure', '')
-        command = './configure --prefix=/usr ' + configure_args
+        configure_args = get_build_config(self.version).get('configure', '')
+        command = '{0}/configure --prefix={1} {2}'.format(self.chroot_src_dir,
+                                                          self.prefix,
+                                                          configure_args)
+
+        build_dir = self.jail.get_path(self.chroot_build_dir)
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(build_dir)
 
-        self.jail.log_chroot(command,
-                             cwd=self.chroot_src_dir,
-                             log_to='configure.log',
-                             log_message="Configuring VLC")
+        self.clean_source_tree()
+
+        if self.profiler.is_enabled():
+            self.profiler.install()
+
+        with self.use_ccache():
+            self.log_build(command,
+                           env=self.get_env(),
+                           log_to='configure.log',
+                           log_message="Configuring VLC")
 
     @build_state('compiled')
     def make(self):
-        self.jail.log_chroot('make',
-                             cwd=self.chroot_src_dir,
-                             log_to='make.log',
-                             log_message="Compiling VLC")
+        """Compiles VLC sharing the host-wide make job slots.
+        """
+
+        env = self.get_env()
+        jobserver = get_jobserver()
+
+        if jobserver is not None:
+            env['MAKEFLAGS'] = jobserver.get_makeflags()
+
+        if self.profiler.is_enabled():
+            env.update(self.profiler.get_env())
+
+        # Collecting ccache stats of this very compilation only
+        try:
+            os.unlink(self.jail.get_path(self.ccache_log))
+        except OSError:
+            pass
+
+        with contextlib.nested(self.use_ccache(), self.use_job_slot()):
+            self.log_build('make',
+                           env=env,
+                           log_to='make.log',
+                           log_message="Compiling VLC")
+
+        if config.get('ccache', False):
+            self.record_ccache_stats()
+
+        if self.profiler.is_enabled():
+            self.profiler.record()
+
+    def get_manifest(self):
+        """Returns the installed VLC artifact manifest describing the
+        runtime requirements.
+        """
+
+        return {
+            'version': self.version,
+            'prefix': self.prefix,
+            'fingerprint': self.get_fingerprints()['installed'],
+            'source_sha256': self.get_source_digest(),
+            'distr': self.jail.version_config['distr'],
+            'arch': self.jail.version_config.get('arch'),
+            'packages': self.jail.get_packages(),
+        }
+
+    def get_artifact(self):
+        """Returns the digest of a stored artifact matching the build inputs
+        or None.
+        """
+
+        if self.has_state('installed'):
+            return None
+
+        return ArtifactStore().find(self.version,
+                                    self.get_fingerprints()['installed'])
 
     @build_state('installed')
     def install(self):
-        self.jail.log_chroot('make install',
-                             cwd=self.chroot_src_dir,
+        """Installs VLC into the jail and snapshots the installed tree into
+        the artifact store.
+        """
+
+        if not config.get('artifacts', True):
+            return self.jail.log_chroot('make install',
+                                        cwd=self.chroot_build_dir,
+                                        log_to='install.log',
+                                        log_message="Installing VLC")
+
+        install_dir = self.jail.get_path(self.install_dir)
+        shutil.rmtree(install_dir, ignore_errors=True)
+
+        self.jail.log_chroot('make install DESTDIR=' + self.install_dir,
+                             cwd=self.chroot_build_dir,
                              log_to='install.log',
                              log_message="Installing VLC")
 
+        self.jail.exec_command(['cp', '-a', install_dir + '/.',
+                                self.jail.get_path('/')])
+        self.jail.exec_chroot(['ldconfig'])
+
+        self.build_logger.info("Storing the installed VLC artifact")
+        digest = ArtifactStore().add(self.jail, install_dir,
+                                     self.get_manifest())
+        self.build_logger.info("Stored VLC artifact " + digest)
+
+        shutil.rmtree(install_dir)
+
+    def restore(self):
+        """Installs VLC from a stored artifact skipping the sources download,
+        configuring, compilation and installation.
+        """
+
+        store = ArtifactStore()
+        digest = self.get_artifact()
+
+        self.build_logger.info("Restoring VLC from artifact " + digest)
+
+        self.jail.exec_command(['tar', '-C', self.jail.get_path('/'),
+                                '--numeric-owner', '-xJpf',
+                                store.get_path(digest, '.tar.xz')])
+        self.jail.exec_chroot(['ldconfig'])
+
+        for state in STATES[1:]:
+            self.save_fingerprint(state)
+
+        db.execute("UPDATE build SET state=? WHERE version=?",
+                   ['installed', self.version])
+        self.state = 'installed'
+
+    def is_task_done(self, name, shared=False):
+        """Checks whether the build task has nothing to do.
+
+        @param name: task name, see TASKS
+        @param shared: the version variants need the task done, i. e. the
+            sources unpacked whatever artifacts there are
+        """
+
+        if shared and name != 'create_jail':
+            return (self.has_state('source_unpacked') and
+                    self.has_source_tree())
+
+        if self.has_state(TASKS[name][2]):
+            return True
+
+        restorable = self.get_artifact() is not None
+
+        if name == 'restore':
+            return not restorable
+
+        # The artifact makes everything but the jail needless
+        return restorable and name != 'create_jail'
+
+    def run_task(self, name):
+        """Runs a single build task, the scheduler calls this one in a
+        separate process.
+
+        @param name: task name, see TASKS
+        """
+
+        if name not in ('fetch', 'create_jail'):
+            self.jail.prepare()
+
+        try:
+            if name == 'unpack':
+                return self.unpack_shared()
+
+            getattr(self, name)()
+        finally:
+            # Every task runs in a cgroup of its own, the empty ones are
+            # left over otherwise
+            self.jail.cgroup.destroy()
+
     def run(self):
-        """This one makes the whole magic.
+        """This one makes the whole magic sequentially.
         """
 
-        self.start_download()
-        self.create_jail()
-        self.finish_download()
-        self.unpack()
-        self.configure()
-        self.make()
-        self.install()
+        self.invalidate()
+
+        # Variants leave the jail and the sources to the version
+        if self.variant is None:
+            shared = self
+        else:
+            shared = Builder(self.base_version)
+            shared.invalidate()
+
+        try:
+            if self.get_artifact() is not None:
+                shared.create_jail()
+                self.jail.prepare()
+                return self.restore()
+
+            shared.start_download()
+            shared.create_jail()
+            self.jail.prepare()
+            shared.finish_download()
+            shared.unpack_shared()
+            self.configure()
+            self.make()
+            self.install()
+        finally:
+            for builder in set([self, shared]):
+                builder.jail.cgroup.destroy()
 
 
 def build(version):
     """Creates a chroot jail with debootstrap and builds a VLC version.
 
-    @param version: VLC version string
+    @param version: build name
     """
 
     return Builder(version).run()
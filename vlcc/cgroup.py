@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import os
+import re
+import resource
+
+from .core import logger as core_logger
+from .conf import config, get_build_config
+
+
+__all__ = ['CGroup', 'get_limits']
+
+
+# cgroup v2 unified hierarchy mount point and the vlcc subtree in it
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_DIR = os.path.join(CGROUP_ROOT, 'vlcc')
+
+# Default cpu.weight, see the kernel cgroup-v2 documentation
+DEFAULT_WEIGHT = 100
+
+SIZE_RE = re.compile(r'^(\d+)\s*([KMGT]?)B?$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+    """Converts a size like `512M` or `4G` into bytes.
+
+    @param size: size string or bytes number
+    """
+
+    if size is None or isinstance(size, (int, long)):
+        return size
+
+    match = SIZE_RE.match(str(size).strip())
+
+    if match is None:
+        raise ValueError("Invalid size `{0}`".format(size))
+
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+def get_limits(name):
+    """Returns the resource limits of a build, i. e. the global `limits`
+    config section updated with the version's or the variant's own one.
+
+    @param name: build name
+    """
+
+    limits = dict(config.get('limits') or {})
+    limits.update(get_build_config(name).get('limits') or {})
+
+    return dict(cpu_weight=limits.get('cpu_weight'),
+                memory_max=parse_size(limits.get('memory_max')))
+
+
+def write_file(path, value):
+    """Writes a cgroup control file.
+
+    @param path: control file path
+    @param value: value to write
+    """
+
+    with open(path, 'w') as control_file:
+        control_file.write(str(value))
+
+
+def read_keyed(path):
+    """Reads a flat keyed cgroup file like cpu.stat into a dict.
+
+    @param path: control file path
+    """
+
+    try:
+        with open(path) as control_file:
+            return dict((key, int(value)) for key, value in
+                        (line.split() for line in control_file))
+    except (IOError, ValueError):
+        return {}
+
+
+def read_value(path):
+    """Reads a single value cgroup file, returns None if there's none.
+
+    @param path: control file path
+    """
+
+    try:
+        with open(path) as control_file:
+            return int(control_file.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+class CGroup(object):
+    """Per-build cgroup v2 slice.
+
+    Every jail command is moved into `vlcc/<build name>` cgroup with the
+    configured cpu.weight and memory.max, so concurrent builds can't starve
+    each other and the OOM killer only hits the offending build. If cgroups
+    can't be delegated, the memory limit is applied with setrlimit and the
+    CPU weight is approximated with the process niceness instead.
+    """
+
+    def __init__(self, name, logger=core_logger):
+        self.logger = logger
+        self.path = os.path.join(CGROUP_DIR, name)
+        self.limits = get_limits(name)
+        self.enabled = None
+
+    def create(self):
+        """Creates the cgroup and applies the limits.
+
+        @return: True if cgroups are usable
+        """
+
+        if self.enabled is not None:
+            return self.enabled
+
+        self.enabled = False
+
+        if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+            self.logger.debug("cgroup v2 isn't mounted, using rlimits")
+            return False
+
+        try:
+            if not os.path.isdir(CGROUP_DIR):
+                os.mkdir(CGROUP_DIR)
+
+            write_file(os.path.join(CGROUP_ROOT, 'cgroup.subtree_control'),
+                       '+cpu +memory')
+
+            write_file(os.path.join(CGROUP_DIR, 'cgroup.subtree_control'),
+                       '+cpu +memory')
+
+            if not os.path.isdir(self.path):
+                os.mkdir(self.path)
+
+            if self.limits['cpu_weight'] is not None:
+                write_file(os.path.join(self.path, 'cpu.weight'),
+                           self.limits['cpu_weight'])
+
+            if self.limits['memory_max'] is not None:
+                write_file(os.path.join(self.path, 'memory.max'),
+                           self.limits['memory_max'])
+                self.disable_swap()
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to set up cgroup {0}, using rlimits, "
+                                "the message was: `{1}`"
+                                .format(self.path, e.strerror))
+            return False
+
+        self.enabled = True
+        return True
+
+    def disable_swap(self):
+        """Doesn't let the build swap instead of being killed, the hosts
+        without swap accounting keep the memory limit alone.
+        """
+
+        try:
+            write_file(os.path.join(self.path, 'memory.swap.max'), 0)
+        except (IOError, OSError) as e:
+            self.logger.debug("Unable to disable swap in cgroup {0}, "
+                              "the message was: `{1}`"
+                              .format(self.path, e.strerror))
+
+    def attach(self):
+        """Moves the calling process into the cgroup or limits it with
+        rlimits, meant to be used as subprocess.Popen preexec_fn.
+        """
+
+        if self.enabled:
+            write_file(os.path.join(self.path, 'cgroup.procs'), os.getpid())
+            return
+
+        if self.limits['memory_max'] is not None:
+            memory_max = self.limits['memory_max']
+            resource.setrlimit(resource.RLIMIT_AS, (memory_max, memory_max))
+
+        if self.limits['cpu_weight'] is not None:
+            # Every nice level is about 1.25 times CPU weight difference
+            niceness = -math.log(float(self.limits['cpu_weight']) /
+                                 DEFAULT_WEIGHT, 1.25)
+            os.nice(max(-20, min(19, int(round(niceness)))))
+
+    def get_stats(self):
+        """Returns the cgroup resource counters, an empty dict if there's
+        no cgroup.
+
+        CPU times are in seconds, the memory peak is the cgroup lifetime one.
+        """
+
+        if not os.path.isdir(self.path):
+            return {}
+
+        cpu = read_keyed(os.path.join(self.path, 'cpu.stat'))
+        events = read_keyed(os.path.join(self.path, 'memory.events'))
+
+        return dict(
+            cpu_time=cpu.get('usage_usec', 0) / 1e6,
+            user_time=cpu.get('user_usec', 0) / 1e6,
+            sys_time=cpu.get('system_usec', 0) / 1e6,
+            throttled_time=cpu.get('throttled_usec', 0) / 1e6,
+            memory_peak=read_value(os.path.join(self.path, 'memory.peak')),
+            oom_kills=events.get('oom_kill', 0),
+        )
+
+    def destroy(self):
+        """Removes the cgroup if it's empty.
+        """
+
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+        self.enabled = None
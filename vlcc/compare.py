@@ -9,7 +9,9 @@ import subprocess
 import psutil
 
 from .core import options, get_child_logger, fail_with_error
+from .conf import split_build
 from .jail import Jail
+from .build import get_prefix
 from .db import db, dict_factory
 
 from .plot import Plot
@@ -25,14 +27,15 @@ class Sampler(object):
     def __init__(self, version, comparison):
         """Initializes the sampler.
 
-        @param version: VLC version string
+        @param version: build name
         @param comparison: comparison ID
         """
 
         self.version = version
         self.sample_logger = get_child_logger(version)
         self.movie_filename = os.path.basename(options.movie)
-        self.jail = Jail(version, self.sample_logger)
+        self.jail = Jail(split_build(version)[0], self.sample_logger,
+                         name=version)
         self.movie_info = {}
 
         cursor = db.execute("INSERT INTO comparison_build "
@@ -47,6 +50,8 @@ class Sampler(object):
         the jail.
         """
 
+        self.jail.prepare()
+
         misc = os.path.join(os.path.dirname(__file__), 'misc/')
 
         for filename in ['play.py', 'vlc.py']:
@@ -61,7 +66,16 @@ class Sampler(object):
         self.sample_logger.info("Playing " + options.movie)
 
         command = ['python', 'play.py', self.movie_filename]
-        self.process = self.jail.exec_chroot(command,
+        env = None
+
+        if split_build(self.version)[1] is not None:
+            # Variants are installed aside from the system libraries
+            prefix = get_prefix(self.version)
+            env = dict(os.environ,
+                       LD_LIBRARY_PATH=os.path.join(prefix, 'lib'),
+                       VLC_PLUGIN_PATH=os.path.join(prefix, 'lib/vlc/plugins'))
+
+        self.process = self.jail.exec_chroot(command, env=env,
                                              async=True, userspec='vlcc:vlcc',
                                              stdout=subprocess.PIPE)
 
@@ -130,10 +144,10 @@ class Sampler(object):
         return self
 
 
-def compare():
+def compare(versions=None):
     """Compares given VLC versions.
 
-    @param versions: versions list
+    @param versions: build names list, the command line ones by default
     """
 
     cursor = db.execute("INSERT INTO comparison (movie, ready) VALUES (?, ?)",
@@ -142,7 +156,7 @@ def compare():
     comparison = cursor.lastrowid
 
     samplers = [Sampler(version, comparison).run()
-                for version in options.versions]
+                for version in versions or options.versions]
 
     # Write movie info
     # ...
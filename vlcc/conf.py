@@ -12,7 +12,8 @@ from .core import fail_with_error
 config = {}
 
 
-__all__ = ['config', 'load_config']
+__all__ = ['config', 'load_config', 'split_build', 'has_build',
+           'get_build_config', 'get_build_names']
 
 
 def load_config(config_path):
@@ -41,3 +42,64 @@ def load_config(config_path):
         fail_with_error("Error parsing {0}, specify --traceback option for "
                         "details".format(config_path))
     config.update(cfg)
+
+
+def split_build(name):
+    """Splits a build name like `2.0.5:debug` into the VLC version and the
+    variant name, which is None for plain version builds.
+
+    @param name: build name
+    """
+
+    version, _, variant = name.partition(':')
+
+    return version, variant or None
+
+
+def has_build(name):
+    """Checks whether a build is described in the config.
+
+    @param name: build name
+    """
+
+    version, variant = split_build(name)
+    version_config = config.get('versions', {}).get(version)
+
+    if version_config is None:
+        return False
+
+    return variant is None or variant in (version_config.get('variants')
+                                          or {})
+
+
+def get_build_config(name):
+    """Returns a build description, i. e. the version one updated with the
+    variant's.
+
+    @param name: build name
+    """
+
+    version, variant = split_build(name)
+    build_config = dict(config['versions'][version])
+    variants = build_config.pop('variants', None) or {}
+
+    if variant is not None:
+        build_config.update(variants[variant])
+
+    return build_config
+
+
+def get_build_names():
+    """Returns the names of all the builds described in the config, the
+    versions and their variants.
+    """
+
+    names = []
+
+    for version, version_config in sorted(config.get('versions',
+                                                     {}).items()):
+        names.append(version)
+        names.extend(version + ':' + variant for variant in
+                     sorted(version_config.get('variants') or {}))
+
+    return names
@@ -13,6 +13,12 @@ from .conf import config
 __all__ = ['db', 'dict_factory']
 
 
+# Columns added to the existing tables: (table, column, definition)
+MIGRATIONS = [
+    ('build_stage', 'storage', "VARCHAR(8) DEFAULT 'disk'"),
+]
+
+
 def dict_factory(cursor, row):
     """Dictionary row factory function.
     """
@@ -51,8 +57,24 @@ class DB(object):
             except sqlite3.Error as e:
                 fail_with_error("Unable to load the SQL schema, "
                                 "the message was: `{0}`".format(e.message))
+
+        self.migrate()
         self.commit()
 
+    def migrate(self):
+        """Adds the missing columns to the tables created by the older
+        versions.
+        """
+
+        for table, column, definition in MIGRATIONS:
+            cursor = self.query("PRAGMA table_info({0})".format(table), [])
+
+            if column not in [row[1] for row in cursor.fetchall()]:
+                logger.info("Adding column {0} to table {1}"
+                            .format(column, table))
+                self.execute("ALTER TABLE {0} ADD COLUMN {1} {2}"
+                             .format(table, column, definition), [])
+
     def row_factory(self, factory=None):
         """Sets row factory, i. e., vlcc.db.dict_factory
 
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import glob
+import hashlib
+
+import os
+import stat
+import collections
+
+from .core import logger as core_logger, options
+from .conf import config
+
+
+__all__ = ['dedupe', 'dedupe_jail', 'dedupe_source']
+
+
+# FICLONE ioctl request number, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# Smaller files aren't worth hashing
+MIN_SIZE = 4096
+
+# Root FS directories deduplicated in jails
+ROOTFS_DIRS = ['bin', 'lib', 'lib32', 'lib64', 'sbin', 'usr']
+
+
+def file_hash(path):
+    """Returns sha1 digest of a file.
+
+    @param path: file path
+    """
+
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            digest.update(chunk)
+
+    return digest.digest()
+
+
+def clone(src, dest):
+    """Replaces dest file with a reflink copy of src keeping dest metadata.
+
+    @param src: source file path
+    @param dest: destination file path
+
+    @raise IOError: if the file system doesn't support reflinks
+    """
+
+    dest_stat = os.lstat(dest)
+    temp_path = dest + '.vlcc-dedupe'
+
+    try:
+        with open(src, 'rb') as src_file:
+            with open(temp_path, 'wb') as temp_file:
+                fcntl.ioctl(temp_file.fileno(), FICLONE, src_file.fileno())
+
+        os.chown(temp_path, dest_stat.st_uid, dest_stat.st_gid)
+        os.chmod(temp_path, stat.S_IMODE(dest_stat.st_mode))
+        os.utime(temp_path, (dest_stat.st_atime, dest_stat.st_mtime))
+        os.rename(temp_path, dest)
+    except:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def walk_files(roots, sizes=None):
+    """Yields regular files of the given trees grouped by size.
+
+    @param roots: tree paths list
+    @param sizes: yield only files of these sizes if not None
+
+    @return: dict of size -> list of (path, stat result)
+    """
+
+    files = collections.defaultdict(list)
+
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+
+                if not stat.S_ISREG(st.st_mode) or st.st_size < MIN_SIZE:
+                    continue
+
+                if sizes is None or st.st_size in sizes:
+                    files[st.st_size].append((path, st))
+
+    return files
+
+
+def dedupe(targets, peers, mode=None, logger=core_logger):
+    """Makes identical files of the target trees share storage with the peer
+    trees' ones.
+
+    Only target files are replaced, so the trees being built concurrently
+    are only read. Files share blocks copy-on-write, which is safe whatever
+    happens to them later. Hardlinks aren't, jails and sources are modified
+    in place by package upgrades, installations and `make distclean`, so
+    there's no such mode.
+
+    @param targets: tree paths to deduplicate
+    @param peers: tree paths to look for identical files in
+    @param mode: `reflink`, the configured one by default
+    @param logger: logger to report to
+
+    @return: bytes saved
+    """
+
+    mode = mode or config.get('dedupe')
+
+    if mode == 'hardlink':
+        logger.warning("Hardlinked files would change in every jail at "
+                       "once, set dedupe to `reflink`, skipping "
+                       "deduplication")
+        return 0
+
+    if mode != 'reflink':
+        return 0
+
+    target_files = walk_files(targets)
+    peer_files = walk_files(peers, set(target_files))
+
+    saved = count = 0
+
+    for size, candidates in peer_files.iteritems():
+        # Digest -> (path, stat result) of the peer files
+        digests = {}
+
+        for path, st in candidates:
+            digests.setdefault(file_hash(path), (path, st))
+
+        for path, st in target_files[size]:
+            peer = digests.get(file_hash(path))
+
+            if peer is None:
+                continue
+
+            peer_path, peer_st = peer
+
+            if (peer_st.st_dev, peer_st.st_ino) == (st.st_dev, st.st_ino):
+                continue
+
+            if peer_st.st_dev != st.st_dev:
+                continue
+
+            try:
+                clone(peer_path, path)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                               errno.ENOTTY):
+                    logger.warning("The file system doesn't support "
+                                   "reflinks, skipping deduplication")
+                    return saved
+                raise
+
+            saved += size
+            count += 1
+
+    logger.info("Deduplicated {0} files, {1} bytes saved"
+                .format(count, saved))
+
+    return saved
+
+
+def dedupe_source(src_dir, logger=core_logger):
+    """Deduplicates freshly unpacked VLC sources against the other jails'
+    ones.
+
+    @param src_dir: unpacked sources path
+    @param logger: logger to report to
+    """
+
+    src_dir = os.path.realpath(src_dir)
+    peers = [path for path in glob.glob(os.path.join(options.build_dir,
+                                                     'jail-*', 'usr', 'local',
+                                                     'src', 'vlc-*'))
+             if os.path.realpath(path) != src_dir]
+
+    return dedupe([src_dir], peers, logger=logger)
+
+
+def dedupe_jail(chroot_dir, logger=core_logger):
+    """Deduplicates a fresh plain jail root FS against the other jails and
+    the overlay bases.
+
+    Only the system directories are considered.
+
+    @param chroot_dir: jail root FS path
+    @param logger: logger to report to
+    """
+
+    chroot_dir = os.path.realpath(chroot_dir)
+
+    roots = (glob.glob(os.path.join(options.build_dir, 'jail-*')) +
+             glob.glob(os.path.join(options.build_dir, 'base-*')))
+    roots = [path for path in roots
+             if os.path.isdir(path) and not path.endswith(('.upper', '.work',
+                                                           '.tmp', '.lock',
+                                                           '.tmpfs'))
+             and os.path.realpath(path) != chroot_dir]
+
+    def subdirs(root):
+        return [os.path.join(root, name) for name in ROOTFS_DIRS
+                if os.path.isdir(os.path.join(root, name))
+                and not os.path.islink(os.path.join(root, name))]
+
+    peers = sum((subdirs(root) for root in roots), [])
+
+    return dedupe(subdirs(chroot_dir), peers, logger=logger)
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+
+import httplib
+import json
+import socket
+import urllib2
+
+import os
+import re
+import time
+import threading
+
+from .db import db
+
+
+__all__ = ['ChunkedDownload', 'Mirror']
+
+
+# Byte range fetched by a single request
+CHUNK_SIZE = 4 << 20
+
+# Socket read size
+BLOCK_SIZE = 64 << 10
+
+# Socket timeout in seconds
+TIMEOUT = 60.
+
+# Mirrors failing this many times in a row are given up
+MAX_FAILURES = 3
+
+# Chunks failing this many times fail the download
+MAX_ATTEMPTS = 5
+
+# Past transfers per mirror the initial score is based on
+HISTORY = 10
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+\d+-\d+/(\d+)')
+
+
+class Mirror(object):
+    """Download mirror scored by the throughput measured on its chunks.
+    """
+
+    def __init__(self, base_url, url):
+        """Initializes the mirror.
+
+        @param base_url: mirror base URL, see `download_mirrors` option
+        @param url: file URL on the mirror
+        """
+
+        self.base_url = base_url
+        self.url = url
+        self.active = 0
+        self.failures = 0
+        self.total_failures = 0
+        self.bytes = 0
+        self.seconds = 0.
+        self.disabled = False
+
+        cursor = db.query("SELECT SUM(bytes), SUM(seconds) FROM ("
+                          "    SELECT bytes, seconds FROM mirror_transfer "
+                          "    WHERE url=? ORDER BY performed DESC LIMIT ?"
+                          ")", [base_url, HISTORY])
+        size, seconds = cursor.fetchone()
+
+        # Unknown mirrors are tried first
+        self.throughput = (float(size) / seconds if seconds
+                           else float('inf'))
+
+    def get_score(self):
+        """Returns the expected throughput of one more connection.
+        """
+
+        return self.throughput / (self.active + 1)
+
+    def succeed(self, size, seconds):
+        """Updates the throughput with a fetched chunk.
+
+        @param size: chunk size
+        @param seconds: chunk fetching time
+        """
+
+        self.failures = 0
+        self.bytes += size
+        self.seconds += seconds
+
+        measured = size / max(seconds, 1e-3)
+
+        if self.throughput == float('inf'):
+            self.throughput = measured
+        else:
+            self.throughput = (self.throughput + measured) / 2.
+
+    def fail(self):
+        """Counts a failed chunk, the mirror is disabled after MAX_FAILURES
+        ones in a row.
+        """
+
+        self.failures += 1
+        self.total_failures += 1
+        self.disabled = self.failures >= MAX_FAILURES
+
+    def record(self):
+        """Saves the mirror transfer statistics into the DB.
+        """
+
+        if self.seconds or self.total_failures:
+            db.execute("INSERT INTO mirror_transfer "
+                       "(url, bytes, seconds, failures) "
+                       "VALUES (?, ?, ?, ?)",
+                       [self.base_url, self.bytes, self.seconds,
+                        self.total_failures])
+
+
+class Chunk(object):
+    """Byte range of the downloaded file.
+    """
+
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+        self.state = 'pending'
+        # Bytes written from the offset, chunks are written sequentially and
+        # a failed one is resumed, so the written prefix never shrinks
+        self.written = 0
+        self.attempts = 0
+        self.tried = set()
+
+
+class ChunkedDownload(object):
+    """subprocess.Popen-like parallel download of a file fetching byte ranges
+    from several mirrors at once.
+
+    Every chunk goes to the mirror with the best measured throughput per
+    connection and its rest is retried on another one if it fails. The file
+    is preallocated and written in place, the contiguous downloaded prefix
+    is available for streaming while the rest is being fetched. Completed
+    chunks are listed in a `.chunks` file next to it, so an interrupted
+    download resumes with the missing ones.
+    """
+
+    def __init__(self, mirrors, path, logger, connections=4):
+        """Initializes the download.
+
+        @param mirrors: Mirror instances list, the preferred one first
+        @param path: destination file path
+        @param logger: logger to report to
+        @param connections: concurrent connections number
+        """
+
+        self.mirrors = mirrors
+        self.path = path
+        self.map_path = path + '.chunks'
+        self.logger = logger
+        self.connections = connections
+
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.size = None
+        self.initial_size = 0
+        self.error = None
+        self.returncode = None
+
+    def probe(self):
+        """Finds out the file size, the mirrors ignoring byte ranges or
+        serving another size are disabled.
+        """
+
+        for mirror in self.mirrors:
+            request = urllib2.Request(mirror.url,
+                                      headers={'Range': 'bytes=0-0'})
+
+            try:
+                response = urllib2.urlopen(request, timeout=TIMEOUT)
+            except (urllib2.URLError, socket.error,
+                    httplib.HTTPException) as e:
+                self.logger.warning("Mirror {0} is unavailable: {1}"
+                                    .format(mirror.base_url, e))
+                mirror.disabled = True
+                continue
+
+            match = CONTENT_RANGE_RE.match(response.info().get('Content-Range',
+                                                               ''))
+            response.close()
+
+            if response.getcode() != 206 or match is None:
+                # Every chunk would be read from the file start
+                self.logger.warning("Mirror {0} doesn't serve byte ranges, "
+                                    "skipping it".format(mirror.base_url))
+                mirror.disabled = True
+                continue
+
+            size = match.group(1)
+
+            if self.size is None:
+                self.size = int(size)
+            elif self.size != int(size):
+                self.logger.warning("Mirror {0} serves {1} bytes instead of "
+                                    "{2}, skipping it"
+                                    .format(mirror.base_url, size, self.size))
+                mirror.disabled = True
+
+    def load_map(self):
+        """Returns the indices of the chunks completed by an interrupted
+        download of the same file.
+        """
+
+        try:
+            with open(self.map_path) as map_file:
+                chunk_map = json.load(map_file)
+        except (IOError, ValueError):
+            return set()
+
+        if (chunk_map.get('size') != self.size or
+                chunk_map.get('chunk_size') != CHUNK_SIZE):
+            return set()
+
+        return set(chunk_map['done'])
+
+    def save_map(self):
+        """Saves the completed chunks list, called with the lock held.
+        """
+
+        done = [index for index, chunk in enumerate(self.chunks)
+                if chunk.state == 'done']
+
+        with open(self.map_path + '.tmp', 'w') as map_file:
+            json.dump(dict(size=self.size, chunk_size=CHUNK_SIZE, done=done),
+                      map_file)
+
+        os.rename(self.map_path + '.tmp', self.map_path)
+
+    def start(self):
+        """Preallocates the file and starts the download threads.
+
+        @return: False if no mirror can serve the file
+        """
+
+        self.probe()
+
+        if self.size is None:
+            return False
+
+        done = self.load_map()
+
+        with open(self.path, 'ab') as output:
+            output.truncate(self.size)
+
+        for index, offset in enumerate(xrange(0, self.size, CHUNK_SIZE)):
+            chunk = Chunk(offset, min(CHUNK_SIZE, self.size - offset))
+
+            if index in done:
+                chunk.state = 'done'
+                self.initial_size += chunk.size
+
+            self.chunks.append(chunk)
+
+        threads = [threading.Thread(target=self.work)
+                   for _ in xrange(self.connections)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        supervisor = threading.Thread(target=self.supervise, args=(threads,))
+        supervisor.daemon = True
+        supervisor.start()
+
+        return True
+
+    def supervise(self, threads):
+        """Sets the exit status once all the download threads are done.
+
+        @param threads: download threads list
+        """
+
+        for thread in threads:
+            thread.join()
+
+        if self.error is None and any(chunk.state != 'done'
+                                      for chunk in self.chunks):
+            self.error = "Download threads quit unexpectedly"
+
+        if self.error is None:
+            if os.path.exists(self.map_path):
+                os.unlink(self.map_path)
+        else:
+            self.logger.error(self.error)
+
+        self.returncode = 0 if self.error is None else 1
+
+    def pick_mirror(self, chunk):
+        """Returns the best mirror to fetch a chunk from or None, called with
+        the lock held.
+
+        @param chunk: chunk to fetch
+        """
+
+        enabled = [mirror for mirror in self.mirrors if not mirror.disabled]
+        candidates = [mirror for mirror in enabled
+                      if mirror.base_url not in chunk.tried]
+
+        if not candidates and chunk.attempts < MAX_ATTEMPTS:
+            # Every mirror has failed it once, trying them again
+            candidates = enabled
+
+        if not candidates:
+            return None
+
+        return max(candidates, key=lambda mirror: mirror.get_score())
+
+    def work(self):
+        """Fetches the pending chunks in offset order until there are none,
+        runs in a thread.
+        """
+
+        while True:
+            with self.lock:
+                if self.error is not None:
+                    return
+
+                chunk = next((chunk for chunk in self.chunks
+                              if chunk.state == 'pending'), None)
+
+                if chunk is None:
+                    return
+
+                mirror = self.pick_mirror(chunk)
+
+                if mirror is None:
+                    self.error = ("Unable to download bytes {0}-{1} from any "
+                                  "mirror".format(chunk.offset,
+                                                  chunk.offset + chunk.size))
+                    return
+
+                chunk.state = 'running'
+                chunk.attempts += 1
+                mirror.active += 1
+                resumed = chunk.written
+
+            started = time.time()
+            success = self.fetch(chunk, mirror)
+
+            with self.lock:
+                mirror.active -= 1
+
+                if success:
+                    mirror.succeed(chunk.size - resumed, time.time() - started)
+                    chunk.state = 'done'
+                    self.save_map()
+                else:
+                    # The written bytes are kept, streaming readers may have
+                    # consumed them already, the retry fetches the rest
+                    mirror.fail()
+                    chunk.tried.add(mirror.base_url)
+                    chunk.state = 'pending'
+
+    def fetch(self, chunk, mirror):
+        """Fetches the rest of a chunk from a mirror.
+
+        @param chunk: chunk to fetch
+        @param mirror: mirror to fetch from
+
+        @return: True on success
+        """
+
+        start = chunk.offset + chunk.written
+        end = chunk.offset + chunk.size - 1
+        request = urllib2.Request(mirror.url, headers={
+            'Range': 'bytes={0}-{1}'.format(start, end),
+        })
+
+        try:
+            response = urllib2.urlopen(request, timeout=TIMEOUT)
+
+            if response.getcode() != 206:
+                raise IOError("Byte range ignored")
+
+            with open(self.path, 'r+b') as output:
+                output.seek(start)
+
+                while chunk.written < chunk.size:
+                    data = response.read(min(BLOCK_SIZE,
+                                             chunk.size - chunk.written))
+
+                    if not data:
+                        raise IOError("Connection closed")
+
+                    output.write(data)
+                    # Streaming readers mustn't see the bytes before they're
+                    # in the file
+                    output.flush()
+                    chunk.written += len(data)
+
+            response.close()
+        except (urllib2.URLError, IOError, socket.error,
+                httplib.HTTPException) as e:
+            self.logger.warning("Failed to fetch bytes {0}-{1} from {2}: {3}"
+                                .format(start, end, mirror.base_url, e))
+            return False
+
+        return True
+
+    def get_available(self):
+        """Returns the size of the contiguous downloaded prefix of the file.
+        """
+
+        available = 0
+
+        with self.lock:
+            for chunk in self.chunks:
+                if chunk.state != 'done':
+                    return available + chunk.written
+
+                available += chunk.size
+
+        return available
+
+    def poll(self):
+        """Returns the exit status or None if the download is running.
+        """
+
+        return self.returncode
+
+    def report(self):
+        """Logs and saves the mirrors statistics.
+        """
+
+        for mirror in self.mirrors:
+            if mirror.seconds:
+                self.logger.info("Mirror {0}: {1} bytes at {2:.0f} KB/s per "
+                                 "connection, {3} failure(s)"
+                                 .format(mirror.base_url, mirror.bytes,
+                                         mirror.bytes / mirror.seconds / 1024,
+                                         mirror.total_failures))
+
+            mirror.record()
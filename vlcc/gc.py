@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+
+import os
+import stat
+import time
+import shutil
+
+from .core import logger, options
+from .conf import config, split_build, get_build_names
+from .db import db
+from .jail import Jail
+from .store import Store
+from .pool import WarmPool
+from .build import Builder, get_build_dir, get_state
+
+
+__all__ = ['DiskUsage', 'collect_garbage', 'format_size']
+
+
+# Cached directory figures older than this are measured again anyway, files
+# growing in place don't change their directory mtime
+RESCAN_AGE = 7 * 24 * 3600.
+
+# Default retention policies, see `gc` config option
+DEFAULT_POLICIES = {
+    'jail_days': 30,
+    'objects': True,
+}
+
+# Stores in the cache directory accounted as shared trees
+STORES = ['sources', 'rootfs', 'apt', 'ccache', 'artifacts']
+
+
+def format_size(size):
+    """Formats bytes number like `1.5G`.
+
+    @param size: bytes number
+    """
+
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            return "{0:.1f}{1}".format(size, unit).replace('.0', '')
+
+        size /= 1024.
+
+    return "{0:.1f}T".format(size)
+
+
+class DiskUsage(object):
+    """Incremental tree size accounting.
+
+    Every directory's own files figures and subdirectory names are cached
+    with its mtime in `du-cache.json` of the build directory, so only the
+    directories which entries have changed since the last run are listed
+    again, the others cost a single lstat(). File sizes are the allocated
+    blocks, the hardlinked files are counted in every tree.
+    """
+
+    def __init__(self):
+        self.path = os.path.join(options.build_dir, 'du-cache.json')
+        self.seen = {}
+
+        try:
+            with open(self.path) as cache_file:
+                self.cache = json.load(cache_file)
+        except (IOError, ValueError):
+            self.cache = {}
+
+    def save(self):
+        """Saves the figures of the directories measured during this run,
+        the removed ones are dropped.
+        """
+
+        with open(self.path + '.tmp', 'w') as cache_file:
+            json.dump(self.seen, cache_file)
+
+        os.rename(self.path + '.tmp', self.path)
+
+    def scan(self, path, info):
+        """Lists a directory and sums up its own files.
+
+        @param path: directory path
+        @param info: directory os.lstat() result
+        """
+
+        entry = dict(mtime=info.st_mtime, scanned=time.time(),
+                     bytes=info.st_blocks * 512, files=0, dirs=[])
+
+        for name in os.listdir(path):
+            try:
+                child = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+
+            if stat.S_ISDIR(child.st_mode):
+                entry['dirs'].append(name)
+            else:
+                entry['bytes'] += child.st_blocks * 512
+                entry['files'] += 1
+
+        return entry
+
+    def measure(self, root, exclude=()):
+        """Returns the tree size staying on its file system.
+
+        @param root: tree path
+        @param exclude: subtree paths to skip
+
+        @return: tuple of (bytes, files), zeros if there's no tree
+        """
+
+        total_bytes = total_files = 0
+
+        try:
+            device = os.lstat(root).st_dev
+        except OSError:
+            return total_bytes, total_files
+
+        stack = [root]
+
+        while stack:
+            path = stack.pop()
+
+            try:
+                info = os.lstat(path)
+            except OSError:
+                continue
+
+            # Never descending into the mounts, i. e. proc or tmpfs
+            if info.st_dev != device or not stat.S_ISDIR(info.st_mode):
+                continue
+
+            entry = self.cache.get(path)
+
+            if (entry is None or entry['mtime'] != info.st_mtime or
+                    time.time() - entry['scanned'] > RESCAN_AGE):
+                try:
+                    entry = self.scan(path, info)
+                except OSError:
+                    continue
+
+            self.seen[path] = entry
+            total_bytes += entry['bytes']
+            total_files += entry['files']
+
+            stack.extend(child for child in (os.path.join(path, name)
+                                             for name in entry['dirs'])
+                         if child not in exclude)
+
+        return total_bytes, total_files
+
+
+def get_jail_versions():
+    """Returns the VLC versions having jails in the build directory.
+    """
+
+    versions = []
+
+    for path in glob.glob(os.path.join(options.build_dir, 'jail-*')):
+        name = os.path.basename(path)[len('jail-'):]
+
+        if os.path.isdir(path) and not name.endswith(('.upper', '.work',
+                                                      '.tmp', '.tmpfs')):
+            versions.append(name)
+
+    return sorted(versions)
+
+
+def get_builds(version):
+    """Returns the names of the builds in the DB done in a version's jail.
+
+    @param version: VLC version string
+    """
+
+    cursor = db.query("SELECT version FROM build", [])
+
+    return [name for name, in cursor.fetchall()
+            if split_build(name)[0] == version]
+
+
+def get_idle_days(version, names):
+    """Returns the days since a jail has been used for a build or
+    a comparison last time.
+
+    @param version: VLC version string
+    @param names: names of the builds done in the jail
+    """
+
+    params = ", ".join("?" * len(names))
+    cursor = db.query("SELECT julianday('now') - julianday(MAX(performed)) "
+                      "FROM ("
+                      "    SELECT performed FROM build_stage "
+                      "    WHERE build_version IN ({0}) "
+                      "    UNION ALL "
+                      "    SELECT c.performed FROM comparison c "
+                      "    JOIN comparison_build cb "
+                      "        ON cb.comparison_id=c.id "
+                      "    WHERE cb.build_version IN ({0})"
+                      ")".format(params), names + names)
+    days = cursor.fetchone()[0]
+
+    if days is None:
+        # Nothing recorded, the jail creation time will do
+        chroot_dir = os.path.join(options.build_dir, 'jail-' + version)
+        days = (time.time() - os.stat(chroot_dir).st_mtime) / 86400.
+
+    return days
+
+
+def apply_policies(dry_run=False):
+    """Removes the jails and the trees the retention policies drop.
+
+    @param dry_run: only log what would be removed
+    """
+
+    policies = dict(DEFAULT_POLICIES)
+    policies.update(config.get('gc') or {})
+
+    action = "Would remove" if dry_run else "Removing"
+
+    for version in get_jail_versions():
+        if version not in config.get('versions', {}):
+            continue
+
+        names = get_builds(version) or [version]
+        jail_days = policies.get('jail_days')
+
+        if jail_days is not None:
+            idle_days = get_idle_days(version, names)
+
+            if idle_days > jail_days:
+                logger.info("{0} VLC {1} jail unused for {2:.0f} days"
+                            .format(action, version, idle_days))
+
+                if not dry_run:
+                    Jail(version).destroy()
+
+                    for name in names:
+                        # The installed artifacts restore them
+                        Builder(name).reset(None)
+
+                continue
+
+        if not policies.get('objects'):
+            continue
+
+        jail = Jail(version)
+
+        for name in names:
+            if get_state(name) != 'installed':
+                continue
+
+            if dry_run:
+                build_dir = jail.get_stored_path(get_build_dir(name))
+            else:
+                jail.prepare()
+                build_dir = jail.get_path(get_build_dir(name))
+
+            if os.path.isdir(build_dir):
+                logger.info("{0} VLC {1} object files".format(action, name))
+
+                if not dry_run:
+                    shutil.rmtree(build_dir)
+
+
+def get_trees():
+    """Returns the accounted trees.
+
+    @return: list of (build name or None for shared trees, category, path,
+        excluded subtree paths) tuples
+    """
+
+    trees = []
+    builds = dict((name.replace(':', '-'), name)
+                  for name in get_build_names())
+
+    for version in get_jail_versions():
+        jail = Jail(version)
+        # Overlay jails own only their upper directories
+        root = jail.upper_dir if jail.is_overlay() else jail.chroot_dir
+
+        src_dir = os.path.join(root, 'usr/local/src/vlc-' + version)
+        build_dirs = glob.glob(os.path.join(root, 'usr/local/build/vlc-*'))
+
+        trees.append((version, 'jail', root, set([src_dir] + build_dirs)))
+        trees.append((version, 'sources', src_dir, ()))
+
+        for path in build_dirs:
+            slug = os.path.basename(path)[len('vlc-'):]
+            trees.append((builds.get(slug, slug), 'objects', path, ()))
+
+    for path in glob.glob(os.path.join(options.build_dir, 'log-*')):
+        trees.append((os.path.basename(path)[len('log-'):], 'logs', path, ()))
+
+    for path in glob.glob(os.path.join(options.build_dir, 'snap-*')):
+        trees.append((os.path.basename(path)[len('snap-'):], 'snapshots',
+                      path, ()))
+
+    for path in glob.glob(os.path.join(options.build_dir, 'base-*')):
+        if os.path.isdir(path):
+            trees.append((None, 'bases', path, ()))
+
+    trees.append((None, 'pool', WarmPool().root, ()))
+
+    for name in STORES:
+        trees.append((None, name, Store(name).root, ()))
+
+    return trees
+
+
+def account():
+    """Measures the trees and replaces the disk usage figures in the DB.
+
+    @return: list of (build name, category, bytes, files) tuples
+    """
+
+    usage = DiskUsage()
+    figures = []
+
+    for name, category, path, exclude in get_trees():
+        size, files = usage.measure(path, exclude)
+
+        if files:
+            figures.append((name, category, size, files))
+
+    usage.save()
+
+    db.execute("DELETE FROM disk_usage", [])
+
+    for figure in figures:
+        db.execute("INSERT INTO disk_usage "
+                   "(build_version, category, bytes, files) "
+                   "VALUES (?, ?, ?, ?)", list(figure))
+
+    return figures
+
+
+def collect_garbage(dry_run=False):
+    """Applies the retention policies to the build directory and logs the
+    disk usage of what's left.
+
+    @param dry_run: only log what would be removed
+    """
+
+    apply_policies(dry_run)
+
+    started = time.time()
+    figures = account()
+
+    for name, category, size, files in figures:
+        logger.info("{0:<16} {1:<10} {2:>8} in {3} file(s)"
+                    .format(name or "(shared)", category, format_size(size),
+                            files))
+
+    logger.info("Total {0}, accounted in {1:.2f}s"
+                .format(format_size(sum(figure[2] for figure in figures)),
+                        time.time() - started))
@@ -1,20 +1,40 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import collections
 
 from datetime import datetime
 
-from flask import Flask, render_template, send_from_directory, abort
+from flask import Flask, Response, render_template, send_from_directory
+from flask import abort, request
 
 from ..core import __version__
-from ..core import initialize
+from ..core import options, argparser, initialize
 from ..conf import config
 from ..db import db, dict_factory
+from ..log import read_tail
+from ..units import get_slowest_units, get_directory_totals
 
 
 __all__ = ['main']
 
 
+# Build state to log file name mapping
+STAGE_LOGS = {
+    'jail_created': 'debootstrap',
+    'configured': 'configure',
+    'compiled': 'make',
+    'installed': 'install',
+}
+
+# Safe version and log names, variants are named like `2.0.5:debug`
+NAME_RE = re.compile(r'^[\w-][\w.:-]*$')
+
+# Directories shown on the compile units page
+UNIT_DIRS = 20
+
+
 app = Flask(__name__)
 
 
@@ -30,13 +50,9 @@ def index():
     return comparison()
 
 
-@app.route('/comparison/<comparison_id>')
-def comparison(comparison_id=None):
-    context = {}
-
-    comparison = None
-
-    # Fetching main menu
+def get_menu():
+    """Fetches the main menu entries, i. e. the ready comparisons.
+    """
 
     db.row_factory()
     cursor = db.query(("SELECT c.id, c.movie, c.performed, "
@@ -51,26 +67,31 @@ def comparison(comparison_id=None):
     dt_format_from, dt_format_to = ('%Y-%m-%d %H:%M:%S',
                                     '%b %d %Y, %H:%M')
 
-    menu = []
-    for index, (comp_id, movie, performed, versions) in enumerate(cursor):
-        menu_entry = {
-            'id': comp_id,
-            'versions': versions,
-            'performed': (datetime
-                          .strptime(performed, dt_format_from)
-                          .strftime(dt_format_to)),
-        }
+    return [{
+        'id': comp_id,
+        'movie': movie,
+        'versions': versions,
+        'performed': (datetime
+                      .strptime(performed, dt_format_from)
+                      .strftime(dt_format_to)),
+    } for comp_id, movie, performed, versions in cursor]
 
+
+@app.route('/comparison/<comparison_id>')
+def comparison(comparison_id=None):
+    context = {}
+
+    comparison = None
+
+    # Fetching main menu
+    menu = get_menu()
+
+    for index, menu_entry in enumerate(menu):
         if (comparison_id is None and index == 0
-                or unicode(comp_id) == comparison_id):
-            menu_entry.update({
-                'movie': movie,
-                'is_active': True,
-            })
+                or unicode(menu_entry['id']) == comparison_id):
+            menu_entry['is_active'] = True
             comparison = menu_entry
 
-        menu.append(menu_entry)
-
     if menu:
         if comparison is None:
             abort(404)
@@ -94,10 +115,161 @@ def comparison(comparison_id=None):
     return render_template('comparison.html', **context)
 
 
+@app.route('/builds')
+def builds():
+    """Per-version build stages timing breakdown.
+    """
+
+    db.row_factory(dict_factory)
+
+    # The last record of each stage
+    cursor = db.query("SELECT * FROM build_stage "
+                      "WHERE id IN (SELECT MAX(id) FROM build_stage "
+                      "             GROUP BY build_version, stage) "
+                      "ORDER BY build_version, id", [])
+
+    versions = collections.OrderedDict()
+
+    for stage in cursor:
+        entry = versions.setdefault(stage['build_version'], {
+            'version': stage['build_version'],
+            'stages': [],
+            'total': 0.,
+        })
+        stage['log'] = STAGE_LOGS.get(stage['stage'])
+        entry['stages'].append(stage)
+        entry['total'] += stage['wall_time']
+
+    cursor = db.query("SELECT DISTINCT build_version FROM compile_unit", [])
+    profiled = set(row['build_version'] for row in cursor)
+
+    for entry in versions.itervalues():
+        entry['profiled'] = entry['version'] in profiled
+
+        for stage in entry['stages']:
+            stage['share'] = (100. * stage['wall_time'] / entry['total']
+                              if entry['total'] else 0.)
+
+    context = {
+        'version': __version__,
+        'menu': get_menu(),
+        'builds': versions.values(),
+    }
+
+    return render_template('builds.html', **context)
+
+
+def get_change(value, base):
+    """Returns the relative change in percents or None.
+
+    @param value: measured value
+    @param base: value to compare with
+    """
+
+    if not base:
+        return None
+
+    return 100. * (value - base) / base
+
+
+@app.route('/units/<version>')
+def units(version):
+    """The slowest compile units of a build and their changes against
+    another build's ones.
+    """
+
+    base = request.args.get('base')
+
+    db.row_factory(dict_factory)
+
+    units = get_slowest_units(version, request.args.get('limit', 50,
+                                                        type=int))
+
+    if not units:
+        abort(404)
+
+    base_units = {}
+
+    if base:
+        cursor = db.query("SELECT unit, wall_time FROM compile_unit "
+                          "WHERE build_version=?", [base])
+        base_units = dict((row['unit'], row['wall_time']) for row in cursor)
+
+    for unit in units:
+        unit['base_wall_time'] = base_units.get(unit['unit'])
+        unit['change'] = get_change(unit['wall_time'],
+                                    unit['base_wall_time'])
+
+    totals = get_directory_totals(version)
+    base_totals = get_directory_totals(base) if base else {}
+
+    directories = []
+
+    for name, entry in sorted(totals.items(),
+                              key=lambda item: item[1]['wall_time'],
+                              reverse=True)[:UNIT_DIRS]:
+        base_entry = base_totals.get(name)
+        base_wall_time = base_entry['wall_time'] if base_entry else None
+        directories.append(dict(entry, name=name,
+                                base_wall_time=base_wall_time,
+                                change=get_change(entry['wall_time'],
+                                                  base_wall_time)))
+
+    cursor = db.query("SELECT DISTINCT build_version FROM compile_unit "
+                      "WHERE build_version!=? ORDER BY build_version",
+                      [version])
+
+    context = {
+        'version': __version__,
+        'menu': get_menu(),
+        'build': version,
+        'base': base,
+        'others': [row['build_version'] for row in cursor],
+        'units': units,
+        'directories': directories,
+        'total': sum(entry['wall_time'] for entry in totals.itervalues()),
+        'base_total': (sum(entry['wall_time']
+                           for entry in base_totals.itervalues())
+                       if base else None),
+    }
+
+    return render_template('units.html', **context)
+
+
+@app.route('/log/<version>/<name>')
+def log(version, name):
+    """Live build log tail, refreshed while the log is being written.
+    """
+
+    if not NAME_RE.match(version) or not NAME_RE.match(name):
+        abort(404)
+
+    log_path = os.path.join(options.build_dir, 'log-' + version,
+                            name + '.log')
+
+    tail = read_tail(log_path, request.args.get('lines', 100, type=int))
+
+    if tail is None:
+        abort(404)
+
+    lines, running = tail
+
+    response = Response("".join(lines), mimetype='text/plain')
+
+    if running:
+        response.headers['Refresh'] = '2'
+
+    return response
+
+
 def main():
     """VLCC HTTP server entry point.
     """
 
+    argparser.add_argument('-b', '--build-dir', dest='build_dir',
+                           default="./build/",
+                           help="build directory path, `./build/` by default")
+
     # Initializing the core
     initialize(exit_func=lambda: abort(500))
 
@@ -1,27 +1,179 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import errno
+import fcntl
+
 import os
+import sys
+import pipes
 import shutil
+import commands
 
 import subprocess
 
 from .core import logger as core_logger, options, fail_with_error
 from .conf import config
+from .store import Store, fingerprint
+from .repo import get_archives_dir, get_repo_url, link_or_copy
+from .log import LogStream
+from .dedupe import dedupe_jail
+from .pool import WarmPool
+from .cgroup import CGroup
+from .agent import Agent
+
+
+__all__ = ['Jail', 'is_mounted', 'get_available_memory']
+
+
+# Popen kwargs the in-jail agent supports
+AGENT_KWARGS = set(['stdout', 'stderr', 'env'])
+
+# tmpfs free space to consider it full when a command fails
+TMPFS_RESERVE = 16 << 20
+
+# debootstrap option support cache
+_debootstrap_options = {}
+
+
+def prune_tree(src, dest):
+    """Removes the entries of a tree copy that are gone from the tree or
+    have changed their type, so copying the tree over makes them identical.
+
+    @param src: tree path
+    @param dest: tree copy path
+    """
+
+    def is_dir(path):
+        return os.path.isdir(path) and not os.path.islink(path)
+
+    for dirpath, dirnames, filenames in os.walk(dest):
+        src_dir = os.path.join(src, os.path.relpath(dirpath, dest))
+
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            src_path = os.path.join(src_dir, name)
+
+            if (os.path.lexists(src_path) and
+                    is_dir(src_path) == is_dir(path)):
+                continue
+
+            if is_dir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+
+        dirnames[:] = [name for name in dirnames
+                       if is_dir(os.path.join(dirpath, name))]
+
+
+def get_mount_points(path):
+    """Returns the mount points at or under the path, the deepest last.
+
+    @param path: directory path
+    """
+
+    path = os.path.realpath(path)
+    mount_points = []
+
+    with open('/proc/mounts') as mounts:
+        for line in mounts:
+            # Spaces in mount points are octal-escaped
+            mount_point = line.split()[1].decode('string_escape')
+
+            if mount_point == path or mount_point.startswith(path + '/'):
+                mount_points.append(mount_point)
+
+    return mount_points
+
+
+def is_mounted(path):
+    """Checks whether the path is a mount point.
+
+    @param path: directory path
+    """
+
+    return os.path.realpath(path) in get_mount_points(path)
+
+
+def get_available_memory():
+    """Returns the memory available for new allocations in bytes.
+    """
+
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            key, value = line.split(':', 1)
+
+            if key == 'MemAvailable':
+                # Kilobytes
+                return int(value.split()[0]) * 1024
+
+    return 0
+
+
+def debootstrap_supports(option):
+    """Checks whether the installed debootstrap supports an option.
+
+    @param option: long option string, i. e. `--cache-dir`
+    """
+
+    if option not in _debootstrap_options:
+        status, output = commands.getstatusoutput('debootstrap --help')
+        _debootstrap_options[option] = status == 0 and option in output
+
+    return _debootstrap_options[option]
 
 
-__all__ = ['Jail']
+def overlay_supported():
+    """Checks whether the kernel is able to mount overlayfs.
+    """
+
+    try:
+        with open('/proc/filesystems') as filesystems:
+            return any(line.split()[-1] == 'overlay'
+                       for line in filesystems if line.strip())
+    except IOError:
+        return False
 
 
 class Jail(object):
     """Chroot jail managing class.
     """
 
-    def __init__(self, version, logger=core_logger):
+    def __init__(self, version, logger=core_logger, name=None):
+        """Initializes the jail.
+
+        @param version: VLC version string
+        @param logger: logger to report to
+        @param name: build name if the jail is shared by version variants,
+            used for the build logs and the resource limits
+        """
+
+        name = name or version
+
         self.logger = logger
         self.version_config = config['versions'][version]
-        self.log_dir = os.path.join(options.build_dir, 'log-' + version)
+        self.log_dir = os.path.join(options.build_dir, 'log-' + name)
         self.chroot_dir = os.path.join(options.build_dir, 'jail-' + version)
 
+        # Overlay mode directories, the lower one is shared by all the jails
+        # with the same root FS fingerprint
+        self.upper_dir = self.chroot_dir + '.upper'
+        self.work_dir = self.chroot_dir + '.work'
+        self.base_dir = os.path.join(options.build_dir,
+                                     'base-' + self.get_fingerprint())
+
+        # tmpfs a build tree is moved to for the time being
+        self.tmpfs_dir = os.path.join(options.build_dir,
+                                      'jail-' + name + '.tmpfs')
+        self.tmpfs_full = False
+
+        # Resource limits of all the jail commands
+        self.cgroup = CGroup(name, logger)
+
+        # In-jail command execution agent, started on demand
+        self.agent = Agent(self) if config.get('exec_agent', False) else None
+
         try:
             os.makedirs(self.log_dir)
         except OSError:
@@ -63,15 +215,21 @@ class Jail(object):
         @param dest: destination path inside the jail
         """
 
-        dest = self.get_path(dest)
+        path = self.get_path(dest)
 
-        if not os.path.exists(dest):
+        if not os.path.exists(path):
             try:
-                os.link(src, dest)
+                os.link(src, path)
             except OSError as e:
+                if e.errno == errno.EXDEV:
+                    # Overlay jails live on their own file system
+                    self.logger.debug("Unable to hardlink {0} across file "
+                                      "systems, copying".format(src))
+                    return self.copy(src, dest)
+
                 fail_with_error("Unable to create hard link from {0} to "
                                 "{1}, the message was: `{2}`"
-                                .format(src, dest, e.message))
+                                .format(src, path, e.message))
 
     def exec_command(self, command, async=False, **popen_kwargs):
         """Executes a command.
@@ -91,6 +249,9 @@ class Jail(object):
         if not options.verbose and not output_specified:
             popen_kwargs['stdout'] = popen_kwargs['stderr'] = subprocess.PIPE
 
+        self.cgroup.create()
+        popen_kwargs.setdefault('preexec_fn', self.cgroup.attach)
+
         process = subprocess.Popen(command, **popen_kwargs)
 
         if not async:
@@ -108,10 +269,16 @@ class Jail(object):
         @param userspec: `USER[:GROUP]` string to use
         @param async: returns immediately if True
         @popen_kwargs: subprocess.Popen kwargs
+
+        Strings are run as shell command lines, sequences as they are.
         """
 
-        if isinstance(command, basestring):
-            command = [command]
+        if self.agent is not None and set(popen_kwargs) <= AGENT_KWARGS:
+            process = self.exec_agent(command, cwd, userspec, async,
+                                      **popen_kwargs)
+
+            if process is not None:
+                return process
 
         cmd = ['chroot']
 
@@ -120,17 +287,66 @@ class Jail(object):
 
         cmd += [self.chroot_dir]
 
+        if isinstance(command, basestring):
+            script = command
+        else:
+            script = " ".join(pipes.quote(arg) for arg in command)
+
         if cwd is not None:
-            cmd += ['bash', '-c', 'cd {0}; {1}'
-                    .format(cwd, " ".join(command))]
+            cmd += ['bash', '-c', 'cd {0} && {1}'
+                    .format(pipes.quote(cwd), script)]
+        elif isinstance(command, basestring):
+            cmd += ['bash', '-c', command]
         else:
             cmd += command
 
         return self.exec_command(cmd, async, **popen_kwargs)
 
+    def exec_agent(self, command, cwd=None, userspec=None,
+                   async=False, **popen_kwargs):
+        """Executes a command with the in-jail agent.
+
+        @param command: command string or sequence
+        @param cwd: chroot working directory string
+        @param userspec: `USER[:GROUP]` string to use
+        @param async: returns immediately if True
+        @popen_kwargs: stdout, stderr and env subprocess.Popen kwargs,
+            stderr is always merged into stdout
+
+        @return: process-like object or None if the agent is unavailable
+        """
+
+        if isinstance(command, basestring):
+            argv = ['bash', '-c', command]
+        else:
+            argv = list(command)
+
+        if 'stdout' in popen_kwargs:
+            stdout = popen_kwargs['stdout'] or sys.stdout
+        else:
+            # Suppressing the output in non-verbose mode
+            stdout = sys.stdout if options.verbose else None
+
+        process = self.agent.execute(argv, cwd=cwd,
+                                     env=popen_kwargs.get('env'),
+                                     userspec=userspec, stdout=stdout,
+                                     async=async)
+
+        if process is None:
+            return None
+
+        self.logger.debug("Executed `{0}` with the agent"
+                          .format(" ".join(argv)))
+
+        if not async:
+            if 0 != process.wait():
+                fail_with_error("Execution of {0} failed".format(argv[0]))
+
+        return process
+
     def _log_exec(self, method, log_to, log_message, **kwargs):
-        """Calls the method with kwargs passed and logs the results
-        into a file.
+        """Calls the method with kwargs passed and streams the results
+        into a compressed log file.
 
         @param method: either self.exec_chroot or self.exec_command
         @param log_to: log file name
@@ -139,11 +355,18 @@ class Jail(object):
 
         log_path = os.path.join(self.log_dir, log_to)
 
-        self.logger.info("{0}, see {1} for details"
+        self.logger.info("{0}, see {1}.gz for details"
                          .format(log_message.capitalize(), log_path))
 
-        with open(log_path, 'wt') as log_file:
-            return method(stdout=log_file, stderr=log_file, **kwargs)
+        process = method(stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         async=True, **kwargs)
+        LogStream(log_path).pump(process.stdout)
+
+        if 0 != process.wait():
+            fail_with_error("Execution failed, see {0}.gz for details"
+                            .format(log_path))
+
+        return process
 
     def log_command(self, command, log_to, log_message):
         """Executes a command and logs the results into a file.
@@ -157,39 +380,435 @@ class Jail(object):
         return self._log_exec(self.exec_command, log_to, log_message, **kwargs)
 
     def log_chroot(self, command, log_to, log_message,
-                   cwd=None, userspec=None):
+                   cwd=None, userspec=None, env=None):
         """Executes a chroot command and logs the results into a file.
 
         @param command: command string or sequence
         @param log_to: log file name
         @param log_message: message string to log
         @param cwd: chroot working directory string
+        @param userspec: `USER[:GROUP]` string to use
+        @param env: environment dict, the current one by default
         """
 
-        kwargs = dict(command=command, cwd=cwd, userspec=userspec)
+        kwargs = dict(command=command, cwd=cwd, userspec=userspec, env=env)
         return self._log_exec(self.exec_chroot, log_to, log_message, **kwargs)
 
-    def create(self):
-        """Creates a chroot jail with debootstrap.
+    def get_packages(self):
+        """Returns the sorted list of packages to include into the jail, or
+        None if debootstrap defaults should be used.
         """
 
-        command = ['debootstrap']
+        packages = []
 
         if 'dependencies' in self.version_config:
-            deps = (['build-essential', 'python'] +
-                    self.version_config['dependencies'])
-            command.append('--include=' + ",".join(set(deps)))
+            packages += (['build-essential', 'python'] +
+                         self.version_config['dependencies'])
+
+        if config.get('ccache', False):
+            packages.append('ccache')
+
+        return sorted(set(packages)) or None
+
+    def get_fingerprint(self):
+        """Returns the root FS fingerprint, i. e. a hash of everything
+        debootstrap gets as its input.
+        """
+
+        return fingerprint(self.version_config['distr'],
+                           self.version_config.get('arch'),
+                           self.get_packages(),
+                           config.get('mirror'))
+
+    def seed_archives(self, target_dir):
+        """Hardlinks the shared .deb archives into the target, so debootstrap
+        doesn't download them again.
+
+        @param target_dir: root FS directory path
+        """
+
+        archives = os.path.join(target_dir, 'var/cache/apt/archives')
+
+        try:
+            os.makedirs(archives)
+        except OSError:
+            pass
+
+        shared = get_archives_dir()
+
+        for filename in os.listdir(shared):
+            if filename.endswith('.deb'):
+                link_or_copy(os.path.join(shared, filename),
+                             os.path.join(archives, filename))
+
+    def harvest_archives(self, target_dir, clean=True):
+        """Moves .deb archives downloaded by debootstrap to the shared
+        archives directory.
+
+        @param target_dir: root FS directory path
+        @param clean: remove the archives from the target if True
+        """
+
+        archives = os.path.join(target_dir, 'var/cache/apt/archives')
+        shared = get_archives_dir()
+
+        if not os.path.isdir(archives):
+            return
+
+        for filename in os.listdir(archives):
+            if filename.endswith('.deb'):
+                path = os.path.join(archives, filename)
+                link_or_copy(path, os.path.join(shared, filename))
+
+                if clean:
+                    os.unlink(path)
+
+    def debootstrap(self, target_dir, download_only=False):
+        """Runs debootstrap into the target directory.
+
+        Packages are taken from the local repository if it has been
+        populated, and downloaded .deb files are shared by all the jails.
+
+        @param target_dir: root FS directory path
+        @param download_only: only download packages if True
+        """
+
+        command = ['debootstrap']
+
+        if download_only:
+            command.append('--download-only')
+
+        packages = self.get_packages()
+
+        if packages is not None:
+            command.append('--include=' + ",".join(packages))
 
         if 'arch' in self.version_config:
             command.append('--arch=' + self.version_config['arch'])
 
-        command += [self.version_config['distr'], self.chroot_dir]
+        mirror = config.get('mirror')
+
+        # The local repository is pointless when populating it
+        repo_url = (None if download_only
+                    else get_repo_url(self.version_config['distr']))
+
+        if repo_url is None and getattr(options, 'offline', False):
+            fail_with_error("The local repository is not populated for {0}, "
+                            "unable to create the jail in offline mode"
+                            .format(self.version_config['distr']))
+
+        if repo_url is not None:
+            self.logger.info("Using the local repository " + repo_url)
+            command.append('--no-check-gpg')
+            mirror = repo_url
+
+        use_cache_dir = (config.get('apt_cache', True) and not download_only
+                         and debootstrap_supports('--cache-dir'))
 
-        if 'mirror' in config:
-            command.append(config['mirror'])
+        if use_cache_dir:
+            command.append('--cache-dir=' +
+                           os.path.abspath(get_archives_dir()))
+        elif config.get('apt_cache', True):
+            self.seed_archives(target_dir)
+
+        command += [self.version_config['distr'], target_dir]
+
+        if mirror:
+            command.append(mirror)
 
         self.log_command(command, log_to='debootstrap.log',
                          log_message="Creating chroot jail for VLC")
 
+        if config.get('apt_cache', True) and not use_cache_dir:
+            self.harvest_archives(target_dir, clean=not download_only)
+
+    def bootstrap(self, target_dir):
+        """Fills the target directory with a fresh root FS, unpacking it from
+        the root FS cache if possible.
+
+        @param target_dir: root FS directory path
+        """
+
+        if not config.get('rootfs_cache', True):
+            return self.debootstrap(target_dir)
+
+        key = self.get_fingerprint()
+        store = Store('rootfs')
+
+        if store.has(key, '.tar.gz'):
+            self.logger.info("Root FS cache hit ({0}), unpacking the jail"
+                             .format(key))
+            try:
+                os.makedirs(target_dir)
+            except OSError:
+                pass
+
+            self.exec_command(['tar', '-C', target_dir, '--numeric-owner',
+                               '-xpzf', store.get_path(key, '.tar.gz')])
+        else:
+            self.logger.info("Root FS cache miss ({0})".format(key))
+            self.debootstrap(target_dir)
+
+            temp_path = store.get_temp_path(key, '.tar.gz')
+            self.log_command(['tar', '-C', target_dir, '--numeric-owner',
+                              '-czpf', temp_path, '.'],
+                             log_to='rootfs-cache.log',
+                             log_message="Storing the root FS in cache")
+            store.commit(temp_path, key, '.tar.gz')
+
+    def get_stored_path(self, inner_path, *rest):
+        """Converts a path inside the jail into the path it's stored at
+        without mounting anything, the files created in an overlay jail are
+        in its upper directory.
+
+        @param inner_path: path inside the jail
+        @param rest: additional path components to join
+        """
+
+        if not self.is_overlay():
+            return self.get_path(inner_path, *rest)
+
+        return os.path.join(self.upper_dir, inner_path.lstrip('/'), *rest)
+
+    def is_overlay(self):
+        """Checks whether the jail is an overlay one.
+        """
+
+        return os.path.isdir(self.upper_dir)
+
+    def create_base(self):
+        """Creates the shared read-only lower directory unless another build
+        has already done it.
+        """
+
+        with open(self.base_dir + '.lock', 'w') as lock_file:
+            # Serializing concurrent builds with the same fingerprint
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if os.path.isdir(self.base_dir):
+                self.logger.info("Reusing the jail base " + self.base_dir)
+                return
+
+            temp_dir = self.base_dir + '.tmp'
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+            self.bootstrap(temp_dir)
+            os.rename(temp_dir, self.base_dir)
+
+    def mount(self):
+        """Mounts the overlay jail root FS unless it's already mounted.
+
+        @return: False if the overlay can't be mounted
+        """
+
+        if not self.is_overlay() or is_mounted(self.chroot_dir):
+            return True
+
+        mount_options = ('lowerdir={0},upperdir={1},workdir={2}'
+                         .format(os.path.abspath(self.base_dir),
+                                 os.path.abspath(self.upper_dir),
+                                 os.path.abspath(self.work_dir)))
+
+        command = ['mount', '-t', 'overlay', 'overlay',
+                   '-o', mount_options, self.chroot_dir]
+
+        process = self.exec_command(command, async=True)
+        process.communicate()
+
+        return 0 == process.returncode
+
+    def prepare(self):
+        """Makes the jail ready to use, i. e. mounts the overlay root FS.
+        """
+
+        if not self.mount():
+            fail_with_error("Unable to mount the overlay jail {0}"
+                            .format(self.chroot_dir))
+
+    @contextlib.contextmanager
+    def bind(self, src, inner_path):
+        """Context manager bind-mounting a host directory into the jail.
+
+        @param src: host directory path
+        @param inner_path: mount point path inside the jail
+        """
+
+        path = self.get_path(inner_path)
+
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+
+        if is_mounted(path):
+            yield
+            return
+
+        self.exec_command(['mount', '--bind', src, path])
+
+        try:
+            yield
+        finally:
+            self.exec_command(['umount', path])
+
+    def get_tree_size(self, inner_path):
+        """Returns the disk usage of a jail tree in bytes.
+
+        @param inner_path: tree path inside the jail
+        """
+
+        process = self.exec_command(['du', '-sk', self.get_path(inner_path)],
+                                    async=True, stdout=subprocess.PIPE,
+                                    stderr=open(os.devnull, 'w'))
+        output, _ = process.communicate()
+
+        return int(output.split()[0]) * 1024 if output else 0
+
+    @contextlib.contextmanager
+    def tmpfs(self, inner_path, size):
+        """Context manager moving a jail tree onto tmpfs for the time being.
+
+        The tree is copied onto a new tmpfs, which is bind-mounted over it,
+        so the paths inside the jail stay the same. The changes are synced
+        back to disk on exit whatever happens, self.tmpfs_full tells if the
+        tmpfs has run out of space.
+
+        @param inner_path: tree path inside the jail
+        @param size: tmpfs size in bytes
+        """
+
+        path = self.get_path(inner_path)
+
+        try:
+            os.makedirs(self.tmpfs_dir)
+        except OSError:
+            pass
+
+        self.exec_command(['mount', '-t', 'tmpfs',
+                           '-o', 'size={0}'.format(size),
+                           'tmpfs', self.tmpfs_dir])
+        self.tmpfs_full = False
+
+        try:
+            self.exec_command(['cp', '-a', path + '/.', self.tmpfs_dir])
+
+            with self.bind(self.tmpfs_dir, inner_path):
+                yield
+        except BaseException:
+            error = sys.exc_info()
+
+            # The original error matters more than the cleanup one
+            if not self.release_tmpfs(path):
+                self.logger.error("Unable to sync {0} back from tmpfs, it's "
+                                  "left in {1}".format(path, self.tmpfs_dir))
+
+            raise error[0], error[1], error[2]
+
+        if not self.release_tmpfs(path):
+            fail_with_error("Unable to sync {0} back from tmpfs, it's left "
+                            "in {1}".format(path, self.tmpfs_dir))
+
+    def release_tmpfs(self, path):
+        """Syncs a tree back from tmpfs to disk and unmounts the tmpfs, the
+        tmpfs is left mounted if the sync fails.
+
+        @param path: tree root FS path
+
+        @return: False on failure
+        """
+
+        stat = os.statvfs(self.tmpfs_dir)
+        self.tmpfs_full = stat.f_bavail * stat.f_frsize < TMPFS_RESERVE
+
+        try:
+            prune_tree(self.tmpfs_dir, path)
+        except (IOError, OSError) as e:
+            self.logger.error("Unable to remove the files deleted on tmpfs "
+                              "from {0}: {1}".format(path, e))
+            return False
+
+        # Unchanged files keep their modification times
+        for command in [['cp', '-au', self.tmpfs_dir + '/.', path],
+                        ['umount', self.tmpfs_dir]]:
+            process = self.exec_command(command, async=True)
+            process.communicate()
+
+            if 0 != process.returncode:
+                self.logger.error("Execution of {0} failed"
+                                  .format(command[0]))
+                return False
+
+        os.rmdir(self.tmpfs_dir)
+        return True
+
+    def create_overlay(self):
+        """Creates a copy-on-write jail over the shared base directory.
+
+        @return: False if overlayfs is unavailable
+        """
+
+        if not overlay_supported():
+            return False
+
+        self.create_base()
+
+        for path in [self.upper_dir, self.work_dir, self.chroot_dir]:
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+
+        if not self.mount():
+            shutil.rmtree(self.upper_dir, ignore_errors=True)
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            return False
+
+        return True
+
+    def destroy(self):
+        """Unmounts and removes the jail directories.
+        """
+
+        if self.agent is not None:
+            self.agent.stop()
+
+        # Leftovers of interrupted builds go first
+        for path in reversed(get_mount_points(self.chroot_dir) +
+                             get_mount_points(self.tmpfs_dir)):
+            self.exec_command(['umount', path])
+
+        for path in [self.chroot_dir, self.upper_dir, self.work_dir,
+                     self.tmpfs_dir]:
+            if os.path.exists(path):
+                # Never descending into anything still mounted into the jail
+                self.exec_command(['rm', '-rf', '--one-file-system', path])
+
+        self.cgroup.destroy()
+
+    def create(self):
+        """Creates a chroot jail with debootstrap or from the root FS cache.
+        """
+
+        if os.path.exists(self.chroot_dir):
+            self.logger.info("Removing the stale jail " + self.chroot_dir)
+            self.destroy()
+
+        if config.get('overlay', False):
+            if self.create_overlay():
+                self.logger.info("Created overlay jail over " + self.base_dir)
+            else:
+                self.logger.warning("Unable to mount overlayfs, falling back "
+                                    "to a plain jail directory")
+
+        if not self.is_overlay():
+            if not WarmPool().claim(self):
+                if os.path.isdir(self.base_dir):
+                    self.exec_command(['cp', '-a', '--reflink=auto',
+                                       self.base_dir + '/.', self.chroot_dir])
+                else:
+                    self.bootstrap(self.chroot_dir)
+
+            dedupe_jail(self.chroot_dir, self.logger)
+
         # Creating vlcc user
         self.exec_chroot(['useradd', 'vlcc'])
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import sqlite3
+import time
+
+from .core import logger, options, fail_with_error
+from .conf import config
+from .build import Builder, TASKS
+from .artifact import ArtifactStore
+from .predict import Predictor
+
+
+__all__ = ['JobQueue', 'distribute', 'get_queue_path', 'get_shared_store',
+           'get_worker_name']
+
+
+# Claimed jobs without a worker heartbeat for this long are requeued
+STALE_TIMEOUT = 120.
+
+# Queue polling interval in seconds
+POLL_INTERVAL = 5.
+
+
+def get_queue_path():
+    """Returns the shared job queue DB path.
+    """
+
+    return (getattr(options, 'queue', None) or
+            config.get('job_queue', './queue.db'))
+
+
+def get_shared_store():
+    """Returns the artifact store directory shared by the workers.
+    """
+
+    return (getattr(options, 'shared_store', None) or
+            config.get('shared_store', './shared/'))
+
+
+class JobQueue(object):
+    """Build jobs queue shared by the coordinator and the workers.
+
+    The queue is an SQLite DB, so any file system all the hosts can lock
+    files on will do, a local one for the workers on the same host. Every
+    job builds a single VLC version and publishes the installed tree into
+    the shared artifact store.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_queue_path()
+
+        try:
+            # Autocommit, transactions are managed explicitly
+            self.connection = sqlite3.connect(self.path, timeout=60.,
+                                              isolation_level=None)
+        except sqlite3.Error as e:
+            fail_with_error("Unable to open the job queue {0}, "
+                            "the message was: `{1}`"
+                            .format(self.path, e.message))
+
+        self.connection.row_factory = sqlite3.Row
+
+        schema_path = os.path.join(os.path.dirname(__file__), 'misc/jobs.sql')
+
+        with open(schema_path, 'r') as schema_file:
+            self.execute_script(schema_file.read())
+
+    def execute_script(self, script):
+        """Executes an SQL script.
+
+        @param script: SQL statements string
+        """
+
+        try:
+            self.connection.executescript(script)
+        except sqlite3.Error as e:
+            fail_with_error("Unable to update the job queue, "
+                            "the message was: `{0}`".format(e.message))
+
+    def execute(self, query, params):
+        """Executes an SQL statement.
+
+        @param query: query string
+        @param params: params list or dict
+
+        @return: sqlite3.Cursor object
+        """
+
+        try:
+            return self.connection.execute(query, params)
+        except sqlite3.Error as e:
+            fail_with_error("Unable to execute the query {0} on the job "
+                            "queue, the message was: `{1}`"
+                            .format(query, e.message))
+
+    def enqueue(self, version, priority=0.):
+        """Adds a job unless the version is already queued or being built.
+
+        @param version: VLC version string
+        @param priority: jobs with the highest one are claimed first
+
+        @return: job id
+        """
+
+        self.execute("BEGIN IMMEDIATE", [])
+
+        row = self.execute("SELECT id FROM job WHERE version=? "
+                           "    AND state IN ('pending', 'claimed')",
+                           [version]).fetchone()
+
+        if row is None:
+            cursor = self.execute("INSERT INTO job (version, priority) "
+                                  "VALUES (?, ?)", [version, priority])
+            job_id = cursor.lastrowid
+        else:
+            job_id = row['id']
+
+        self.execute("COMMIT", [])
+
+        return job_id
+
+    def claim(self, worker):
+        """Atomically claims the highest priority pending job.
+
+        @param worker: worker name
+
+        @return: job row or None if there are no pending jobs
+        """
+
+        self.execute("BEGIN IMMEDIATE", [])
+
+        row = self.execute("SELECT * FROM job WHERE state='pending' "
+                           "ORDER BY priority DESC, id LIMIT 1",
+                           []).fetchone()
+
+        if row is not None:
+            self.execute("UPDATE job SET state='claimed', worker=?, "
+                         "    heartbeat=?, stage=NULL WHERE id=?",
+                         [worker, time.time(), row['id']])
+
+        self.execute("COMMIT", [])
+
+        return row
+
+    def report(self, job_id, stage):
+        """Updates a claimed job heartbeat and build state.
+
+        @param job_id: job id
+        @param stage: build state the worker has reached
+
+        @return: False if the job is no longer claimed, i. e. cancelled
+        """
+
+        cursor = self.execute("UPDATE job SET heartbeat=?, stage=? "
+                              "WHERE id=? AND state='claimed'",
+                              [time.time(), stage, job_id])
+
+        return cursor.rowcount > 0
+
+    def cancel(self, job_ids):
+        """Cancels the pending and the claimed jobs, the workers stop
+        building them on the next report.
+
+        @param job_ids: job ids list
+        """
+
+        for job_id in job_ids:
+            self.execute("UPDATE job SET state='cancelled', heartbeat=? "
+                         "WHERE id=? AND state IN ('pending', 'claimed')",
+                         [time.time(), job_id])
+
+    def finish(self, job_id, artifact=None, message=None):
+        """Marks a job done if there's an artifact or failed otherwise.
+
+        @param job_id: job id
+        @param artifact: published artifact digest
+        @param message: failure reason
+        """
+
+        self.execute("UPDATE job SET state=?, artifact=?, message=?, "
+                     "    heartbeat=? WHERE id=?",
+                     ['done' if artifact else 'failed', artifact, message,
+                      time.time(), job_id])
+
+    def requeue_stale(self):
+        """Returns the jobs of the workers gone silent back to the queue.
+
+        @return: requeued jobs number
+        """
+
+        cursor = self.execute("UPDATE job SET state='pending', worker=NULL "
+                              "WHERE state='claimed' AND heartbeat<?",
+                              [time.time() - STALE_TIMEOUT])
+
+        return cursor.rowcount
+
+    def get(self, job_id):
+        """Returns a job row.
+
+        @param job_id: job id
+        """
+
+        return self.execute("SELECT * FROM job WHERE id=?",
+                            [job_id]).fetchone()
+
+
+def distribute(versions, on_error='fail-fast'):
+    """Builds VLC versions on the workers and imports the artifacts.
+
+    The longest expected builds are queued with the highest priority.
+
+    @param versions: build names list
+    @param on_error: build error policy, see vlcc.schedule.ERROR_POLICIES,
+        in `fail-fast` mode the first failure cancels the other jobs
+
+    @return: list of the versions the workers failed to build
+    """
+
+    queue = JobQueue()
+    predictor = Predictor()
+
+    # Job id -> version
+    jobs = {}
+
+    for version in versions:
+        priority = sum(predictor.estimate(version, name)
+                       for name in TASKS if name != 'restore')
+        jobs[queue.enqueue(version, priority)] = version
+
+    logger.info("Queued {0} build job(s) in {1}, waiting for the workers"
+                .format(len(jobs), queue.path))
+
+    # Job id -> (state, worker, stage) last logged
+    reported = {}
+    failed = []
+
+    while jobs:
+        requeued = queue.requeue_stale()
+
+        if requeued:
+            logger.warning("Requeued {0} job(s) of silent workers"
+                           .format(requeued))
+
+        for job_id, version in sorted(jobs.items()):
+            job = queue.get(job_id)
+            status = (job['state'], job['worker'], job['stage'])
+
+            if reported.get(job_id) != status:
+                reported[job_id] = status
+                logger.info("VLC {0}: {1} by {2}, stage `{3}`"
+                            .format(version, *status))
+
+            if job['state'] == 'failed':
+                logger.error("VLC {0} build failed on {1}: {2}"
+                             .format(version, job['worker'], job['message']))
+                failed.append(version)
+            elif job['state'] != 'done':
+                continue
+
+            del jobs[job_id]
+
+            if failed and on_error == 'fail-fast' and jobs:
+                logger.warning("Cancelling {0} job(s)".format(len(jobs)))
+                queue.cancel(jobs.keys())
+                failed.extend(jobs.values())
+                jobs.clear()
+                break
+
+        if jobs:
+            time.sleep(POLL_INTERVAL)
+
+    built = [version for version in versions if version not in failed]
+
+    if built:
+        ArtifactStore().import_(get_shared_store(), built)
+
+    for version in built:
+        builder = Builder(version)
+
+        if (not builder.has_state('installed') and
+                builder.get_artifact() is None):
+            logger.warning("VLC {0} artifact doesn't match the local build "
+                           "inputs, it's going to be built locally, check "
+                           "the workers use the same config".format(version))
+
+    return failed
+
+
+def get_worker_name():
+    """Returns the default worker name.
+    """
+
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
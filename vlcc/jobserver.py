@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import errno
+
+import os
+import multiprocessing
+
+from .core import logger
+from .conf import config
+
+
+__all__ = ['JobServer', 'get_jobserver', 'start_jobserver']
+
+
+# Host-wide jobserver instance, inherited by build processes
+_jobserver = None
+
+
+class JobServer(object):
+    """GNU make jobserver shared by all the concurrent builds.
+
+    The jobserver is a pipe filled with job slot tokens. Every make process
+    takes a token for each job it runs in parallel, so the slots are
+    rebalanced automatically between active builds as their jobs finish.
+    """
+
+    def __init__(self, slots):
+        """Creates the jobserver pipe.
+
+        @param slots: total job slots number
+        """
+
+        self.slots = slots
+        self.read_fd, self.write_fd = os.pipe()
+
+        os.write(self.write_fd, '+' * slots)
+
+    def get_makeflags(self):
+        """Returns MAKEFLAGS value making child make processes use the
+        jobserver.
+        """
+
+        return ('-j --jobserver-fds={0},{1}'
+                .format(self.read_fd, self.write_fd))
+
+    def acquire(self):
+        """Takes a token blocking until it's available.
+
+        @return: token string
+        """
+
+        while True:
+            try:
+                return os.read(self.read_fd, 1)
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    def release(self, token):
+        """Returns a token to the jobserver.
+
+        @param token: token string returned by acquire()
+        """
+
+        os.write(self.write_fd, token)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Context manager holding a token for the top-level make process.
+
+        make's first job doesn't take a token from the pipe, so the
+        builder does that on its behalf to keep the total within limits.
+        """
+
+        token = self.acquire()
+
+        try:
+            yield
+        finally:
+            self.release(token)
+
+
+def start_jobserver():
+    """Creates the host-wide jobserver, should be called before forking the
+    build processes.
+    """
+
+    global _jobserver
+
+    slots = config.get('make_jobs', 'auto')
+
+    if slots == 'auto':
+        slots = multiprocessing.cpu_count()
+
+    slots = max(int(slots), 1)
+
+    logger.info("Starting make jobserver with {0} job slots".format(slots))
+
+    _jobserver = JobServer(slots)
+    return _jobserver
+
+
+def get_jobserver():
+    """Returns the host-wide jobserver, or None if it's not started.
+    """
+
+    return _jobserver
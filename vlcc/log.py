@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import gzip
+
+import os
+import threading
+
+
+__all__ = ['LogStream', 'read_tail']
+
+
+class LogStream(object):
+    """Build output pump.
+
+    The output is written into a gzip-compressed log file, while the last
+    lines are kept in a ring buffer and flushed into a small `.tail` file for
+    live viewing by a timer thread, so quiet builds show their last lines
+    too. The buffer is flushed once more at EOF and the tail file is removed
+    once the log file is closed.
+    """
+
+    def __init__(self, log_path, lines=200, flush_interval=1.):
+        """Initializes the stream.
+
+        @param log_path: log file path without the compression extension
+        @param lines: ring buffer size in lines
+        @param flush_interval: tail file update interval in seconds
+        """
+
+        self.log_path = log_path
+        self.tail_path = log_path + '.tail'
+        self.buffer = collections.deque(maxlen=lines)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        # The buffer has lines the tail file lacks
+        self.dirty = False
+
+    def flush_tail(self):
+        """Atomically replaces the tail file with the ring buffer contents.
+        """
+
+        temp_path = self.tail_path + '.tmp'
+
+        with self.lock:
+            lines = list(self.buffer)
+            self.dirty = False
+
+        with open(temp_path, 'wb') as tail_file:
+            tail_file.writelines(lines)
+
+        os.rename(temp_path, self.tail_path)
+
+    def flush_periodically(self):
+        """Flushes the tail file every flush interval until the stream is
+        closed.
+        """
+
+        while not self.closed.wait(self.flush_interval):
+            if self.dirty:
+                self.flush_tail()
+
+    def pump(self, stream):
+        """Reads the stream until EOF.
+
+        @param stream: file-like object, i. e. process stdout
+        """
+
+        timer = threading.Thread(target=self.flush_periodically)
+        timer.daemon = True
+        timer.start()
+
+        try:
+            with gzip.open(self.log_path + '.gz', 'wb') as log_file:
+                for line in iter(stream.readline, ''):
+                    log_file.write(line)
+
+                    with self.lock:
+                        self.buffer.append(line)
+                        self.dirty = True
+
+                self.closed.set()
+                timer.join()
+                # The last lines stay visible until the log file is complete
+                self.flush_tail()
+        finally:
+            self.closed.set()
+
+        try:
+            os.unlink(self.tail_path)
+        except OSError:
+            pass
+
+
+def read_tail(log_path, lines=100):
+    """Returns the last lines of a log being written or a finished one.
+
+    @param log_path: log file path without the compression extension
+    @param lines: lines number
+
+    @return: tuple of (lines list, True if the log is still being written)
+        or None if there's no such log
+    """
+
+    tail_path = log_path + '.tail'
+
+    try:
+        with open(tail_path, 'rb') as tail_file:
+            return list(collections.deque(tail_file, lines)), True
+    except IOError:
+        pass
+
+    for path, opener in [(log_path + '.gz', gzip.open), (log_path, open)]:
+        try:
+            with opener(path, 'rb') as log_file:
+                return list(collections.deque(log_file, lines)), False
+        except IOError:
+            pass
+
+    return None
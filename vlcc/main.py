@@ -4,13 +4,15 @@ import os
 import sys
 import commands
 
-from multiprocessing import Pool
-
 from .core import logger, options, argparser
 from .core import initialize, fail_with_error
-from .conf import config
+from .conf import has_build
 
-from .build import build
+from .schedule import schedule, plan, get_error_policy, ERROR_POLICIES
+from .jobs import distribute
+from .repo import populate
+from .jobserver import start_jobserver
+from .subcommands import subcommands
 from .compare import compare
 
 
@@ -21,6 +23,12 @@ def main():
     """VLCC runner entry point function.
     """
 
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        return subcommands[sys.argv[1]]()
+
+    argparser.epilog = ("Subcommands: {0}, run `vlcc-run COMMAND --help` "
+                        "for details".format(", ".join(sorted(subcommands))))
+
     # VLCC runner specific arguments
     argparser.add_argument('movie', metavar='MOVIE',
                            help='A movie file to play')
@@ -33,10 +41,48 @@ def main():
     argparser.add_argument('-b', '--build-dir', dest='build_dir',
                            default="./build/",
                            help="build directory path, `./build/` by default")
+    argparser.add_argument('--offline', action="store_true",
+                           dest='offline', default=False,
+                           help="fail instead of downloading anything")
+    argparser.add_argument('--populate-repo', action="store_true",
+                           dest='populate_repo', default=False,
+                           help="download the jail packages into the local "
+                                "repository before building")
+    argparser.add_argument('--plan', action="store_true",
+                           dest='plan', default=False,
+                           help="print the projected build schedule based on "
+                                "the past builds and exit")
+    argparser.add_argument('--distribute', action="store_true",
+                           dest='distribute', default=False,
+                           help="build on the workers sharing the job queue "
+                                "and only restore the artifacts locally")
+    argparser.add_argument('--on-error', dest='on_error',
+                           choices=ERROR_POLICIES, default=None,
+                           help="cancel all the builds once one fails or "
+                                "compare the built versions, `on_error` "
+                                "config option by default")
 
     # Initializing the core
     initialize()
 
+    # Checking versions
+    missing_versions = set(version for version in options.versions
+                           if not has_build(version))
+
+    if missing_versions:
+        params = dict(
+            s='s' if len(missing_versions) > 1 else '',
+            ver=", ".join(missing_versions),
+            config=options.config,
+        )
+        fail_with_error("VLC version{0[s]} {0[ver]} description{0[s]} "
+                        "not found in {0[config]}"
+                        .format(params))
+
+    # Planning needs neither root privileges nor the build tools
+    if options.plan:
+        return plan(options.versions)
+
     if os.getuid() != 0:
         fail_with_error("Root privileges are required to run this script")
 
@@ -66,28 +112,45 @@ def main():
     except OSError:
         pass
 
-    # Checking versions
-    missing_versions = set(options.versions) - set(config.get('versions', {}))
+    if options.populate_repo:
+        populate(options.versions)
 
-    if missing_versions:
-        params = dict(
-            s='s' if len(missing_versions) > 1 else '',
-            ver=", ".join(missing_versions),
-            config=options.config,
-        )
-        fail_with_error("VLC version{0[s]} {0[ver]} description{0[s]} "
-                        "not found in {0[config]}"
-                        .format(params))
+    on_error = get_error_policy()
+    versions = options.versions
 
     # Building
-    pool = Pool(len(options.versions))
-    pool.map_async(build, options.versions).get(timeout=sys.maxint)
+    if options.distribute:
+        failed = distribute(versions, on_error)
+
+        if failed and on_error == 'fail-fast':
+            fail_with_error("Workers were unable to build VLC {0}"
+                            .format(", ".join(failed)))
+
+        versions = [version for version in versions if version not in failed]
+
+    start_jobserver()
+
+    failed = schedule(versions, on_error) if versions else []
+
+    if failed and on_error == 'fail-fast':
+        fail_with_error("Unable to build VLC {0}".format(", ".join(failed)))
+
+    built = [version for version in versions if version not in failed]
+    failed = [version for version in options.versions if version not in built]
+
+    if failed:
+        logger.error("Unable to build VLC {0}, comparing the rest"
+                     .format(", ".join(failed)))
+
+    if not built:
+        fail_with_error("No VLC version has been built")
 
     # Uncomment for building sequentially
+    #from .build import build
     #[build(version)
     # for version in options.versions]
 
     # Comparing
-    compare()
+    compare(built)
 
     logger.info("Finished.")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# In-jail command execution agent
+#
+# Reads JSON requests line by line from stdin:
+#   {"argv": [...], "cwd": "...", "env": {...}, "userspec": "USER[:GROUP]"}
+# and replies to every one with JSON lines on stdout:
+#   {"pid": PID} once the command is started,
+#   {"output": "..."} for every line of its merged stdout and stderr,
+#   {"exit": STATUS, "rusage": {...}} once it's finished with its resource
+#   usage, see get_rusage(), or {"exit": 127, "error": "..."} if it can't
+#   be started.
+# Output is transferred as latin-1 decoded text to pass any bytes through.
+# The agent exits on stdin EOF, i. e. when vlcc is gone.
+#
+
+import grp
+import json
+import os
+import pwd
+import subprocess
+import sys
+
+
+def reply(message):
+    sys.stdout.write(json.dumps(message) + '\n')
+    sys.stdout.flush()
+
+
+def get_demote(userspec):
+    """Returns a function switching the child process to the user.
+    """
+
+    if not userspec:
+        return None
+
+    user, _, group = userspec.partition(':')
+    entry = pwd.getpwnam(user)
+    gid = grp.getgrnam(group).gr_gid if group else entry.pw_gid
+
+    def demote():
+        os.setgroups([])
+        os.setgid(gid)
+        os.setuid(entry.pw_uid)
+
+    return demote
+
+
+def get_rusage(usage):
+    """Converts os.wait4() resource usage into a dict, the command isn't
+    a child of vlcc, so vlcc can't account it itself.
+    """
+
+    return {
+        'user_time': usage.ru_utime,
+        'sys_time': usage.ru_stime,
+        # Kilobytes on Linux
+        'max_rss': usage.ru_maxrss * 1024,
+        'read_blocks': usage.ru_inblock,
+        'write_blocks': usage.ru_oublock,
+    }
+
+
+def execute(request):
+    env = request.get('env')
+
+    if env is not None:
+        env = dict((str(key), str(value)) for key, value in env.items())
+
+    try:
+        process = subprocess.Popen([str(arg) for arg in request['argv']],
+                                   cwd=request.get('cwd'), env=env,
+                                   stdin=open(os.devnull),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   preexec_fn=get_demote(
+                                       request.get('userspec')))
+    except (OSError, KeyError) as e:
+        return reply({'exit': 127, 'error': str(e)})
+
+    reply({'pid': process.pid})
+
+    for line in iter(process.stdout.readline, ''):
+        reply({'output': line.decode('latin-1')})
+
+    _, status, usage = os.wait4(process.pid, 0)
+    status = (-os.WTERMSIG(status) if os.WIFSIGNALED(status)
+              else os.WEXITSTATUS(status))
+
+    reply({'exit': status, 'rusage': get_rusage(usage)})
+
+
+if __name__ == "__main__":
+    for line in iter(sys.stdin.readline, ''):
+        execute(json.loads(line))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# In-jail compiler wrapper profiling compile and link invocations
+#
+# Used as `python vlcc-ccwrap.py COMPILER ARGS...`, i. e. as CC and CXX.
+# If VLCC_UNITS_LOG is set, every invocation producing a file appends a
+# JSON line to it:
+#   {"unit": OUTPUT, "source": SOURCE, "kind": "compile" or "link",
+#    "wall_time": S, "cpu_time": S, "max_rss": BYTES, "output_bytes": BYTES}
+# with the output path relative to VLCC_BUILD_DIR. Otherwise, i. e. while
+# configuring, the compiler is just executed.
+#
+
+import json
+import os
+import signal
+import sys
+import time
+
+
+SOURCE_EXTS = ('.c', '.cc', '.cpp', '.cxx', '.m', '.mm', '.s', '.S')
+
+
+def get_output(args):
+    """Returns the output and the source paths of a compiler invocation,
+    the output is None if nothing is produced.
+    """
+
+    sources = [arg for arg in args if arg.endswith(SOURCE_EXTS)]
+    source = sources[0] if sources else None
+
+    if '-E' in args or '-M' in args or '-MM' in args:
+        return None, source
+
+    if '-o' in args[:-1]:
+        return args[args.index('-o') + 1], source
+
+    if '-c' in args and source is not None:
+        return os.path.splitext(os.path.basename(source))[0] + '.o', source
+
+    return None, source
+
+
+def main():
+    argv = sys.argv[1:]
+    log_path = os.environ.get('VLCC_UNITS_LOG')
+    output, source = get_output(argv)
+
+    if not log_path or output is None:
+        os.execvp(argv[0], argv)
+
+    started = time.time()
+    pid = os.fork()
+
+    if pid == 0:
+        try:
+            os.execvp(argv[0], argv)
+        finally:
+            os._exit(127)
+
+    # The compiler handles the interruptions
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _, status, usage = os.wait4(pid, 0)
+
+    if os.WIFSIGNALED(status):
+        sys.exit(128 + os.WTERMSIG(status))
+
+    status = os.WEXITSTATUS(status)
+
+    if status == 0:
+        output = os.path.abspath(output)
+
+        try:
+            output_bytes = os.path.getsize(output)
+        except OSError:
+            output_bytes = None
+
+        record = {
+            'unit': os.path.relpath(output, os.environ.get('VLCC_BUILD_DIR',
+                                                           '/')),
+            'source': source,
+            'kind': 'compile' if '-c' in argv else 'link',
+            'wall_time': time.time() - started,
+            'cpu_time': usage.ru_utime + usage.ru_stime,
+            'max_rss': usage.ru_maxrss * 1024,
+            'output_bytes': output_bytes,
+        }
+
+        # A single appending write keeps parallel jobs' lines whole
+        fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        os.write(fd, (json.dumps(record) + '\n').encode('utf-8'))
+        os.close(fd)
+
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+-- Shared build job queue, see vlcc.jobs
+
+CREATE TABLE IF NOT EXISTS job (
+    id INTEGER PRIMARY KEY,
+    version VARCHAR(8),
+    priority FLOAT DEFAULT 0,
+    -- pending, claimed, done, failed or cancelled
+    state VARCHAR(8) DEFAULT 'pending',
+    worker VARCHAR(64),
+    heartbeat FLOAT,
+    stage VARCHAR(16),
+    artifact CHAR(64),
+    message TEXT,
+    created DATE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS job_state_index ON job (state, priority);
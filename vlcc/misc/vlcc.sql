@@ -51,10 +51,114 @@ CREATE TABLE IF NOT EXISTS comparison_build (
     UNIQUE (comparison_id, build_version) ON CONFLICT REPLACE
 );
 
+CREATE TABLE IF NOT EXISTS ccache_stats (
+    build_version VARCHAR(8),
+    hits INTEGER,
+    misses INTEGER,
+    performed DATE DEFAULT CURRENT_TIMESTAMP,
+
+    FOREIGN KEY (build_version) REFERENCES build(version)
+);
+
+CREATE TABLE IF NOT EXISTS download (
+    build_version VARCHAR(8),
+    sha256 CHAR(64),
+    bytes BIGINT,
+    seconds FLOAT,
+    cached BOOLEAN,
+    performed DATE DEFAULT CURRENT_TIMESTAMP,
+
+    FOREIGN KEY (build_version) REFERENCES build(version)
+);
+
+CREATE TABLE IF NOT EXISTS build_stage (
+    id INTEGER PRIMARY KEY,
+    build_version VARCHAR(8),
+    stage VARCHAR(16),
+    wall_time FLOAT,
+    user_time FLOAT,
+    sys_time FLOAT,
+    max_rss BIGINT,
+    read_bytes BIGINT,
+    write_bytes BIGINT,
+    -- disk, tmpfs or spilled
+    storage VARCHAR(8) DEFAULT 'disk',
+    performed DATE DEFAULT CURRENT_TIMESTAMP,
+
+    FOREIGN KEY (build_version) REFERENCES build(version)
+);
+
+CREATE TABLE IF NOT EXISTS build_fingerprint (
+    build_version VARCHAR(8),
+    state VARCHAR(16),
+    fingerprint CHAR(40),
+
+    FOREIGN KEY (build_version) REFERENCES build(version),
+
+    UNIQUE (build_version, state) ON CONFLICT REPLACE
+);
+
+CREATE TABLE IF NOT EXISTS build_cgroup (
+    id INTEGER PRIMARY KEY,
+    build_version VARCHAR(8),
+    stage VARCHAR(16),
+    cpu_time FLOAT,
+    user_time FLOAT,
+    sys_time FLOAT,
+    throttled_time FLOAT,
+    memory_peak BIGINT,
+    oom_kills INTEGER,
+    performed DATE DEFAULT CURRENT_TIMESTAMP,
+
+    FOREIGN KEY (build_version) REFERENCES build(version)
+);
+
+CREATE TABLE IF NOT EXISTS disk_usage (
+    id INTEGER PRIMARY KEY,
+    -- NULL for the trees shared by the builds
+    build_version VARCHAR(8),
+    -- jail, sources, objects, logs, snapshots or a shared tree name
+    category VARCHAR(16),
+    bytes BIGINT,
+    files INTEGER,
+    measured DATE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS mirror_transfer (
+    id INTEGER PRIMARY KEY,
+    -- mirror base URL
+    url VARCHAR(255),
+    bytes BIGINT,
+    seconds FLOAT,
+    failures INTEGER,
+    performed DATE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS compile_unit (
+    id INTEGER PRIMARY KEY,
+    build_version VARCHAR(8),
+    -- output path relative to the build tree
+    unit VARCHAR(255),
+    source VARCHAR(255),
+    -- compile or link
+    kind VARCHAR(8),
+    wall_time FLOAT,
+    cpu_time FLOAT,
+    max_rss BIGINT,
+    output_bytes BIGINT,
+    performed DATE DEFAULT CURRENT_TIMESTAMP,
+
+    FOREIGN KEY (build_version) REFERENCES build(version)
+);
+
 -- Awesome indexes
 
 CREATE INDEX IF NOT EXISTS comparison_performed_index ON comparison (performed);
 
 CREATE INDEX IF NOT EXISTS sample_comparison_build_id_index ON sample (comparison_build_id);
 
+CREATE INDEX IF NOT EXISTS build_stage_build_version_index ON build_stage (build_version, stage);
+
+CREATE INDEX IF NOT EXISTS compile_unit_build_version_index ON compile_unit (build_version, wall_time);
+
 COMMIT;
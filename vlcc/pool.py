@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import multiprocessing
+
+from .core import logger, options
+from .conf import config
+
+
+__all__ = ['WarmPool']
+
+
+class WarmPool(object):
+    """Pool of ready-to-use plain jails created in background.
+
+    Warm jails live in `pool/<fingerprint>/` subdirectory of the build
+    directory. A build claims one by renaming it into its jail directory,
+    which is atomic, so concurrent builds never get the same jail.
+    """
+
+    def __init__(self):
+        self.root = os.path.join(options.build_dir, 'pool')
+
+    def get_dir(self, fingerprint):
+        """Returns the directory of warm jails with the given root FS
+        fingerprint.
+
+        @param fingerprint: root FS fingerprint
+        """
+
+        return os.path.join(self.root, fingerprint)
+
+    def get_ready(self, fingerprint):
+        """Returns the ready jail paths.
+
+        @param fingerprint: root FS fingerprint
+        """
+
+        pool_dir = self.get_dir(fingerprint)
+
+        if not os.path.isdir(pool_dir):
+            return []
+
+        return [os.path.join(pool_dir, name)
+                for name in sorted(os.listdir(pool_dir))
+                if not name.startswith('.')]
+
+    def claim(self, jail):
+        """Moves a warm jail into the jail directory.
+
+        @param jail: jail object
+        @return: True if a warm jail has been claimed
+        """
+
+        for path in self.get_ready(jail.get_fingerprint()):
+            try:
+                os.rename(path, jail.chroot_dir)
+            except OSError:
+                # Claimed by another build
+                continue
+
+            jail.logger.info("Claimed warm jail " + path)
+            return True
+
+        return False
+
+    def fill(self, jail):
+        """Creates a warm jail.
+
+        @param jail: jail object describing the root FS
+        """
+
+        fingerprint = jail.get_fingerprint()
+        pool_dir = self.get_dir(fingerprint)
+        temp_dir = os.path.join(pool_dir, '.tmp-{0}'.format(os.getpid()))
+
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+        # Not to clobber the build logs of the version describing the root FS
+        jail.log_dir = os.path.join(self.root, 'log-' + fingerprint)
+
+        try:
+            os.makedirs(jail.log_dir)
+        except OSError:
+            pass
+
+        jail.bootstrap(temp_dir)
+        os.rename(temp_dir, os.path.join(pool_dir,
+                                         'jail-{0:.6f}'.format(time.time())))
+
+    def serve(self, size, interval=60., max_load=None, once=False):
+        """Keeps the given number of warm jails for every configured root FS
+        while the machine is idle.
+
+        @param size: warm jails number per root FS
+        @param interval: idle check interval in seconds
+        @param max_load: one minute load average to consider the machine
+            idle below, a half of CPUs number by default
+        @param once: fill the pool and return if True
+        """
+        from .jail import Jail
+
+        if max_load is None:
+            max_load = multiprocessing.cpu_count() / 2.
+
+        # Root FS fingerprint -> jail object
+        jails = {}
+
+        for version in sorted(config.get('versions', {})):
+            jail = Jail(version)
+            jails.setdefault(jail.get_fingerprint(), jail)
+
+        for fingerprint in jails:
+            try:
+                os.makedirs(self.get_dir(fingerprint))
+            except OSError:
+                pass
+
+        logger.info("Keeping {0} warm jail(s) for {1} root FS(es)"
+                    .format(size, len(jails)))
+
+        while True:
+            missing = [(fingerprint, jail)
+                       for fingerprint, jail in sorted(jails.items())
+                       if len(self.get_ready(fingerprint)) < size]
+
+            if not missing and once:
+                return
+
+            if missing and os.getloadavg()[0] < max_load:
+                fingerprint, jail = missing[0]
+
+                logger.info("Creating a warm {0} jail ({1})"
+                            .format(jail.version_config['distr'],
+                                    fingerprint))
+                self.fill(jail)
+                continue
+
+            time.sleep(interval)
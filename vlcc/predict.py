@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from .build import TASKS
+from .db import db
+
+
+__all__ = ['Predictor']
+
+
+# Task durations in seconds assumed when there's no history at all
+DEFAULT_ESTIMATES = {
+    'fetch': 60.,
+    'create_jail': 300.,
+    'unpack': 30.,
+    'configure': 120.,
+    'make': 1800.,
+    'install': 60.,
+    'restore': 30.,
+}
+
+# Number of the latest runs to average
+HISTORY = 5
+
+
+class Predictor(object):
+    """Build task duration estimator based on the past build stages.
+
+    A task is expected to take the average wall time of its latest runs for
+    the same VLC version, or for any version if this one has never been
+    built, or the default guess if the task has never been run at all.
+    """
+
+    def __init__(self):
+        # (version, task name) -> estimate
+        self.estimates = {}
+
+    def get_history(self, name, version=None):
+        """Returns the latest durations of a task.
+
+        @param name: task name, see vlcc.build.TASKS
+        @param version: VLC version string, any version if None
+        """
+
+        if name == 'fetch':
+            # Cached sources don't tell how long downloads take
+            query = ("SELECT seconds FROM download "
+                     "WHERE NOT cached {0} "
+                     "ORDER BY performed DESC LIMIT ?")
+            params = []
+        else:
+            query = ("SELECT wall_time FROM build_stage "
+                     "WHERE stage=? {0} "
+                     "ORDER BY id DESC LIMIT ?")
+            params = [TASKS[name][2]]
+
+        if version is not None:
+            query = query.format("AND build_version=?")
+            params.append(version)
+        else:
+            query = query.format("")
+
+        cursor = db.query(query, params + [HISTORY])
+
+        return [row[0] for row in cursor.fetchall()]
+
+    def estimate(self, version, name):
+        """Returns the expected task duration in seconds.
+
+        @param version: VLC version string
+        @param name: task name, see vlcc.build.TASKS
+        """
+
+        key = (version, name)
+
+        if key not in self.estimates:
+            # restore isn't recorded as a build stage
+            history = ([] if name == 'restore' else
+                       self.get_history(name, version) or
+                       self.get_history(name))
+
+            if history:
+                self.estimates[key] = sum(history) / len(history)
+            else:
+                self.estimates[key] = DEFAULT_ESTIMATES[name]
+
+        return self.estimates[key]
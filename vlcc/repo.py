@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+
+import os
+import shutil
+import commands
+import subprocess
+
+from .core import logger, options, fail_with_error
+from .conf import config, split_build
+from .store import Store
+
+
+__all__ = ['get_archives_dir', 'get_repo_url', 'populate']
+
+
+def get_archives_dir():
+    """Returns the shared .deb archives directory used by all the jails.
+    """
+
+    return Store('apt').root
+
+
+def get_repo_dir():
+    """Returns the local repository directory or None if it's disabled.
+    """
+
+    repo_dir = config.get('local_repo')
+    return os.path.abspath(repo_dir) if repo_dir else None
+
+
+def get_repo_url(distr):
+    """Returns the local repository URL if it has been populated for the
+    given distribution.
+
+    @param distr: distribution code name, i. e. `wheezy`
+    """
+
+    repo_dir = get_repo_dir()
+
+    if repo_dir is None:
+        return None
+
+    if not os.path.exists(os.path.join(repo_dir, 'dists', distr, 'Release')):
+        return None
+
+    return 'file://' + repo_dir
+
+
+def get_host_arch():
+    """Returns the host dpkg architecture.
+    """
+
+    status, output = commands.getstatusoutput('dpkg --print-architecture')
+
+    if status != 0:
+        fail_with_error("Unable to determine the host architecture")
+
+    return output.strip()
+
+
+def link_or_copy(src, dest):
+    """Hardlinks a file falling back to copying across file systems.
+
+    @param src: source path
+    @param dest: destination path
+    """
+
+    if os.path.exists(dest):
+        return
+
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def get_debpaths(target_dir):
+    """Returns paths of the .deb files debootstrap has downloaded for
+    the target.
+
+    @param target_dir: debootstrap target directory
+    """
+
+    archives = os.path.join(target_dir, 'var/cache/apt/archives')
+    debpaths = os.path.join(target_dir, 'debootstrap', 'debpaths')
+
+    if not os.path.exists(debpaths):
+        return [os.path.join(archives, filename)
+                for filename in os.listdir(archives)
+                if filename.endswith('.deb')]
+
+    with open(debpaths) as f:
+        return [os.path.join(target_dir, line.split()[1].lstrip('/'))
+                for line in f if line.strip()]
+
+
+def index(repo_dir, distr, arches):
+    """Writes Packages and Release files of a distribution.
+
+    @param repo_dir: repository directory
+    @param distr: distribution code name
+    @param arches: architectures list
+    """
+
+    pool = os.path.join('pool', distr)
+    dists_dir = os.path.join(repo_dir, 'dists', distr)
+
+    for arch in arches:
+        packages_dir = os.path.join(dists_dir, 'main', 'binary-' + arch)
+
+        try:
+            os.makedirs(packages_dir)
+        except OSError:
+            pass
+
+        process = subprocess.Popen(['apt-ftparchive', '--arch', arch,
+                                    'packages', pool],
+                                   cwd=repo_dir, stdout=subprocess.PIPE)
+        packages, _ = process.communicate()
+
+        if process.returncode != 0:
+            fail_with_error("Unable to index {0} packages".format(distr))
+
+        with open(os.path.join(packages_dir, 'Packages'), 'wb') as f:
+            f.write(packages)
+
+        with gzip.open(os.path.join(packages_dir, 'Packages.gz'), 'wb') as f:
+            f.write(packages)
+
+    release_options = dict(
+        Suite=distr,
+        Codename=distr,
+        Components='main',
+        Architectures=" ".join(sorted(arches)),
+    )
+
+    command = ['apt-ftparchive']
+
+    for key, value in sorted(release_options.items()):
+        command += ['-o', 'APT::FTPArchive::Release::{0}={1}'
+                    .format(key, value)]
+
+    command += ['release', dists_dir]
+
+    # A stale Release file would be listed in the new one
+    try:
+        os.unlink(os.path.join(dists_dir, 'Release'))
+    except OSError:
+        pass
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    release, _ = process.communicate()
+
+    if process.returncode != 0:
+        fail_with_error("Unable to write {0} Release file".format(distr))
+
+    # Writing the Release file after indexing since it's inside dists_dir
+    with open(os.path.join(dists_dir, 'Release'), 'wb') as f:
+        f.write(release)
+
+
+def populate(versions):
+    """Downloads all the packages required by the given VLC versions' jails
+    into the local repository, so jails can be created offline.
+
+    @param versions: build names list, variants share their version's jail
+    """
+    from .jail import Jail
+
+    repo_dir = get_repo_dir()
+
+    if repo_dir is None:
+        fail_with_error("Please specify local_repo in {0} to populate it"
+                        .format(options.config))
+
+    status, _ = commands.getstatusoutput('apt-ftparchive --version')
+
+    if status != 0:
+        fail_with_error("Please install apt-utils to populate "
+                        "the local repository")
+
+    # Distribution code name to architectures mapping
+    dists = {}
+    fingerprints = set()
+
+    for version in versions:
+        jail = Jail(split_build(version)[0])
+        fingerprint = jail.get_fingerprint()
+
+        if fingerprint in fingerprints:
+            continue
+
+        fingerprints.add(fingerprint)
+
+        distr = jail.version_config['distr']
+        arch = jail.version_config.get('arch') or get_host_arch()
+        dists.setdefault(distr, set()).add(arch)
+
+        logger.info("Populating the local repository for VLC " + version)
+
+        target_dir = os.path.join(options.build_dir,
+                                  'repo-' + fingerprint + '.tmp')
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+        jail.debootstrap(target_dir, download_only=True)
+
+        pool_dir = os.path.join(repo_dir, 'pool', distr)
+
+        try:
+            os.makedirs(pool_dir)
+        except OSError:
+            pass
+
+        for path in get_debpaths(target_dir):
+            link_or_copy(path, os.path.join(pool_dir, os.path.basename(path)))
+
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+    for distr, arches in dists.iteritems():
+        index(repo_dir, distr, arches)
+
+    logger.info("Local repository {0} is ready".format(repo_dir))
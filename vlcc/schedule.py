@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import multiprocessing
+import Queue
+
+import signal
+import sys
+import time
+
+from multiprocessing import Pool
+
+import psutil
+
+from .core import logger, options, get_child_logger, fail_with_error
+from .conf import config, split_build
+from .build import Builder, TASKS, SHARED_TASKS
+from .db import db
+from .predict import Predictor
+
+
+__all__ = ['Scheduler', 'schedule', 'plan', 'get_error_policy',
+           'kill_tree', 'exit_on_sigterm', 'ERROR_POLICIES']
+
+
+# Default number of concurrent tasks per resource class
+DEFAULT_RESOURCES = {
+    'network': 2,
+    'disk': 1,
+    'cpu': 2,
+}
+
+
+# What to do when a build fails: cancel the others right away or let them
+# finish and compare the built versions
+ERROR_POLICIES = ['fail-fast', 'continue']
+
+# Seconds cancelled processes are given to exit before they're killed
+KILL_TIMEOUT = 5.
+
+# Seconds the cancelled tasks are given to sync their tmpfs trees back and
+# unmount what they've mounted before the pool workers are terminated
+CLEANUP_TIMEOUT = 300.
+
+
+def get_error_policy():
+    """Returns the build error policy, see ERROR_POLICIES.
+    """
+
+    policy = (getattr(options, 'on_error', None) or
+              config.get('on_error', 'fail-fast'))
+
+    if policy not in ERROR_POLICIES:
+        fail_with_error("Unknown on_error policy `{0}`, use one of {1}"
+                        .format(policy, ", ".join(ERROR_POLICIES)))
+
+    return policy
+
+
+def exit_on_sigterm():
+    """Turns SIGTERM into SystemExit, so the cancelled builds unmount what
+    they've mounted on the way out.
+    """
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+
+def kill_tree(pid, timeout=KILL_TIMEOUT):
+    """Terminates all the descendants of a process, the ones still running
+    after the timeout are killed.
+
+    @param pid: process ID
+    @param timeout: seconds to wait for the processes to exit
+    """
+
+    try:
+        children = psutil.Process(pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+
+    for child in children:
+        try:
+            child.terminate()
+        except psutil.NoSuchProcess:
+            pass
+
+    _, alive = psutil.wait_procs(children, timeout=timeout)
+
+    for child in alive:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def _init_worker():
+    """Pool worker initializer, a DB connection can't be shared by
+    processes.
+    """
+
+    db.connect()
+    exit_on_sigterm()
+
+
+def _run_task(version, name):
+    """Runs a build task in a pool worker.
+
+    @param version: build name
+    @param name: task name
+
+    @return: True on success
+    """
+
+    try:
+        Builder(version).run_task(name)
+    except SystemExit:
+        # fail_with_error() has already logged the reason
+        return False
+    except Exception:
+        get_child_logger(version).exception("Task `{0}` crashed"
+                                            .format(name))
+        return False
+
+    return True
+
+
+class Task(object):
+    """A single build stage of a VLC version.
+    """
+
+    def __init__(self, version, name):
+        """Initializes the task.
+
+        @param version: build name
+        @param name: task name, see vlcc.build.TASKS
+        """
+
+        self.version = version
+        self.name = name
+        self.resource, deps, _ = TASKS[name]
+
+        base_version, variant = split_build(version)
+
+        # Variants depend on their version's jail and sources
+        self.deps = [(base_version if variant is not None and
+                      dep in SHARED_TASKS else version, dep)
+                     for dep in deps]
+        self.state = 'pending'
+        self.started = self.finished = None
+        self.estimate = 0.
+        # Expected time to finish the build from the task start
+        self.priority = 0.
+
+    @property
+    def key(self):
+        return (self.version, self.name)
+
+    def __str__(self):
+        return "{0}:{1}".format(self.version, self.name)
+
+
+class Scheduler(object):
+    """Build stages scheduler.
+
+    Every build stage of every version is a task with declared dependencies
+    and a resource class. Ready tasks are run in a process pool as soon as
+    their resource class has a free slot, so one version's download may
+    overlap another version's compilation. The ready tasks with the longest
+    expected remaining build go first, so the slowest builds don't end up
+    starting last. Variants only configure, build and install, the fetching,
+    jail creation and unpacking are their version's tasks.
+
+    In `fail-fast` mode the first failed task cancels everything, the
+    running tasks' processes are terminated. In `continue` mode only the
+    tasks depending on the failed one are skipped.
+    """
+
+    def __init__(self, versions, on_error='fail-fast', read_only=False):
+        """Plans the tasks, the ones with completed build states are
+        marked as done.
+
+        @param versions: build names list
+        @param on_error: build error policy, see ERROR_POLICIES
+        @param read_only: only project the schedule, the build states and
+            the jails are left as they are
+        """
+
+        self.versions = versions
+        self.on_error = on_error
+        self.resources = dict(DEFAULT_RESOURCES)
+        self.resources.update(config.get('resources') or {})
+
+        self.tasks = collections.OrderedDict()
+        self.results = Queue.Queue()
+
+        # VLC versions the variants share tasks of
+        shared = set()
+        # Invalidated builders, read-only ones keep the states in memory
+        builders = {}
+
+        for version in versions:
+            builder = builders[version] = Builder(version, read_only)
+            builder.invalidate()
+
+            if builder.variant is not None:
+                shared.add(builder.base_version)
+
+            for name in TASKS:
+                if builder.variant is not None and name in SHARED_TASKS:
+                    continue
+
+                task = Task(version, name)
+
+                if builder.is_task_done(name):
+                    task.state = 'done'
+
+                self.tasks[task.key] = task
+
+        for version in shared:
+            builder = builders.get(version)
+
+            if builder is None:
+                builder = Builder(version, read_only)
+                builder.invalidate()
+
+            for name in SHARED_TASKS:
+                task = Task(version, name)
+
+                if builder.is_task_done(name, shared=True):
+                    task.state = 'done'
+
+                self.tasks[task.key] = task
+
+            restore = self.tasks.get((version, 'restore'))
+
+            # Restoring and unpacking at once would race for the build state
+            if restore is not None:
+                restore.deps.append((version, 'unpack'))
+
+        predictor = Predictor()
+
+        for task in self.get_tasks('pending'):
+            task.estimate = predictor.estimate(task.version, task.name)
+
+        for task in self.tasks.itervalues():
+            self.get_priority(task)
+
+    def get_priority(self, task):
+        """Computes the task priority, i. e. the longest expected path
+        through the pending tasks depending on it.
+
+        @param task: task
+        """
+
+        if task.priority or task.state != 'pending':
+            return task.priority
+
+        dependents = [self.get_priority(other)
+                      for other in self.get_tasks('pending')
+                      if task.key in other.deps]
+
+        task.priority = task.estimate + max(dependents or [0.])
+
+        return task.priority
+
+    def get_remaining(self, version):
+        """Returns the expected time left to build a version.
+
+        @param version: build name
+        """
+
+        base_version = split_build(version)[0]
+
+        return max([task.priority for task in self.tasks.itervalues()
+                    if task.version == version or
+                    (task.version == base_version and
+                     task.name in SHARED_TASKS)] or [0.])
+
+    def get_tasks(self, state):
+        """Returns the tasks in a given state.
+
+        @param state: task state string
+        """
+
+        return [task for task in self.tasks.itervalues()
+                if task.state == state]
+
+    def get_ready(self):
+        """Returns the pending tasks with all the dependencies done, the
+        highest priority first.
+        """
+
+        ready = [task for task in self.get_tasks('pending')
+                 if all(self.tasks[dep].state == 'done' for dep in task.deps)]
+
+        return sorted(ready, key=lambda task: task.priority, reverse=True)
+
+    def get_free_slots(self, resource):
+        """Returns the number of free slots of a resource class.
+
+        @param resource: resource class name
+        """
+
+        running = sum(1 for task in self.get_tasks('running')
+                      if task.resource == resource)
+
+        return self.resources.get(resource, 1) - running
+
+    def skip_dependents(self, failed):
+        """Marks all the pending tasks depending on a failed one as skipped.
+
+        @param failed: failed task
+        """
+
+        for task in self.get_tasks('pending'):
+            if failed.key in task.deps:
+                task.state = 'skipped'
+                self.skip_dependents(task)
+
+    def log_schedule(self):
+        """Logs the current schedule state.
+        """
+
+        counts = collections.Counter(task.state
+                                     for task in self.tasks.itervalues())
+        running = ", ".join(str(task) for task in self.get_tasks('running'))
+
+        logger.info("Schedule: running [{0}], ready {1}, pending {2}, "
+                    "done {3}, failed {4}, skipped {5}, cancelled {6}"
+                    .format(running, len(self.get_ready()),
+                            counts['pending'], counts['done'],
+                            counts['failed'], counts['skipped'],
+                            counts['cancelled']))
+
+    def start(self, pool, task):
+        """Starts a task in the pool.
+
+        @param pool: process pool
+        @param task: task to start
+        """
+
+        task.state = 'running'
+        task.started = time.time()
+
+        callback = lambda success: self.results.put((task, success))
+        pool.apply_async(_run_task, task.key, callback=callback)
+
+    def finish(self, task, success):
+        """Updates the schedule with a finished task.
+
+        @param task: finished task
+        @param success: True if the task succeeded
+        """
+
+        task.finished = time.time()
+        duration = task.finished - task.started
+
+        if success:
+            task.state = 'done'
+            logger.info("Task {0} finished in {1:.2f}s"
+                        .format(task, duration))
+        else:
+            task.state = 'failed'
+            logger.error("Task {0} failed in {1:.2f}s"
+                         .format(task, duration))
+            self.skip_dependents(task)
+
+    def cancel(self, pool, timeout=CLEANUP_TIMEOUT):
+        """Cancels the pending and the running tasks terminating the pool
+        workers' processes.
+
+        @param pool: process pool
+        @param timeout: seconds to wait for the running tasks to clean up
+            before the workers are terminated
+        """
+
+        running = self.get_tasks('running')
+
+        logger.warning("Cancelling {0} running and {1} pending task(s)"
+                       .format(len(running), len(self.get_tasks('pending'))))
+
+        for task in running + self.get_tasks('pending'):
+            task.state = 'cancelled'
+
+        # Compilers and the like go first, so the workers see them failing
+        # and clean up
+        for worker in multiprocessing.active_children():
+            kill_tree(worker.pid)
+
+        # The workers are only terminated after their tasks return, a SIGTERM
+        # in the middle of the cleanup would leave tmpfs and bind mounts
+        # behind
+        deadline = time.time() + timeout
+        waiting = set(running)
+
+        while waiting and time.time() < deadline:
+            try:
+                task, _ = self.results.get(timeout=max(0., deadline -
+                                                       time.time()))
+            except Queue.Empty:
+                break
+
+            waiting.discard(task)
+
+        if waiting:
+            logger.warning("Terminating {0} task(s) still cleaning up: {1}"
+                           .format(len(waiting),
+                                   ", ".join(str(task) for task in waiting)))
+
+        pool.terminate()
+
+    def plan(self):
+        """Simulates the schedule with the expected task durations.
+
+        @return: tuple of (list of (task, start, finish) tuples, total time)
+        """
+
+        states = dict((key, task.state)
+                      for key, task in self.tasks.iteritems())
+        timeline = []
+        running = []  # (finish, task) list
+        clock = 0.
+
+        try:
+            while True:
+                for task in self.get_ready():
+                    if self.get_free_slots(task.resource) > 0:
+                        task.state = 'running'
+                        running.append((clock + task.estimate, task))
+                        timeline.append((task, clock,
+                                         clock + task.estimate))
+
+                if not running:
+                    break
+
+                running.sort(key=lambda item: item[0])
+                clock, task = running.pop(0)
+                task.state = 'done'
+        finally:
+            for key, state in states.iteritems():
+                self.tasks[key].state = state
+
+        return timeline, clock
+
+    def log_plan(self):
+        """Logs the projected schedule.
+        """
+
+        timeline, total = self.plan()
+
+        for version in self.versions:
+            logger.info("VLC {0}: about {1:.0f}s of work left"
+                        .format(version, self.get_remaining(version)))
+
+        for task, start, finish in timeline:
+            logger.info("{0:>8.0f}s - {1:>8.0f}s  {2} ({3})"
+                        .format(start, finish, task, task.resource))
+
+        logger.info("Projected total time: {0:.0f}s".format(total))
+
+    def run(self):
+        """Runs the tasks until there's nothing to run.
+
+        @return: list of failed build names
+        """
+
+        # One process per task to get per-task resource usage
+        pool = Pool(processes=sum(self.resources.values()),
+                    initializer=_init_worker, maxtasksperchild=1)
+
+        cancelled = False
+
+        while True:
+            for task in self.get_ready():
+                if self.get_free_slots(task.resource) > 0:
+                    self.start(pool, task)
+
+            if not self.get_tasks('running'):
+                break
+
+            self.log_schedule()
+
+            while True:
+                try:
+                    # Timeout keeps the loop interruptible
+                    task, success = self.results.get(timeout=1.)
+                except Queue.Empty:
+                    continue
+                break
+
+            self.finish(task, success)
+
+            if not success and self.on_error == 'fail-fast':
+                self.cancel(pool)
+                cancelled = True
+                break
+
+        if not cancelled:
+            pool.close()
+
+        pool.join()
+
+        failed = set(task.version for task in self.tasks.itervalues()
+                     if task.state in ('failed', 'skipped', 'cancelled'))
+
+        return [version for version in self.versions if version in failed]
+
+
+def schedule(versions, on_error=None):
+    """Builds VLC versions running their stages in parallel.
+
+    @param versions: build names list
+    @param on_error: build error policy, the configured one by default
+
+    @return: list of failed build names
+    """
+
+    return Scheduler(versions, on_error or get_error_policy()).run()
+
+
+def plan(versions):
+    """Logs the projected build schedule without building anything.
+
+    @param versions: build names list
+    """
+
+    Scheduler(versions, read_only=True).log_plan()
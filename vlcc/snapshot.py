@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import os
+import shutil
+import subprocess
+import time
+
+from .core import options, fail_with_error
+from .conf import config
+
+
+__all__ = ['SnapshotStore']
+
+
+# tar options preserving everything overlayfs upper directories contain,
+# i. e. whiteout devices and opaque directory xattrs
+TAR_OPTIONS = ['--numeric-owner', '--xattrs', '--xattrs-include=trusted.*']
+
+
+class SnapshotStore(object):
+    """Jail snapshots of a VLC build, one per build state.
+
+    Overlay jails are snapshotted by archiving the upper directory only,
+    plain jails are copied with reflinks if the file system supports them,
+    or archived entirely otherwise. Every snapshot is accompanied by the
+    build state fingerprints it has been taken at.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.root = os.path.join(options.build_dir, 'snap-' + version)
+
+    def get_path(self, state, suffix=''):
+        """Returns a snapshot path.
+
+        @param state: build state name
+        @param suffix: path suffix
+        """
+
+        return os.path.join(self.root, state + suffix)
+
+    def get_states(self):
+        """Returns the states there are snapshots of.
+        """
+
+        if not os.path.isdir(self.root):
+            return []
+
+        return sorted(filename[:-len('.json')]
+                      for filename in os.listdir(self.root)
+                      if filename.endswith('.json'))
+
+    def get_manifest(self, state):
+        """Loads a snapshot manifest, returns None if there's no snapshot.
+
+        @param state: build state name
+        """
+
+        try:
+            with open(self.get_path(state, '.json')) as manifest_file:
+                return json.load(manifest_file)
+        except IOError:
+            return None
+
+    def remove(self, state):
+        """Removes a snapshot.
+
+        @param state: build state name
+        """
+
+        for suffix in ['.json', '.tar']:
+            path = self.get_path(state, suffix)
+
+            if os.path.exists(path):
+                os.unlink(path)
+
+        if os.path.isdir(self.get_path(state)):
+            shutil.rmtree(self.get_path(state))
+
+    def take(self, state, jail, fingerprints):
+        """Snapshots the jail replacing the state's previous snapshot.
+
+        @param state: build state name
+        @param jail: jail to snapshot
+        @param fingerprints: build state fingerprints dict
+        """
+
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass
+
+        self.remove(state)
+
+        started = time.time()
+
+        if jail.is_overlay():
+            mode = 'overlay'
+            jail.exec_command(['tar', '-C', jail.upper_dir] + TAR_OPTIONS +
+                              ['-cf', self.get_path(state, '.tar'), '.'])
+        elif self.copy(jail, jail.chroot_dir, self.get_path(state)):
+            mode = 'reflink'
+        else:
+            mode = 'tar'
+            jail.exec_command(['tar', '-C', jail.chroot_dir] + TAR_OPTIONS +
+                              ['-cf', self.get_path(state, '.tar'), '.'])
+
+        manifest = dict(state=state, mode=mode, fingerprints=fingerprints,
+                        fingerprint=jail.get_fingerprint())
+
+        with open(self.get_path(state, '.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+
+        jail.logger.info("Took {0} snapshot of state `{1}` in {2:.2f}s"
+                         .format(mode, state, time.time() - started))
+
+    def copy(self, jail, src, dest):
+        """Copies a tree with reflinks.
+
+        @param jail: jail to run the copying with
+        @param src: source tree path
+        @param dest: destination tree path
+
+        @return: False if the file system doesn't support reflinks
+        """
+
+        if config.get('snapshots') == 'tar':
+            return False
+
+        process = jail.exec_command(['cp', '-a', '--reflink=always',
+                                     src, dest], async=True,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        process.communicate()
+
+        if 0 != process.returncode:
+            shutil.rmtree(dest, ignore_errors=True)
+            return False
+
+        return True
+
+    def restore(self, state, jail):
+        """Replaces a jail with a snapshot.
+
+        @param state: build state name
+        @param jail: jail to restore into, may belong to another version
+
+        @return: build state fingerprints dict the snapshot has been taken at
+        """
+
+        manifest = self.get_manifest(state)
+
+        if manifest is None:
+            fail_with_error("There's no `{0}` snapshot of VLC {1}, available "
+                            "are: {2}".format(state, self.version,
+                                              ", ".join(self.get_states())
+                                              or "none"))
+
+        if manifest['fingerprint'] != jail.get_fingerprint():
+            fail_with_error("VLC {0} jail root FS differs from the snapshot "
+                            "one".format(self.version))
+
+        jail.destroy()
+
+        if manifest['mode'] == 'overlay':
+            jail.create_base()
+
+            for path in [jail.upper_dir, jail.work_dir, jail.chroot_dir]:
+                os.makedirs(path)
+
+            jail.exec_command(['tar', '-C', jail.upper_dir] + TAR_OPTIONS +
+                              ['-xpf', self.get_path(state, '.tar')])
+            jail.prepare()
+        elif manifest['mode'] == 'reflink':
+            jail.exec_command(['cp', '-a', '--reflink=auto',
+                               self.get_path(state), jail.chroot_dir])
+        else:
+            os.makedirs(jail.chroot_dir)
+            jail.exec_command(['tar', '-C', jail.chroot_dir] + TAR_OPTIONS +
+                              ['-xpf', self.get_path(state, '.tar')])
+
+        jail.logger.info("Restored the jail from `{0}` snapshot of VLC {1}"
+                         .format(state, self.version))
+
+        return manifest['fingerprints']
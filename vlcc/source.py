@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import hashlib
+
+import os
+import time
+import shutil
+import threading
+import subprocess
+
+from .core import options, fail_with_error
+from .conf import config
+from .store import Store
+from .db import db
+from .download import ChunkedDownload, Mirror
+
+
+__all__ = ['Source']
+
+
+class Source(object):
+    """VLC sources archive kept in the persistent source store.
+
+    Archives are stored by their sha256 digest and reused by all the build
+    directories. Downloads are resumable: a partially downloaded archive is
+    kept in the store until it's complete.
+
+    While an archive is being downloaded, it's decompressed and extracted
+    into the staging directory on the fly. The extracted tree is only used
+    once the whole archive checksum is verified.
+
+    Archives are downloaded with wget, or in parallel chunks from all the
+    mirrors if `download_mirrors` are configured, see
+    vlcc.download.ChunkedDownload.
+    """
+
+    # Read chunk size for streaming extraction
+    chunk_size = 1 << 20
+
+    def __init__(self, version, jail):
+        """Initializes the source.
+
+        @param version: VLC version string
+        @param jail: build jail object, used to execute commands
+        """
+
+        self.version = version
+        self.jail = jail
+        self.logger = jail.logger
+        self.store = Store('sources')
+
+        self.ext = '.tar.' + ('xz' if version[0] == '2' else 'bz2')
+        self.filename = 'vlc-' + version + self.ext
+        self.url = self.get_url(config['download_url'])
+
+        self.partial_path = os.path.join(self.store.root,
+                                         self.filename + '.part')
+        self.index_path = os.path.join(self.store.root,
+                                       self.filename + '.sha256')
+        self.ready_dir = os.path.join(options.build_dir, 'src-' + version)
+        self.staging_dir = self.ready_dir + '.partial'
+
+        self.process = None
+        self.lock_file = None
+        self.started = self.finished = None
+        self.initial_size = 0
+
+        # Streaming extraction results
+        self.digest = None
+        self.extracted = False
+
+    def get_url(self, base_url):
+        """Returns the archive URL on a mirror.
+
+        @param base_url: mirror base URL
+        """
+
+        return "/".join((base_url.rstrip('/'), self.version, self.filename))
+
+    def get_available(self, archive):
+        """Returns the downloaded archive size safe to read.
+
+        @param archive: partial archive file object
+        """
+
+        if isinstance(self.process, ChunkedDownload):
+            # The file is preallocated, only the contiguous prefix is there
+            return self.process.get_available()
+
+        return os.fstat(archive.fileno()).st_size
+
+    def get_digest(self):
+        """Returns the expected archive sha256 digest, either configured or
+        known from a previous download, or None.
+        """
+
+        digest = config['versions'][self.version].get('sha256')
+
+        if digest is None and os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                digest = index_file.read().strip()
+
+        return digest
+
+    def get_path(self):
+        """Returns the stored archive path or None if it's not stored yet.
+        """
+
+        digest = self.get_digest()
+
+        if digest is not None and self.store.has(digest, self.ext):
+            return self.store.get_path(digest, self.ext)
+
+        return None
+
+    def record(self, digest, size, seconds, cached):
+        """Saves the fetch statistics into the DB.
+
+        @param digest: archive sha256 digest
+        @param size: downloaded bytes number
+        @param seconds: download duration
+        @param cached: True if the archive has been taken from the store
+        """
+
+        db.execute("INSERT INTO download "
+                   "(build_version, sha256, bytes, seconds, cached) "
+                   "VALUES (?, ?, ?, ?, ?)",
+                   [self.version, digest, size, seconds, cached])
+
+    def open_tar(self):
+        """Starts tar extracting an archive from its stdin into the clean
+        staging directory.
+
+        @return: process instance
+        """
+
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        os.makedirs(self.staging_dir)
+
+        flag = '-J' if self.ext.endswith('xz') else '-j'
+        command = ['tar', '-C', self.staging_dir, '-x', flag, '-f', '-']
+
+        return self.jail.exec_command(command, async=True,
+                                      stdin=subprocess.PIPE)
+
+    def _stream(self):
+        """Feeds the growing partial archive to tar while wget is still
+        downloading it, computing the archive digest on the way.
+        """
+
+        tar = self.open_tar()
+        digest = hashlib.sha256()
+        tar_failed = False
+
+        with open(self.partial_path, 'rb') as archive:
+            while True:
+                # Checking wget before reading not to miss the last bytes
+                if self.finished is None and self.process.poll() is not None:
+                    self.finished = time.time()
+
+                # A negative size would read up to EOF
+                chunk = archive.read(max(0, min(self.chunk_size,
+                                                self.get_available(archive) -
+                                                archive.tell())))
+
+                if chunk:
+                    digest.update(chunk)
+
+                    if not tar_failed:
+                        try:
+                            tar.stdin.write(chunk)
+                        except IOError as e:
+                            if e.errno != errno.EPIPE:
+                                raise
+                            tar_failed = True
+                elif self.finished is not None:
+                    break
+                else:
+                    time.sleep(.1)
+
+        try:
+            tar.stdin.close()
+        except IOError:
+            pass
+
+        self.digest = digest.hexdigest()
+        self.extracted = 0 == tar.wait() and not tar_failed
+
+    def is_extracted(self):
+        """Checks whether the verified extracted tree is ready to be moved
+        into the jail.
+        """
+
+        return os.path.isdir(self.ready_dir)
+
+    def promote(self):
+        """Marks the extracted tree in the staging directory as verified.
+        """
+
+        shutil.rmtree(self.ready_dir, ignore_errors=True)
+        os.rename(self.staging_dir, self.ready_dir)
+
+    def extract(self, path):
+        """Extracts a stored archive into the ready directory.
+
+        @param path: archive path
+        """
+
+        tar = self.open_tar()
+
+        with open(path, 'rb') as archive:
+            shutil.copyfileobj(archive, tar.stdin, self.chunk_size)
+
+        tar.stdin.close()
+        self.extracted = 0 == tar.wait()
+
+        if not self.extracted:
+            self.discard()
+            fail_with_error("Unable to extract " + path)
+
+        self.promote()
+
+    def discard(self):
+        """Removes a partially extracted tree.
+        """
+
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        self.extracted = False
+
+    def start(self):
+        """Starts downloading the archive with wget unless it's stored.
+        """
+
+        if self.get_path() is not None:
+            return
+
+        if getattr(options, 'offline', False):
+            fail_with_error("VLC {0} sources archive is not in the source "
+                            "store, unable to download it in offline mode"
+                            .format(self.version))
+
+        self.lock_file = open(self.partial_path + '.lock', 'w')
+
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # Another build is downloading the same archive
+            self.logger.info("Waiting for {0} to be downloaded by another "
+                             "build".format(self.filename))
+            return
+
+        self.started = time.time()
+
+        if not (config.get('download_mirrors') and self.start_chunked()):
+            self.start_wget()
+
+        self.thread = threading.Thread(target=self._stream)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def start_wget(self):
+        """Starts downloading the archive with a single wget connection.
+        """
+
+        if os.path.exists(self.partial_path + '.chunks'):
+            # wget would resume a sparse chunked download from its end
+            os.unlink(self.partial_path + '.chunks')
+            os.unlink(self.partial_path)
+
+        if os.path.exists(self.partial_path):
+            self.initial_size = os.path.getsize(self.partial_path)
+        else:
+            open(self.partial_path, 'wb').close()
+
+        command = ['wget', '-c', '--tries=3', '--timeout=60',
+                   '-O', self.partial_path, self.url]
+
+        self.logger.info("Starting download from " + self.url)
+
+        self.process = self.jail.exec_command(command, async=True)
+
+    def start_chunked(self):
+        """Starts downloading the archive in parallel chunks from
+        `download_url` and `download_mirrors`.
+
+        @return: False if none of the mirrors serves byte ranges
+        """
+
+        base_urls = [config['download_url']] + [
+            base_url for base_url in config['download_mirrors']
+            if base_url != config['download_url']]
+        mirrors = [Mirror(base_url, self.get_url(base_url))
+                   for base_url in base_urls]
+
+        self.process = ChunkedDownload(mirrors, self.partial_path,
+                                       self.logger,
+                                       config.get('download_connections', 4))
+
+        self.logger.info("Starting download of {0} from {1} mirror(s)"
+                         .format(self.filename, len(mirrors)))
+
+        if not self.process.start():
+            self.logger.warning("None of the mirrors serves byte ranges of "
+                                "{0}, downloading it with wget"
+                                .format(self.filename))
+            self.process = None
+            return False
+
+        self.initial_size = self.process.initial_size
+
+        return True
+
+    def finish(self):
+        """Waits for the download to finish, verifies the archive and puts
+        it into the store.
+
+        If the archive has been extracted while downloading, the verified
+        tree is left in the ready directory, see is_extracted().
+
+        @return: stored archive path
+        """
+
+        if self.process is None:
+            if self.lock_file is not None:
+                # Waiting for another build to finish the download
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+                self.lock_file.close()
+
+            path = self.get_path()
+
+            if path is None:
+                fail_with_error("Download of {0} by another build failed"
+                                .format(self.filename))
+
+            self.logger.info("Using stored sources archive " + path)
+            self.record(self.get_digest(), 0, 0., True)
+            return path
+
+        self.thread.join()
+
+        if isinstance(self.process, ChunkedDownload):
+            self.process.report()
+
+        if 0 != self.process.returncode:
+            self.discard()
+            fail_with_error("Download failed :-(")
+
+        digest = self.digest
+        expected = config['versions'][self.version].get('sha256')
+
+        if expected is not None and expected != digest:
+            self.discard()
+            os.unlink(self.partial_path)
+            fail_with_error("Checksum mismatch for {0}: expected {1}, "
+                            "got {2}".format(self.filename, expected, digest))
+
+        size = os.path.getsize(self.partial_path) - self.initial_size
+        seconds = self.finished - self.started
+
+        path = self.store.commit(self.partial_path, digest, self.ext)
+
+        with open(self.index_path, 'w') as index_file:
+            index_file.write(digest)
+
+        self.lock_file.close()
+
+        self.logger.info("Downloaded {0} bytes in {1:.2f}s"
+                         .format(size, seconds))
+        self.record(digest, size, seconds, False)
+
+        if self.extracted:
+            self.promote()
+        else:
+            self.logger.warning("Streaming extraction failed, "
+                                "retrying from the stored archive")
+            self.discard()
+
+        return path
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+
+import os
+
+from .core import fail_with_error
+from .conf import config
+
+
+__all__ = ['Store', 'fingerprint', 'file_digest']
+
+
+def fingerprint(*items):
+    """Returns a stable hex digest of the given JSON-serializable items.
+
+    @param items: objects to fingerprint
+    """
+
+    data = json.dumps(items, sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
+
+
+def file_digest(path, algorithm='sha256', chunk_size=1 << 20):
+    """Returns hex digest of a file contents.
+
+    @param path: file path
+    @param algorithm: hashlib algorithm name
+    @param chunk_size: read chunk size in bytes
+    """
+
+    digest = hashlib.new(algorithm)
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class Store(object):
+    """Simple keyed file store living in the cache directory.
+
+    Entries are written to a temporary path first and then atomically
+    committed, so concurrent builds never see half-written files.
+    """
+
+    def __init__(self, name):
+        """Initializes the store.
+
+        @param name: store subdirectory name
+        """
+
+        self.root = os.path.join(config.get('cache_dir', './cache/'), name)
+
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass
+
+    def get_path(self, key, suffix=''):
+        """Returns the entry path.
+
+        @param key: entry key
+        @param suffix: file name suffix, i. e. extension
+        """
+
+        return os.path.join(self.root, key + suffix)
+
+    def has(self, key, suffix=''):
+        """Checks whether the entry exists.
+
+        @param key: entry key
+        @param suffix: file name suffix
+        """
+
+        return os.path.exists(self.get_path(key, suffix))
+
+    def get_temp_path(self, key, suffix=''):
+        """Returns a process-unique path to write the entry to before
+        committing it.
+
+        @param key: entry key
+        @param suffix: file name suffix
+        """
+
+        return os.path.join(self.root, ".{0}{1}.{2}"
+                            .format(key, suffix, os.getpid()))
+
+    def commit(self, temp_path, key, suffix=''):
+        """Atomically moves a written temporary file into the store.
+
+        @param temp_path: path returned by get_temp_path()
+        @param key: entry key
+        @param suffix: file name suffix
+
+        @return: entry path
+        """
+
+        path = self.get_path(key, suffix)
+
+        try:
+            os.rename(temp_path, path)
+        except OSError as e:
+            fail_with_error("Unable to store {0} in {1}, "
+                            "the message was: `{2}`"
+                            .format(temp_path, path, e.strerror))
+        return path
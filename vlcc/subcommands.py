@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from .core import logger, options, argparser, initialize, fail_with_error
+from .conf import config, has_build, split_build
+from .artifact import ArtifactStore
+from .pool import WarmPool
+from .build import Builder, STATES
+from .gc import collect_garbage
+
+
+__all__ = ['subcommands']
+
+
+def add_artifact_arguments(command):
+    """Adds export/import subcommands arguments.
+
+    @param command: subcommand name
+    """
+
+    argparser.add_argument('command', metavar='COMMAND', choices=[command],
+                           help="subcommand name")
+    argparser.add_argument('store_dir', metavar='STORE_DIR',
+                           help="artifacts store directory to {0}"
+                           .format('export to' if command == 'export'
+                                   else 'import from'))
+    argparser.add_argument('versions', metavar='VERSION',
+                           type=str.lower, nargs='*',
+                           help="VLC version number, all by default")
+
+
+def export_artifacts():
+    """Exports installed VLC artifacts into another store directory.
+    """
+
+    add_artifact_arguments('export')
+    initialize()
+
+    count = ArtifactStore().export(options.store_dir, options.versions)
+    logger.info("Exported {0} artifact(s) to {1}"
+                .format(count, options.store_dir))
+
+
+def import_artifacts():
+    """Imports installed VLC artifacts from another store directory.
+    """
+
+    add_artifact_arguments('import')
+    initialize()
+
+    count = ArtifactStore().import_(options.store_dir, options.versions)
+    logger.info("Imported {0} artifact(s) from {1}"
+                .format(count, options.store_dir))
+
+
+def add_build_dir_argument():
+    """Adds the build directory argument shared with the build command.
+    """
+
+    argparser.add_argument('-b', '--build-dir', dest='build_dir',
+                           default="./build/",
+                           help="build directory path, `./build/` by default")
+
+
+def serve_pool():
+    """Keeps warm jails ready for the builds in background.
+    """
+
+    argparser.add_argument('command', metavar='COMMAND', choices=['pool'],
+                           help="subcommand name")
+    argparser.add_argument('-n', '--size', dest='size', type=int,
+                           default=None,
+                           help="warm jails number per root FS, "
+                                "`warm_jails` config option by default")
+    argparser.add_argument('--max-load', dest='max_load', type=float,
+                           default=None,
+                           help="load average to create jails below, "
+                                "a half of CPUs number by default")
+    argparser.add_argument('--interval', dest='interval', type=float,
+                           default=60.,
+                           help="idle check interval, 60 seconds by default")
+    argparser.add_argument('--once', action="store_true",
+                           dest='once', default=False,
+                           help="fill the pool and exit")
+    add_build_dir_argument()
+
+    initialize()
+
+    if os.getuid() != 0:
+        fail_with_error("Root privileges are required to run this script")
+
+    size = options.size
+
+    if size is None:
+        size = config.get('warm_jails', 1)
+
+    WarmPool().serve(size, interval=options.interval,
+                     max_load=options.max_load, once=options.once)
+
+
+def add_snapshot_arguments(command):
+    """Adds rollback/branch subcommands arguments.
+
+    @param command: subcommand name
+    """
+
+    argparser.add_argument('command', metavar='COMMAND', choices=[command],
+                           help="subcommand name")
+    argparser.add_argument('version', metavar='VERSION', type=str.lower,
+                           help="VLC version number")
+    argparser.add_argument('state', metavar='STATE', choices=STATES[1:],
+                           help="build state snapshot to start from, one of "
+                                "{0}".format(", ".join(STATES[1:])))
+
+    if command == 'branch':
+        argparser.add_argument('new_version', metavar='NEW_VERSION',
+                               type=str.lower,
+                               help="VLC version number to build from the "
+                                    "snapshot")
+
+    add_build_dir_argument()
+
+    initialize()
+
+    if os.getuid() != 0:
+        fail_with_error("Root privileges are required to run this script")
+
+    for version in [options.version, getattr(options, 'new_version', None)]:
+        if version is not None and not has_build(version):
+            fail_with_error("VLC version {0} description not found in {1}"
+                            .format(version, options.config))
+
+        if version is not None and split_build(version)[1] is not None:
+            fail_with_error("Variant {0} shares the version's jail, snapshots "
+                            "are taken of versions only".format(version))
+
+
+def rollback():
+    """Rolls a VLC build back to a build state snapshot.
+    """
+
+    add_snapshot_arguments('rollback')
+    Builder(options.version).rollback(options.state)
+
+
+def branch():
+    """Starts another VLC build from a build state snapshot.
+    """
+
+    add_snapshot_arguments('branch')
+    Builder(options.version).branch(options.state, options.new_version)
+
+
+def gc():
+    """Removes what the retention policies drop from the build directory
+    and accounts the disk usage.
+    """
+
+    argparser.add_argument('command', metavar='COMMAND', choices=['gc'],
+                           help="subcommand name")
+    argparser.add_argument('-n', '--dry-run', action="store_true",
+                           dest='dry_run', default=False,
+                           help="only report what would be removed")
+    add_build_dir_argument()
+
+    initialize()
+
+    if os.getuid() != 0:
+        fail_with_error("Root privileges are required to run this script")
+
+    collect_garbage(options.dry_run)
+
+
+# vlcc-run subcommand name -> entry point function
+subcommands = {
+    'export': export_artifacts,
+    'import': import_artifacts,
+    'pool': serve_pool,
+    'rollback': rollback,
+    'branch': branch,
+    'gc': gc,
+}
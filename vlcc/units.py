@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import os
+import shutil
+
+from .conf import config
+from .db import db
+
+
+__all__ = ['CompileProfiler', 'get_slowest_units', 'get_directory_totals']
+
+
+# Wrapper script path inside jails
+WRAPPER_PATH = '/usr/local/lib/vlcc-ccwrap.py'
+
+# Slowest units logged after a build
+REPORTED_UNITS = 5
+
+
+class CompileProfiler(object):
+    """Per translation unit compile profiler of a build.
+
+    The compiler wrapper is installed into the jail and put in front of CC
+    and CXX at the configure time, so the generated makefiles run it. While
+    compiling, it logs the wall and CPU times, peak RSS and output size of
+    every compile and link invocation, the log is saved into
+    `compile_unit` table once the compilation is over.
+    """
+
+    def __init__(self, builder):
+        """Initializes the profiler.
+
+        @param builder: build to profile
+        """
+
+        self.builder = builder
+        self.jail = builder.jail
+        self.log_path = ('/var/log/vlcc-units-' +
+                         builder.version.replace(':', '-') + '.log')
+
+    def is_enabled(self):
+        """Checks whether the build is profiled, the wrapper requires Python
+        in the jail.
+        """
+
+        return (config.get('profile_compile', False) and
+                os.path.exists(self.jail.get_path('/usr/bin/python')))
+
+    def install(self):
+        """Copies the wrapper into the jail and removes the previous log.
+        """
+
+        script = os.path.join(os.path.dirname(__file__), 'misc/ccwrap.py')
+        shutil.copy2(script, self.jail.get_path(WRAPPER_PATH))
+
+        try:
+            os.unlink(self.jail.get_path(self.log_path))
+        except OSError:
+            pass
+
+    def wrap(self, env):
+        """Puts the wrapper in front of the compilers.
+
+        @param env: build environment dict to update
+        """
+
+        for name, default in [('CC', 'gcc'), ('CXX', 'g++')]:
+            env[name] = 'python {0} {1}'.format(WRAPPER_PATH,
+                                                env.get(name, default))
+
+    def get_env(self):
+        """Returns the environment turning the recording on.
+        """
+
+        return {
+            'VLCC_UNITS_LOG': self.log_path,
+            'VLCC_BUILD_DIR': self.builder.chroot_build_dir,
+        }
+
+    def record(self):
+        """Saves the logged invocations into the DB replacing the previous
+        compilation ones.
+        """
+
+        units = []
+
+        try:
+            with open(self.jail.get_path(self.log_path)) as log_file:
+                for line in log_file:
+                    try:
+                        units.append(json.loads(line))
+                    except ValueError:
+                        # Interrupted write
+                        continue
+        except IOError:
+            return
+
+        version = self.builder.version
+
+        db.execute("DELETE FROM compile_unit WHERE build_version=?",
+                   [version])
+
+        for unit in units:
+            db.execute("INSERT INTO compile_unit "
+                       "(build_version, unit, source, kind, wall_time, "
+                       "    cpu_time, max_rss, output_bytes) "
+                       "VALUES (:version, :unit, :source, :kind, "
+                       "    :wall_time, :cpu_time, :max_rss, :output_bytes)",
+                       dict(unit, version=version))
+
+        self.builder.build_logger.info(
+            "Profiled {0} compile and link invocation(s), {1:.2f}s CPU"
+            .format(len(units), sum(unit['cpu_time'] for unit in units)))
+
+        for unit in get_slowest_units(version, REPORTED_UNITS):
+            self.builder.build_logger.info(
+                "{0[wall_time]:>8.2f}s  {0[unit]}".format(unit))
+
+
+def get_slowest_units(version, limit):
+    """Returns the slowest compile and link invocations of a build.
+
+    @param version: build name
+    @param limit: units number
+
+    @return: list of dicts
+    """
+
+    cursor = db.query("SELECT unit, source, kind, wall_time, cpu_time, "
+                      "    max_rss, output_bytes "
+                      "FROM compile_unit WHERE build_version=? "
+                      "ORDER BY wall_time DESC LIMIT ?", [version, limit])
+    names = [column[0] for column in cursor.description]
+
+    # The web interface fetches dicts
+    return [row if isinstance(row, dict) else dict(zip(names, row))
+            for row in cursor.fetchall()]
+
+
+def get_directory_totals(version):
+    """Sums the invocations up per build tree directory, i. e. per VLC
+    module.
+
+    @param version: build name
+
+    @return: dict of directory -> dict of count, wall_time and cpu_time
+    """
+
+    cursor = db.query("SELECT unit, wall_time, cpu_time FROM compile_unit "
+                      "WHERE build_version=?", [version])
+    totals = {}
+
+    for row in cursor.fetchall():
+        if isinstance(row, dict):
+            row = (row['unit'], row['wall_time'], row['cpu_time'])
+
+        unit, wall_time, cpu_time = row
+        # libtool puts PIC objects and libraries into .libs
+        directory = os.path.dirname(unit).replace('/.libs', '')
+        directory = '.' if directory in ('', '.libs') else directory
+
+        entry = totals.setdefault(directory, dict(count=0, wall_time=0.,
+                                                  cpu_time=0.))
+        entry['count'] += 1
+        entry['wall_time'] += wall_time
+        entry['cpu_time'] += cpu_time
+
+    return totals
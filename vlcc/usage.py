@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import resource
+import time
+
+
+__all__ = ['Usage', 'account']
+
+
+# Block size of ru_inblock and ru_oublock counters
+BLOCK_SIZE = 512
+
+# Summary resource usage of the processes that aren't children of this one
+_foreign = dict(user_time=0., sys_time=0., max_rss=0, read_blocks=0,
+                write_blocks=0)
+
+
+def account(usage):
+    """Adds the resource usage of a finished process that isn't a child of
+    this one, i. e. of a command run by the in-jail agent.
+
+    @param usage: dict of user_time, sys_time, max_rss, read_blocks and
+        write_blocks
+    """
+
+    for key in ['user_time', 'sys_time', 'read_blocks', 'write_blocks']:
+        _foreign[key] += usage.get(key, 0)
+
+    _foreign['max_rss'] = max(_foreign['max_rss'], usage.get('max_rss', 0))
+
+
+class Usage(object):
+    """Resource usage meter for the current process and its child tree.
+
+    Child processes are only accounted after they are waited for. Peak RSS
+    is the maximum over all the children of the process lifetime, so it's
+    exact for processes running a single stage, like the scheduler's ones.
+    The commands run by the in-jail agent are accounted with account().
+    """
+
+    def __init__(self):
+        self.start = self.snapshot()
+
+    @staticmethod
+    def snapshot():
+        """Returns current wall time and summary resource usage.
+        """
+
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        return dict(
+            wall_time=time.time(),
+            user_time=(own.ru_utime + children.ru_utime +
+                       _foreign['user_time']),
+            sys_time=own.ru_stime + children.ru_stime + _foreign['sys_time'],
+            # Kilobytes on Linux
+            max_rss=max(children.ru_maxrss * 1024, _foreign['max_rss']),
+            read_bytes=(own.ru_inblock + children.ru_inblock +
+                        _foreign['read_blocks']) * BLOCK_SIZE,
+            write_bytes=(own.ru_oublock + children.ru_oublock +
+                         _foreign['write_blocks']) * BLOCK_SIZE,
+        )
+
+    def get(self):
+        """Returns resource usage since the meter creation.
+        """
+
+        current = self.snapshot()
+
+        usage = dict((key, current[key] - self.start[key])
+                     for key in current)
+        usage['max_rss'] = current['max_rss']
+
+        return usage
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import signal
+
+from multiprocessing import Process
+
+from .core import logger, options, argparser
+from .core import initialize, fail_with_error
+from .conf import config, has_build
+from .db import db
+from .build import Builder, get_state
+from .schedule import schedule, kill_tree, exit_on_sigterm
+from .artifact import ArtifactStore
+from .jobserver import start_jobserver
+from .jobs import JobQueue, POLL_INTERVAL, get_shared_store, get_worker_name
+
+
+__all__ = ['main', 'work']
+
+
+def _build(version):
+    """Builds a VLC version in a child process.
+
+    @param version: VLC version string
+    """
+
+    db.connect()
+    exit_on_sigterm()
+    sys.exit(1 if schedule([version]) else 0)
+
+
+def run_job(queue, job):
+    """Builds a claimed job's version reporting the progress and publishes
+    the artifact into the shared store.
+
+    @param queue: job queue
+    @param job: job row
+    """
+
+    version = job['version']
+
+    if not has_build(version):
+        return queue.finish(job['id'], message="VLC {0} description not "
+                            "found in {1}".format(version, options.config))
+
+    logger.info("Building VLC {0}, job {1}".format(version, job['id']))
+
+    process = Process(target=_build, args=(version,))
+    process.start()
+
+    while process.is_alive():
+        if not queue.report(job['id'], get_state(version)):
+            logger.warning("VLC {0} job {1} has been cancelled"
+                           .format(version, job['id']))
+            kill_tree(process.pid)
+            process.terminate()
+            process.join(POLL_INTERVAL)
+
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+            return
+
+        process.join(POLL_INTERVAL)
+
+    queue.report(job['id'], get_state(version))
+
+    if process.exitcode != 0:
+        return queue.finish(job['id'], message="Build failed, see {0} logs"
+                            .format(options.build_dir))
+
+    store = ArtifactStore()
+    fingerprint = Builder(version).get_fingerprints()['installed']
+    digest = store.find(version, fingerprint)
+
+    if digest is None:
+        return queue.finish(job['id'], message="No artifact stored")
+
+    store.export(get_shared_store(), [version])
+    queue.finish(job['id'], artifact=digest)
+
+    logger.info("Published VLC {0} artifact {1}".format(version, digest))
+
+
+def work(once=False):
+    """Claims and runs the queued build jobs.
+
+    @param once: exit when the queue is empty if True
+    """
+
+    queue = JobQueue()
+    worker = options.name or get_worker_name()
+
+    logger.info("Worker {0} is waiting for jobs in {1}"
+                .format(worker, queue.path))
+
+    while True:
+        job = queue.claim(worker)
+
+        if job is not None:
+            run_job(queue, job)
+        elif once:
+            return
+        else:
+            time.sleep(POLL_INTERVAL)
+
+
+def main():
+    """VLCC build worker entry point function.
+    """
+
+    argparser.add_argument('-b', '--build-dir', dest='build_dir',
+                           default="./build/",
+                           help="build directory path, `./build/` by default")
+    argparser.add_argument('--queue', dest='queue', default=None,
+                           help="shared job queue DB path, `job_queue` "
+                                "config option by default")
+    argparser.add_argument('--shared-store', dest='shared_store',
+                           default=None,
+                           help="shared artifact store directory, "
+                                "`shared_store` config option by default")
+    argparser.add_argument('--db', dest='db', default=None,
+                           help="worker DB path, the configured one by "
+                                "default, should differ for the workers "
+                                "on the same host")
+    argparser.add_argument('--name', dest='name', default=None,
+                           help="worker name, `HOST:PID` by default")
+    argparser.add_argument('--once', action="store_true",
+                           dest='once', default=False,
+                           help="exit when there are no queued jobs")
+    argparser.add_argument('--offline', action="store_true",
+                           dest='offline', default=False,
+                           help="fail instead of downloading anything")
+
+    initialize()
+
+    if os.getuid() != 0:
+        fail_with_error("Root privileges are required to run this script")
+
+    if options.db is not None:
+        config['db'] = options.db
+        db.connect()
+
+    # Workers only hand artifacts over
+    config['artifacts'] = True
+
+    try:
+        os.makedirs(options.build_dir)
+    except OSError:
+        pass
+
+    start_jobserver()
+    work(options.once)